@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+import hashlib
+import logging
+import sys
+import time
+
+from python.config import config
+from python.Archive import ArchiveItem, ArchiveFileList
+
+logging.basicConfig(**config["logging"])    # On server logs to /var/log/dweb/dweb-gateway
+
+# Usage: benchmark_archive.py [numfiles]    default 100000
+# Times building a synthetic item with numfiles files, without fetching anything, i.e. the per file work in ArchiveItem.new
+# Each step should grow linearly with numfiles, so e.g. compare 10000 with 100000
+numfiles = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+itemid = "benchmark"
+
+
+def synthetic(n):
+    files = [{"name": "dir{}/file{}.txt".format(i % 100, i), "size": "1000", "mtime": "1500000000", "format": "Text",
+              "sha1": hashlib.sha1(str(i).encode('ascii')).hexdigest()} for i in range(n)]
+    files += [{"name": itemid + "_archive.torrent", "size": "1000", "mtime": "1500000001", "format": "Archive BitTorrent"},
+              {"name": itemid + "_meta.xml", "size": "1000", "mtime": "1500000000", "format": "Metadata"}]
+    return {"metadata": {"identifier": itemid, "magnetlink": "magnet:?xt=urn:btih:0000000000000000000000000000000000000000"},
+            "files": files, "item_size": 1000 * n}
+
+
+def timed(label, func):
+    start = time.time()
+    res = func()
+    elapsed = time.time() - start
+    print("{:<36} {:8.3f}s {:8.2f}us/file".format(label, elapsed, elapsed * 1000000 / numfiles))
+    return res
+
+
+obj = ArchiveItem("archiveid", itemid)
+obj.itemid = itemid
+obj._metadata = synthetic(numfiles)
+print("Item with {} files".format(numfiles))
+timed("annotate (intorrent, contenthash)", obj._annotatefiles)
+obj._list = timed("ArchiveFileList", lambda: ArchiveFileList(obj, "archiveid"))
+names = [f["name"] for f in obj._metadata["files"]]
+timed("filemetadata lookups", lambda: [obj.filemetadata(name) for name in names])
+timed("ArchiveFile for every file", lambda: list(obj._list))
+intorrent = timed("inTorrent for every file", lambda: sum(af.inTorrent() for af in obj._list))
+print("{} files in torrent".format(intorrent))
@@ -0,0 +1,23 @@
+#!/usr/bin/env python3
+
+import logging
+import sys
+
+from python.config import config
+from python.BulkLoader import BulkLoader
+
+logging.basicConfig(**config["logging"])    # On server logs to /var/log/dweb/dweb-gateway
+
+# Usage: bulkload_ipfs.py itemid itemid ...    or    bulkload_ipfs.py < itemids.txt    (one per line)
+# Concurrency per stage is in config["bulkload"], rerunning skips files already in IPFS
+logging.debug("bulkload_ipfs args={}".format(sys.argv)) # sys.argv[1] is first arg (0 is this script)
+itemids = sys.argv[1:] or sys.stdin   # stdin is consumed as the loader has room, so can be a long stream
+
+# Set to False to use IPFS urlstore rather than add (only where config["ipfs"]["url_urlstore"] is set)
+forceadd = True
+# Set to true if want each ipfs hash added to DHT via DHT provide
+announcedht = False
+
+print('"URL","Add/Urlstore","Hash","Size","Announced"')
+res = BulkLoader(forceadd=forceadd, announcedht=announcedht, printlog=True).run(itemids)
+print("Items {items}, files {files}, skipped {skipped}, errors {errors}, {elapsed}s, {filespersec} files/s, {mbpersec} MB/s".format(**res), file=sys.stderr)
@@ -0,0 +1,15 @@
+#!/usr/bin/env python3
+
+import logging
+import sys
+
+from python.config import config
+from python.JobQueue import JobQueue
+import python.ServerGateway   # Imports all the modules that register jobs
+
+logging.basicConfig(**config["logging"])    # On server logs to /var/log/dweb/dweb-gateway
+
+# Run background jobs (see JobQueue) in a separate process from the gateway, e.g. under supervisor
+# Usage: jobworker.py [threads]     default config["jobs"]["workerprocessthreads"]
+logging.debug("jobworker args={}".format(sys.argv)) # sys.argv[1] is first arg (0 is this script)
+JobQueue.run(int(sys.argv[1]) if len(sys.argv) > 1 else None)
@@ -5,14 +5,16 @@ import base64
 import hashlib
 import requests
 import urllib.parse
+import time
 from datetime import datetime
 from .NameResolver import NameResolverDir, NameResolverFile
-from .miscutils import loads, dumps, httpget
+from .miscutils import loads, dumps, httpget, LRUCache, FanOut
 from .config import config
 from .Multihash import Multihash
 from .Errors import CodingException, MyBaseException, IPFSException, TransportURLNotFound, ForbiddenException
-from .HashStore import MagnetLinkService, ThumbnailIPFSfromItemIdService, TitleService
+from .HashStore import HashStore, IPLDHashService, MagnetLinkService, ThumbnailIPFSfromItemIdService, TitleService, ItemMetadataService
 from .TransportIPFS import TransportIPFS
+from .JobQueue import JobQueue
 from .LocalResolver import KeyValueTable
 from .KeyPair import KeyPair
 import json  # for json.decoder.JSONDecodeError
@@ -88,13 +90,25 @@ class AdvancedSearch(NameResolverDir):
         except json.decoder.JSONDecodeError as e:
             logging.error("Failed to decode JSON from search, query %s failed".format(obj.query));
             raise e
-        for doc in obj.res["response"]["docs"]:
-            doc["thumbnaillinks"] = ArchiveItem.item2thumbnail(doc["identifier"], verbose)
+        docs = obj.res["response"]["docs"]
+        for doc in docs:
             c = doc.get("collection")
             if c:
-                collection0id = c[0] if isinstance(c, (list, tuple, set)) else c
-                doc["collection0title"] = cls.collectiontitle(collection0id, verbose)
-                doc["collection0thumbnaillinks"] = ArchiveItem.item2thumbnail(collection0id, verbose)
+                doc["_collection0id"] = c[0] if isinstance(c, (list, tuple, set)) else c
+        # Enrich concurrently, once per distinct id as docs often share a collection, docs not done by the deadline
+        # get the HTTP thumbnail, and the thumbnails and titles will be cached for the next search
+        thumbnailids = {doc["identifier"] for doc in docs} | {doc["_collection0id"] for doc in docs if "_collection0id" in doc}
+        collectionids = {doc["_collection0id"] for doc in docs if "_collection0id" in doc}
+        calls = {("thumbnaillinks", i): (lambda i=i: ArchiveItem.item2thumbnail(i, verbose)) for i in thumbnailids}
+        calls["titles"] = lambda: cls.collectiontitles(collectionids, verbose)
+        enriched = FanOut.run(calls)
+        titles = enriched.get("titles") or {}
+        for doc in docs:
+            doc["thumbnaillinks"] = enriched.get(("thumbnaillinks", doc["identifier"])) or ArchiveItem.item2thumbnailhttp(doc["identifier"])
+            collection0id = doc.pop("_collection0id", None)
+            if collection0id:
+                doc["collection0title"] = titles.get(collection0id, "")
+                doc["collection0thumbnaillinks"] = enriched.get(("thumbnaillinks", collection0id)) or ArchiveItem.item2thumbnailhttp(collection0id)
         obj._list = obj.res["response"]["docs"]  # TODO probably wrong, as prob needs to be NameResolver instances
         if verbose: logging.debug("AdvancedSearch found {0} items".format(len(obj._list)))
         return obj
@@ -110,21 +124,58 @@ class AdvancedSearch(NameResolverDir):
 
     @classmethod
     def collectiontitle(cls, itemid, verbose=False):
-        if itemid.startswith('fav-'):
-            return itemid[4:] + " favorites"
-        if itemid in archiveconfig["staticnames"]:
-            return archiveconfig["staticnames"][itemid]
-        cached = TitleService.archiveidget(itemid, verbose)
-        if cached:
-            return cached
-        query = "https://archive.org/advancedsearch.php?" + '&'.join([k + "=" + v for (k, v) in {'q': 'identifier:'+itemid, 'fl': 'title', 'output': 'json'}.items()])
-        try:
-            title = loads(httpget(query))["response"]["docs"][0]["title"]
-            TitleService.archiveidset(itemid, title, verbose)
-        except Exception as e:
-            logging.error("Couldnt find collection title for {}, err={}".format(itemid, e))
-            title = ""
-        return title
+        return cls.collectiontitles([itemid], verbose)[itemid]
+
+    @classmethod
+    def collectiontitles(cls, itemids, verbose=False):
+        """
+        Titles of collections, cached ones are read from TitleService in one round trip, and the rest found with one
+        advancedsearch query (per 100) and written back in one round trip. Ids not found are cached as "" for
+        config["archive"]["titlemissingttl"] so they arent searched for on every request.
+
+        :param itemids: iterable of collection ids
+        :return:        { itemid: title or "" if not found }
+        """
+        res = {}
+        lookup = []
+        for itemid in set(itemids):
+            if itemid.startswith('fav-'):
+                res[itemid] = itemid[4:] + " favorites"
+            elif itemid in archiveconfig["staticnames"]:
+                res[itemid] = archiveconfig["staticnames"][itemid]
+            else:
+                lookup.append(itemid)
+        cached = HashStore.get_many([("archiveid:" + itemid, TitleService) for itemid in lookup], verbose=verbose)
+        missing = []
+        for itemid, title in zip(lookup, cached):
+            if title is None:
+                missing.append(itemid)
+            else:
+                res[itemid] = title     # Including "" if known not to be found
+        for i in range(0, len(missing), 100):
+            batch = missing[i:i+100]
+            query = "https://archive.org/advancedsearch.php?" + urllib.parse.urlencode(
+                {'q': 'identifier:(' + ' OR '.join(batch) + ')', 'fl': 'identifier,title', 'rows': len(batch), 'output': 'json'})
+            try:
+                found = {doc["identifier"]: doc.get("title") for doc in loads(httpget(query))["response"]["docs"]}
+            except Exception as e:
+                logging.error("Couldnt find collection titles for {}, err={}".format(batch, e))
+                res.update({itemid: "" for itemid in batch})     # Dont cache, may work next time
+                continue
+            triples = []
+            for itemid in batch:
+                title = found.get(itemid)
+                if isinstance(title, list):
+                    title = title[0] if title else None
+                if title:
+                    triples.append(("archiveid:" + itemid, TitleService, title))
+                else:
+                    logging.debug("No collection title for {}".format(itemid))
+                    title = ""
+                    triples.append(("archiveid:" + itemid, TitleService, title, config["archive"]["titlemissingttl"]))
+                res[itemid] = title
+            HashStore.set_many(triples, verbose=verbose)
+        return res
 
 
 # noinspection PyUnresolvedReferences
@@ -137,7 +188,7 @@ class ArchiveItem(NameResolverDir):
     Attributes:
         itemid = itemid
         _thumbnail = list of urls of thumbnail (access via thumbnail())
-        _list = list of ArchiveFiles
+        _list = ArchiveFileList, each ArchiveFile is created when first used
 
     Supports: metadata
     """
@@ -170,31 +221,164 @@ class ArchiveItem(NameResolverDir):
         obj.query = "{}{}".format(config["archive"]["url_metadata"], itemid)    # Typically https://archive.org/metadata/foo
         # TODO-DETAILS may need to handle url escaping, i.e. some queries may be invalid till that is done
         if verbose: logging.debug("Archive Metadata url={0}".format(obj.query))
-        res = httpget(obj.query)        # SLOW - retrieves metadata
-        obj._metadata = loads(res)
+        obj._metadata = cls.fetchmetadata(itemid, verbose=verbose)    # SLOW if not cached - retrieves metadata
         if not obj._metadata:  # metadata retrieval failed, itemid probably false
             raise ArchiveItemNotFound(itemid=itemid)
-        obj.setmagnetlink(wantmodified=True, wanttorrent=kwargs.get("wanttorrent", False), verbose=verbose)  # Set a modified magnet link suitable for WebTorrent
+        # The rest only depend on the metadata, so fetch them concurrently (see FanOut). The magnetlink is part of the
+        # result so is waited for, the optional thumbnail and titles only up to a deadline, they dont change obj so any
+        # still running after the deadline finish in the background, caching their results for next time
+        wanttorrent = kwargs.get("wanttorrent", False)
+        calls = {"magnetlink": lambda: obj.findmagnetlink(wantmodified=True, wanttorrent=wanttorrent, verbose=verbose)}  # A modified magnet link suitable for WebTorrent
         if not obj._metadata["metadata"].get("thumbnaillinks"):  # Set thumbnaillinks if not done already - can be slow as loads to IPFS
-            obj._metadata["metadata"]["thumbnaillinks"] = obj.item2thumbnail(obj.itemid, verbose)
+            calls["thumbnaillinks"] = lambda: cls.item2thumbnail(itemid, verbose)
+        collections = obj._metadata["metadata"].get("collection")
+        if collections and not args:    # Will want titles for metadata()
+            collections = collections if isinstance(collections, (list, tuple, set)) else [collections]
+            calls["collection_titles"] = lambda: AdvancedSearch.collectiontitles(collections, verbose)
+        res = FanOut.run(calls, required=("magnetlink",))
+        if "magnetlink" in res:
+            obj._setmagnetlink(*res["magnetlink"])
+        elif wanttorrent:   # Failed, cant return the torrent without it, so try again
+            obj.setmagnetlink(wantmodified=True, wanttorrent=True, verbose=verbose)
+        if "thumbnaillinks" in calls:
+            obj._metadata["metadata"]["thumbnaillinks"] = res.get("thumbnaillinks") or cls.item2thumbnailhttp(itemid)
+        if "collection_titles" in calls:
+            obj._collectiontitles = res.get("collection_titles") or {c: "" for c in collections}
         name = "/".join(args) if args else None  # Get the name of the file if present
         if name:  # Its a single file just cache that one
             if name.startswith(".____padding_file"):    # Webtorrent convention
                 ln = int(name.split('/')[-1])
                 return ArchiveFilePadding(verbose=verbose, ln=ln)
             else:
-                f = [f for f in obj._metadata["files"] if f["name"] == name]
-                if not f: raise Exception("Valid Archive item {} but no file called: {}".format(itemid, name))    # TODO change to islice
-                return ArchiveFile.new(namespace, itemid, name, item=obj, metadata=f[0], verbose=verbose)
-        else:  # Its an item - cache all the files
-            obj._list = [ArchiveFile.new(namespace, itemid, f["name"], item=obj, metadata=f, transport=transport,
-                                         verbose=verbose) for f in obj._metadata["files"]]
+                f = obj.filemetadata(name)
+                if not f: raise Exception("Valid Archive item {} but no file called: {}".format(itemid, name))
+                return ArchiveFile.new(namespace, itemid, name, item=obj, metadata=f, verbose=verbose)
+        else:  # Its an item - annotate all the files, but only make ArchiveFiles if they are used e.g. by cache_ipfs
+            obj._annotatefiles()
+            obj._list = ArchiveFileList(obj, namespace, transport=transport, verbose=verbose)
             if verbose: logging.debug("Archive Metadata found {0} files".format(len(obj._list)))
             return obj
 
+    def filemetadata(self, name):
+        """
+        :param name:    Name of a file in the item
+        :return:        Its dict from the files in the item's metadata, or None, via an index built on first use
+        """
+        if self._fileindex is None:
+            self._fileindex = {f["name"]: f for f in self._metadata["files"]}
+        return self._fileindex.get(name)
+
+    def _annotatefiles(self):
+        """
+        Set contenthash and magnetlink on the metadata of all files in one pass, as ArchiveFile.new does for one file,
+        the in torrent test only does per file work as the rest is cached on the item (see torrentrules)
+        """
+        magnetlink = self._metadata["metadata"].get("magnetlink")
+        for f in self._metadata["files"]:
+            if magnetlink and self.fileintorrent(f):
+                f["magnetlink"] = "{}/{}".format(magnetlink, f["name"])
+            if f.get("sha1"):  # For the _files.xml there is no SHA1
+                f["contenthash"] = "contenthash:/contenthash/{}".format(Multihash.multihash58fromsha1hex(f["sha1"]))
+
+    _metadatacache = None   # LRUCache of { fetched, updated, raw } by itemid, created by fetchmetadata
+    _collectiontitles = None    # { collectionid: title } fetched by new() alongside the other sub-fetches, for metadata()
+    _fileindex = None   # { name: file metadata } built by filemetadata
+    _torrenttime = None     # Cached by torrenttime
+    _torrentrules = None    # Cached by torrentrules
+    torrentsizelimit = 80530636800  # Items bigger than this (75GB) have no files in their torrent
+
+    @classmethod
+    def fetchmetadata(cls, itemid, verbose=False):
+        """
+        Get an item's metadata from archive.org, via a cache in this process and (optionally) a shared one in redis.
+        Each cache entry holds the raw JSON (so callers get a fresh copy they can modify), when it was fetched and the
+        item's item_last_updated. Entries younger than config["metadatacache"]["ttl"] are used as is, older ones are
+        revalidated by fetching just item_last_updated, and only refetched if the item has changed.
+
+        :param itemid:  Archive item id
+        :return:        dict of metadata, empty if the item doesnt exist
+        """
+        conf = config["metadatacache"]
+        url = "{}{}".format(config["archive"]["url_metadata"], itemid)    # Typically https://archive.org/metadata/foo
+        if not conf["enabled"]:
+            return loads(httpget(url))
+        if cls._metadatacache is None:
+            ArchiveItem._metadatacache = LRUCache(conf["size"])
+        now = time.time()
+        entry = cls._metadatacache.get(itemid)
+        if entry is None and conf["redis"]:
+            stored = ItemMetadataService.get(itemid, verbose)
+            entry = loads(stored) if stored else None
+        if entry and now - entry["fetched"] < conf["ttl"]:
+            if verbose: logging.debug("Archive Metadata cached for {}".format(itemid))
+            cls._metadatacache.set(itemid, entry)
+            return loads(entry["raw"])
+        if entry and conf["revalidate"] and entry["updated"]:
+            try:
+                updated = loads(httpget(url + "/item_last_updated")).get("result")    # Tiny response e.g. {"result":1525390337}
+            except (requests.exceptions.RequestException, TransportURLNotFound, ForbiddenException, json.decoder.JSONDecodeError) as e:
+                logging.warning("Unable to revalidate metadata for {}: {}".format(itemid, e))
+                updated = None
+            if updated == entry["updated"]:
+                if verbose: logging.debug("Archive Metadata unchanged for {}".format(itemid))
+                entry = dict(entry, fetched=now)
+                cls._cachemetadata(itemid, entry, verbose)
+                return loads(entry["raw"])
+        raw = httpget(url)
+        if isinstance(raw, bytes):
+            raw = raw.decode('utf-8')
+        metadata = loads(raw)
+        if metadata:    # Dont cache unknown items, archive.org returns {}
+            cls._cachemetadata(itemid, {"fetched": now, "updated": metadata.get("item_last_updated"), "raw": raw}, verbose)
+        return metadata
+
+    @classmethod
+    def _cachemetadata(cls, itemid, entry, verbose=False):
+        cls._metadatacache.set(itemid, entry)
+        if config["metadatacache"]["redis"]:
+            ItemMetadataService.set(itemid, dumps(entry), ttl=config["metadatacache"]["maxstale"], verbose=verbose)
+
     def torrenttime(self):
-        files = [ f for f in self._metadata["files"] if f["name"].endswith(self.itemid +"_archive.torrent")]
-        return int(files[0]["mtime"]) if len(files) else 0
+        """
+        :return: mtime of the item's torrent file or 0 if it has none, found once per item
+        """
+        if self._torrenttime is None:
+            torrentname = self.itemid + "_archive.torrent"
+            self._torrenttime = next((int(f["mtime"]) for f in self._metadata["files"] if f["name"].endswith(torrentname)), 0)
+        return self._torrenttime
+
+    def torrentrules(self):
+        """
+        The parts of the in torrent test that dont depend on the file, worked out once per item rather than for each file
+
+        :return: (excluded, rejectsuffixes) excluded is True if no files are in the torrent, rejectsuffixes a tuple for str.endswith
+        """
+        if self._torrentrules is None:
+            self._torrentrules = (
+                (self._metadata["metadata"].get("noarchivetorrent", None) == "true")
+                # The rule is a bit more complex, if any of the collctions an item is in are not open (don't start with open_) then can go to 250GB else 75GB)
+                or self._metadata["item_size"] > self.torrentsizelimit,
+                tuple(config["torrent_reject_list"]))
+        return self._torrentrules
+
+    def fileintorrent(self, f):
+        """
+        :param f:   dict of a file from the item's metadata
+        :return:    True if the file is in the item's torrent
+        """
+        # TODO may be some specific files e.g. _meta.xml that should also return false
+        excluded, rejectsuffixes = self.torrentrules()
+        if excluded or f["name"].endswith(rejectsuffixes):
+            return False
+        torrenttime = self.torrenttime()
+        if (not f.get("mtime")) or (torrenttime < int(f["mtime"])):
+            if torrenttime: # Only log the data inconsistency if the torrent exists
+                # Note known bug in Traceys code as of 13Nov2018 where doesnt update torrent when writing __ia_thumb.jpg TODO ask Tracey to fix
+                # Large torrents can be behind on updates
+                if (self._metadata["item_size"] < self.torrentsizelimit) and (f["name"] != "__ia_thumb.jpg"):
+                    logging.warning("Aaron believes all that torrents updated for files not in reject_list exception={}/{}".format(self.itemid, f["name"]));
+            return False
+        return True
 
     @classmethod
     def modifiedtorrent(cls, itemid, wantmodified=True, verbose=False):
@@ -267,10 +451,10 @@ class ArchiveItem(NameResolverDir):
         This is based on assumption that if/when CORS issues are fixed then client will go direct to this API on archive.org
         """
         if self._metadata["metadata"].get("collection"):
-            self._metadata["collection_titles"] = {k: AdvancedSearch.collectiontitle(k, verbose) for k in
-                                                (self._metadata["metadata"]["collection"]
+            self._metadata["collection_titles"] = self._collectiontitles or AdvancedSearch.collectiontitles(
+                                                self._metadata["metadata"]["collection"]
                                                 if isinstance(self._metadata["metadata"]["collection"], (list, tuple, set))
-                                                else [self._metadata["metadata"]["collection"]])}
+                                                else [self._metadata["metadata"]["collection"]], verbose)
         if self._metadata.get("is_collection"): # We are looking up what collections this collection is in as that is used to override the default sort order.
             collections = self._metadata["metadata"].get("collection") or []    # Empty collection if non specified
             if not isinstance(collections, (tuple, list, set)): collections = [collections]
@@ -285,18 +469,34 @@ class ArchiveItem(NameResolverDir):
         - assume that metadata already fetched but that _metadata.files not converted to _list yet (as that process  will use this data.
         :return:
         """
+        self._setmagnetlink(*self.findmagnetlink(wantmodified=wantmodified, wanttorrent=wanttorrent, verbose=verbose))
+
+    def findmagnetlink(self, wantmodified=True, wanttorrent=False, verbose=False):
+        """
+        Find the magnet link, building it from the torrent if not cached, without changing self, so that it can run
+        concurrently with other parts of ArchiveItem.new. See setmagnetlink for parameters.
+
+        :return:    (magnetlink or None, torrentdata or None if didnt need the torrent)
+        """
         if not self._metadata:
             raise CodingException(message="Must have fetched metadata before read torrentdata")
+        magnetlink = None
+        torrentdata = None
         if not self._metadata["metadata"].get("noarchivetorrent", None) == "true": # Some items intentionally dont have torrents
             magnetlink = self._metadata["metadata"].get("magnetlink")  # First check the metadata
             if not magnetlink or wanttorrent:  # Skip if its already set.
                 magnetlink = MagnetLinkService.archiveidget(self.itemid, verbose)  # Look for cached version
                 if not magnetlink or wanttorrent:  # If not cached then build new one
-                    self.torrentdata = self.modifiedtorrent(self.itemid, wantmodified=wantmodified, verbose=True) # Note sideeffect of setting magnetlinks in redis cache, it can be none if torrent inaccessible
+                    torrentdata = self.modifiedtorrent(self.itemid, wantmodified=wantmodified, verbose=True) # Note sideeffect of setting magnetlinks in redis cache, it can be none if torrent inaccessible
                     magnetlink = MagnetLinkService.archiveidget(self.itemid, verbose)  # Look for version cached above
-                if magnetlink:
-                    self._metadata["metadata"]["magnetlink"] = magnetlink  # Store on metadata if have one
             if verbose: logging.info("Magnetlink for {} = {}".format(self.itemid, magnetlink))
+        return magnetlink, torrentdata
+
+    def _setmagnetlink(self, magnetlink, torrentdata):
+        if torrentdata is not None:
+            self.torrentdata = torrentdata
+        if magnetlink:
+            self._metadata["metadata"]["magnetlink"] = magnetlink  # Store on metadata if have one
 
     def torrent(self, headers=True, verbose=False, **kwargs):
         """
@@ -307,12 +507,16 @@ class ArchiveItem(NameResolverDir):
         data = bencode.bencode(self.torrentdata)   # Set in ArchiveItem.new > setmagnetlink
         return {"Content-type": mimetype, "data": data} if headers else data
 
-    def leaf(self, headers=True, verbose=False):
+    def leaf(self, headers=True, verbose=False, wantipfs=None):
         """
         Resolve names to a Leaf (a pointer to a metadata record)
 
         :param headers:
         :param verbose:
+        :param wantipfs:    True to store the metadata in IPFS and include its url, False to leave it out,
+                            default is to include it if this metadata is already in IPFS, else True unless JobQueue.enabled()
+                            in which case a job is queued to store it and the leaf. The leaf is only stored in the
+                            KeyValueTable if it includes IPFS, so it never replaces a leaf the job stored.
         :raises: IPFSException if cant reach IPFS
         :return:
         """
@@ -321,12 +525,24 @@ class ArchiveItem(NameResolverDir):
         # TODO-DOMAIN - store Name record on local nameservice (set)
         # TODO-DOMAIN - return Name record to caller
         metadata = self.metadata(headers=False, verbose=verbose)
-        # Store in IPFS, note cant use urlstore on IPFS as metadata is mutable
-        try:
-            # Store on IPFS, dont ping gateway as will return a gateway url in the result so client can
-            ipfsurl = TransportIPFS().store(data=metadata, verbose=verbose, mimetype="application/json", pinggateway=False)
-        except Exception as e:
-            raise IPFSException(message=e)
+        metadatahash = Multihash(data=dumps(metadata), code=Multihash.SHA2_256).multihash58  # Changes when metadata does
+        ipldhash = IPLDHashService.get(metadatahash, verbose=verbose) if wantipfs is not False else None
+        if wantipfs is None and not ipldhash:
+            wantipfs = not JobQueue.enabled()
+            if not wantipfs:
+                JobQueue.enqueue("leaf", self.itemid)    # Stores a leaf including IPFS, for later requests
+        urls = [config["gateway"]["url_metadata"]+self.itemid]  # Where to get the content
+        if wantipfs and not ipldhash:
+            # Store in IPFS, note cant use urlstore on IPFS as metadata is mutable
+            try:
+                # Store on IPFS, dont ping gateway as will return a gateway url in the result so client can
+                ipfsurl = TransportIPFS().store(data=metadata, verbose=verbose, mimetype="application/json", pinggateway=False)
+            except Exception as e:
+                raise IPFSException(message=e)
+            ipldhash = ipfsurl.split('/')[-1]
+            IPLDHashService.set(metadatahash, ipldhash, verbose=verbose)
+        if ipldhash:
+            urls.insert(0, "ipfs:/ipfs/{}".format(ipldhash))
         # TODO-DOMAIN probably encapsulate construction of name once all tested
         metadataverifykey = config["domains"]["metadataverifykey"]
         metadatapassphrase = config["domains"]["metadatapassphrase"]
@@ -335,7 +551,7 @@ class ArchiveItem(NameResolverDir):
             "name": self.itemid,
             "signatures": [],
             "table": "leaf",
-            "urls": [ipfsurl, config["gateway"]["url_metadata"]+self.itemid]  # Where to get the content
+            "urls": urls
         }
         datenow = datetime.utcnow().isoformat()
         signable = dumps({"date": datenow, "signed": {k: leaf.get(k) for k in ["urls", "name", "expires"] if leaf.get(k)}})  # TODO-DOMAIN-DOC matches SignatureMixin.call in Domain.js
@@ -348,8 +564,9 @@ class ArchiveItem(NameResolverDir):
         # Next two lines would be if adding to HTTP on different machine, instead assuming this machine *is* the KeyValueTable we can go direct.
         # tableurl = "{}/get/table/{}/domains".format(server, pkeymetadatadomain)
         # TransportHTTP().set(tableurl, self.itemid, dumps(leaf), verbose)  # TODO-DOMAIN need to write TransportHTTP
-        KeyValueTable.new("table", metadataverifykey, "domain", verbose=verbose)\
-            .set(headers=False, verbose=verbose, data=[{"key": self.itemid, "value": dumps(leaf)}])
+        if ipldhash:
+            KeyValueTable.new("table", metadataverifykey, "domain", verbose=verbose)\
+                .set(headers=False, verbose=verbose, data=[{"key": self.itemid, "value": dumps(leaf)}])
         mimetype = 'application/json'
         data = {self.itemid: dumps(leaf)}
         return {"Content-type": mimetype, "data": data} if headers else data
@@ -360,26 +577,45 @@ class ArchiveItem(NameResolverDir):
         Set the thumbnail field if not set and return list of urls
         :return:    Array of links to thumbnail - usually IPFS, then HTTP via gateway
         """
-        archive_servicesimgurl = "{}{}".format(config["archive"]["url_servicesimg"], itemid)  # Note similar code in torrentdata
-        archive_servicesimgurl_cors = "{}{}".format(config["gateway"]["url_servicesimg"], itemid)  # Note similar code in torrentdata
         thumbnailipfsurl = ThumbnailIPFSfromItemIdService.get(itemid)
         if not thumbnailipfsurl:  # Dont have IPFS URL
-            if verbose: logging.debug("Retrieving thumbnail for {}".format(itemid))
-            # Store to IPFS and if still reqd then ping the ipfs.io gateway
             try:
-                # Store on IPFS - dont ping gateway (which is slow) allow first browser to ping on timeout by adding ipfs.io URL to return
-                thumbnailipfsurl = TransportIPFS().store(urlfrom=archive_servicesimgurl, verbose=verbose, pinggateway=False, mimetype="image/PNG")
-                logging.debug("Got thumbnail IPFS URL {}".format(thumbnailipfsurl))
+                thumbnailipfsurl = JobQueue.enqueue("storethumbnail", itemid)   # None if queued to run in background
             except IPFSException as e:
                 logging.error(e)
-                return [archive_servicesimgurl_cors]    # Just return the http URL, dont store in REDIS so will try again next time
-            ThumbnailIPFSfromItemIdService.set(itemid, thumbnailipfsurl)
+            if not thumbnailipfsurl:
+                return cls.item2thumbnailhttp(itemid)    # Just return the http URL, IPFS will be there next time
         #return [thumbnailipfsurl, thumbnailipfsurl.replace('ipfs:/ipfs/','https://ipfs.io/ipfs/'), archive_servicesimgurl_cors]
-        return [thumbnailipfsurl, archive_servicesimgurl_cors]
+        return [thumbnailipfsurl] + cls.item2thumbnailhttp(itemid)
+
+    @classmethod
+    def item2thumbnailhttp(cls, itemid):
+        """
+        :return:    Array of the HTTP link to thumbnail via gateway, as item2thumbnail returns when it doesnt have IPFS
+        """
+        return ["{}{}".format(config["gateway"]["url_servicesimg"], itemid)]  # Note similar code in torrentdata
+
+    @classmethod
+    def storethumbnail(cls, itemid, verbose=False):
+        """
+        Store an item's thumbnail to IPFS and remember it in ThumbnailIPFSfromItemIdService, run as a job by item2thumbnail
+
+        :raises:    IPFSException if cant store, in which case nothing is remembered so will try again next time
+        :return:    IPFS url of thumbnail
+        """
+        archive_servicesimgurl = "{}{}".format(config["archive"]["url_servicesimg"], itemid)
+        if verbose: logging.debug("Retrieving thumbnail for {}".format(itemid))
+        # Store on IPFS - dont ping gateway (which is slow) allow first browser to ping on timeout by adding ipfs.io URL to return
+        thumbnailipfsurl = TransportIPFS().store(urlfrom=archive_servicesimgurl, verbose=verbose, pinggateway=False, mimetype="image/PNG")
+        logging.debug("Got thumbnail IPFS URL {}".format(thumbnailipfsurl))
+        ThumbnailIPFSfromItemIdService.set(itemid, thumbnailipfsurl)
+        return thumbnailipfsurl
 
     def thumbnail(self, headers=True, verbose=False):
-        (data, mimetype) = httpget("{}{}".format(config["archive"]["url_servicesimg"], self.itemid), wantmime=True)
-        return {"Content-type": mimetype, "data": data} if headers else data
+        url = "{}{}".format(config["archive"]["url_servicesimg"], self.itemid)
+        if headers:
+            return self._streamurl(url)     # Pass through as it arrives
+        return httpget(url)
 
     def cache_ipfs(self, forceurlstore=False, forceadd=False, verbose=False, announcedht=False, printlog=False):
         """
@@ -391,6 +627,35 @@ class ArchiveItem(NameResolverDir):
         for af in self._list:
             af.cache_ipfs(url=af.archive_url, verbose=verbose, forceurlstore=forceurlstore, forceadd=forceadd, printlog=printlog, announcedht=announcedht, size=int(af._metadata.get("size","0")))
 
+class ArchiveFileList(object):
+    """
+    The files of an ArchiveItem as a sequence of ArchiveFile, each created on first access, so that items with many files
+    dont pay for objects that are never used.
+    """
+
+    def __init__(self, item, namespace, transport=None, verbose=False):
+        self.item = item
+        self.namespace = namespace
+        self.transport = transport
+        self.verbose = verbose
+        self._files = [None] * len(item._metadata["files"])
+
+    def __len__(self):
+        return len(self._files)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if self._files[i] is None:
+            f = self.item._metadata["files"][i]
+            self._files[i] = ArchiveFile.new(self.namespace, self.item.itemid, f["name"], item=self.item, metadata=f,
+                                             transport=self.transport, verbose=self.verbose)
+        return self._files[i]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
 # noinspection PyProtectedMember
 class ArchiveFile(NameResolverFile):
     """
@@ -470,27 +735,12 @@ class ArchiveFile(NameResolverFile):
         return data
 
     def content(self, _headers=None, verbose=False, **kwargs):   # Equivalent to archive.org/downloads/xxx/yyy but gets around cors problems
-        (data, self.mimetype) = httpget(self.archive_url, wantmime=True, range=_headers.get("range"))
-        return {"Content-type": self.mimetype, "data": data}
-        # TODO this should really pass back a stream
+        res = self._streamurl(self.archive_url, _headers=_headers)    # Streamed, honoring any range in _headers
+        self.mimetype = res["Content-type"]
+        return res
 
     def inTorrent(self):
-        # TODO may be some specific files e.g. _meta.xml that should also return false
-        pass
-        if (self.parent._metadata["metadata"].get("noarchivetorrent", None) == "true") or \
-            any([ self._metadata["name"].endswith(ending) for ending in config["torrent_reject_list"] ]):
-            return False
-        # The rule is a bit more complex, if any of the collctions an item is in are not open (don't start with open_) then can go to 250GB else 75GB)
-        if self.parent._metadata["item_size"] > 80530636800:
-            return False
-        if (not self._metadata.get("mtime")) or (self.parent.torrenttime() < int(self._metadata["mtime"])):
-            if self.parent.torrenttime(): # Only log the data inconsistency if the torrent exists
-                # Note known bug in Traceys code as of 13Nov2018 where doesnt update torrent when writing __ia_thumb.jpg TODO ask Tracey to fix
-                # Large torrents can be behind on updates
-                if (self.parent._metadata["item_size"] < 80530636800) and (self._metadata["name"] != "__ia_thumb.jpg"):
-                    logging.warning("Aaron believes all that torrents updated for files not in reject_list exception={}/{}".format(self.itemid, self._metadata["name"]));
-            return False
-        return True
+        return self.parent.fileintorrent(self._metadata)
 
 class ArchiveFilePadding(ArchiveFile):
     # Catch special case of ".____padding_file/nnn" and deliver a range of 0 bytes.
@@ -528,3 +778,8 @@ class ArchiveFilePadding(ArchiveFile):
         """
         return {"Content-type": self.mimetype, "data": self.retrieve(_headers=_headers)}
 
+
+
+# Jobs that can be run in the background (see JobQueue)
+JobQueue.register("storethumbnail", ArchiveItem.storethumbnail)
+JobQueue.register("leaf", lambda itemid: ArchiveItem.new("archiveid", itemid).leaf(headers=False, wantipfs=True))
@@ -0,0 +1,210 @@
+# encoding: utf-8
+"""
+Bulk ingestion of archive.org items into IPFS, a concurrent alternative to calling ArchiveItem.cache_ipfs on one item
+at a time (see load_ipfs.py), which fetches and adds each file in turn.
+
+Files flow through a pipeline of stages, each with its own pool of threads and a bounded queue in front of it, so
+that e.g. slow downloads dont stall adds to IPFS, and memory is bounded to what the queues hold.
+
+metadata:   itemid => files, from ArchiveItem.fetchmetadata, skipping files IPLDHashService already knows (one round trip per item)
+fetch:      file => file with data, from archive.org (skipped when using urlstore, where IPFS fetches it, or when streaming)
+add:        file => file with ipldhash, via TransportIPFS.store, or storeurlstream which fetches as it adds if config["ipfs"]["streamadd"]
+record:     IPLDHashService and MimetypeService for the file, in one round trip
+
+Progress is durable because it is the IPLDHashService itself, so a rerun (e.g. after an interruption) skips files
+already added. Files with no sha1 in the item metadata (e.g. _files.xml) cant be checked before fetching so are redone.
+
+Parameters come from config["bulkload"]
+metadataworkers, fetchworkers, addworkers, recordworkers:   Threads per stage
+queuedepth:     Files (or items) waiting in front of each stage, bounds memory to about fetchworkers+queuedepth files
+reportinterval: Seconds between logging throughput
+"""
+import logging
+import queue
+import threading
+import time
+from urllib.parse import urlparse
+from .config import config
+from .miscutils import httpget
+from .Multihash import Multihash
+from .HashStore import HashStore, IPLDHashService, MimetypeService
+from .TransportIPFS import TransportIPFS
+from .Archive import ArchiveItem, ArchiveItemNotFound
+
+
+class _File(object):
+    """
+    A file in flight through the pipeline
+    """
+    def __init__(self, itemid, name, size, sha1hex=None):
+        self.itemid = itemid
+        self.name = name
+        self.size = size
+        self.multihash = Multihash(sha1hex=sha1hex) if sha1hex else None
+        self.url = "{}{}/{}".format(config["archive"]["url_download"], itemid, name)  # As ArchiveFile.archive_url
+        self.data = None
+        self.mimetype = None
+        self.ipldhash = None
+        self.did = None     # "add" or "urlstore"
+
+
+class BulkLoader(object):
+    """
+    Push all the files of a list (or stream) of items into IPFS
+
+    Fields:
+    forceadd:       True to fetch and add, False to use urlstore where configured (see NameResolverFile.cache_ipfs)
+    announcedht:    True to announce each file to the DHT as it is added
+    printlog:       True to print a CSV line per file as load_ipfs.py does
+    stats:          { items, files, skipped, errors, bytes } counted so far
+
+    Methods:
+    run(itemids)    Load the items, return stats with rates
+    """
+    _done = object()    # Passed down the stages when there are no more items
+
+    def __init__(self, forceadd=True, announcedht=False, printlog=False, verbose=False):
+        self.forceadd = forceadd or not config["ipfs"].get("url_urlstore")
+        self.stream = self.forceadd and config["ipfs"].get("streamadd")    # Fetch in the add stage, without buffering
+        self.announcedht = announcedht
+        self.printlog = printlog
+        self.verbose = verbose
+        self.stats = {"items": 0, "files": 0, "skipped": 0, "errors": 0, "bytes": 0}
+        self._statslock = threading.Lock()
+        self._start = None
+
+    def _count(self, **kwargs):
+        with self._statslock:
+            for k, v in kwargs.items():
+                self.stats[k] += v
+
+    def rates(self):
+        """
+        :return: stats with elapsed seconds, files/s and MB/s added
+        """
+        elapsed = max(time.time() - self._start, 0.001) if self._start else 0.001
+        with self._statslock:
+            res = dict(self.stats)
+        res["elapsed"] = round(elapsed, 1)
+        res["filespersec"] = round(res["files"] / elapsed, 2)
+        res["mbpersec"] = round(res["bytes"] / elapsed / 1000000, 2)
+        return res
+
+    def run(self, itemids):
+        """
+        Load all files of all items, returns when they are all recorded
+
+        :param itemids: iterable of item ids, can be a generator e.g. lines of stdin, which is consumed as the pipeline has room
+        :return:        rates()
+        """
+        conf = config["bulkload"]
+        self._start = time.time()
+        stages = [  # (function, workers) function takes an item from its queue and returns a list to pass to the next
+            (self._metadata, conf["metadataworkers"]),
+            (self._fetch, conf["fetchworkers"] if self.forceadd and not self.stream else 1),
+            (self._add, conf["addworkers"]),
+            (self._record, conf["recordworkers"]),
+        ]
+        queues = [queue.Queue(maxsize=conf["queuedepth"]) for _ in stages] + [None]
+        threads = []
+        for i, (func, workers) in enumerate(stages):
+            remaining = [workers]  # Last worker of a stage to finish tells the workers of the next stage
+            nextworkers = stages[i + 1][1] if i + 1 < len(stages) else 0
+            for _ in range(workers):
+                t = threading.Thread(target=self._worker, args=(func, queues[i], queues[i + 1], remaining, nextworkers), daemon=True)
+                t.start()
+                threads.append(t)
+        finished = threading.Event()
+        reporter = threading.Thread(target=self._reporter, args=(finished,), daemon=True)
+        reporter.start()
+        try:
+            for itemid in itemids:
+                itemid = itemid.strip()
+                if itemid:
+                    queues[0].put(itemid)
+        finally:
+            for _ in range(stages[0][1]):
+                queues[0].put(self._done)
+            for t in threads:
+                t.join()
+            finished.set()
+        res = self.rates()
+        logging.info("Bulk load finished {}".format(res))
+        return res
+
+    def _worker(self, func, inq, outq, remaining, nextworkers):
+        while True:
+            obj = inq.get()
+            if obj is self._done:
+                break
+            try:
+                for res in func(obj):
+                    if outq is not None:
+                        outq.put(res)
+            except Exception as e:
+                self._count(errors=1)
+                logging.error("Bulk load failed on {}: {}".format(obj if isinstance(obj, str) else obj.url, e))
+        with self._statslock:
+            remaining[0] -= 1
+            last = not remaining[0]
+        if last:
+            for _ in range(nextworkers):
+                outq.put(self._done)
+
+    def _reporter(self, finished):
+        while not finished.wait(config["bulkload"]["reportinterval"]):
+            logging.info("Bulk load {}".format(self.rates()))
+
+    def _metadata(self, itemid):
+        metadata = ArchiveItem.fetchmetadata(itemid, verbose=self.verbose)
+        if not metadata:
+            raise ArchiveItemNotFound(itemid=itemid)
+        files = [_File(itemid, f["name"], int(f.get("size", "0")), f.get("sha1")) for f in metadata.get("files", [])]
+        hashed = [f for f in files if f.multihash]
+        done = HashStore.get_many([(f.multihash.multihash58, IPLDHashService) for f in hashed])
+        skip = {f.name for f, ipldhash in zip(hashed, done) if ipldhash}
+        self._count(items=1, skipped=len(skip))
+        if self.verbose: logging.debug("Bulk load {} has {} files, {} already in IPFS".format(itemid, len(files), len(skip)))
+        return [f for f in files if f.name not in skip]
+
+    def _fetch(self, f):
+        if self.forceadd and not self.stream:
+            f.data, f.mimetype = httpget(f.url, wantmime=True)
+            if isinstance(f.data, str):
+                f.data = f.data.encode('utf-8')
+            if not f.multihash:
+                f.multihash = Multihash(data=f.data, code=Multihash.SHA1)
+        return [f]
+
+    def _add(self, f):
+        if self.stream:
+            f.did = "add"
+            stored = TransportIPFS().storeurlstream(f.url, pinggateway=False, verbose=self.verbose)
+            ipldurl, f.mimetype, f.size = stored["url"], stored["mimetype"], stored["size"]
+            if f.multihash and f.multihash.sha1hex != stored["sha1hex"]:
+                # Changed since the metadata was fetched, as NameResolverFile.cache_ipfs record it under what was added
+                logging.warning("SHA1 mismatch on {} expected {} got {}".format(f.url, f.multihash.sha1hex, stored["sha1hex"]))
+                f.multihash = None
+            if not f.multihash:
+                f.multihash = Multihash(sha1hex=stored["sha1hex"])
+        elif self.forceadd:
+            f.did = "add"
+            ipldurl = TransportIPFS().store(data=f.data, pinggateway=False, mimetype=f.mimetype, verbose=self.verbose)
+            f.size = len(f.data)
+            f.data = None   # Release memory as soon as possible
+        else:
+            f.did = "urlstore"
+            ipldurl = TransportIPFS().store(urlfrom=f.url, pinggateway=False, verbose=self.verbose)
+        f.ipldhash = urlparse(ipldurl).path.split('/')[2]
+        if self.announcedht:
+            TransportIPFS().announcedht(f.ipldhash)
+        return [f]
+
+    def _record(self, f):
+        if f.multihash:     # Only missing for urlstore of a file with no sha1
+            HashStore.set_many([(f.multihash.multihash58, IPLDHashService, f.ipldhash),
+                                (f.multihash.multihash58, MimetypeService, f.mimetype)], verbose=self.verbose)
+        self._count(files=1, bytes=f.size)
+        if self.printlog:
+            print('"{}","{}","{}","{}","{}"'.format(f.url, f.did, f.ipldhash, f.size, self.announcedht))
+        return []
@@ -3,11 +3,12 @@ import sqlite3
 import logging
 import requests
 
-from .HashStore import LocationService, MimetypeService, IPLDHashService
+from .HashStore import HashStore, LocationService, MimetypeService, IPLDHashService
 from .Multihash import Multihash
 from .NameResolver import NameResolverDir, NameResolverFile, NameResolverSearchItem, NameResolverSearch
-from .miscutils import httpget
+from .miscutils import httpget, HTTPSessions
 from .Errors import SearchException, NoContentException
+from .JobQueue import JobQueue
 
 class DOI(NameResolverDir):
     """
@@ -149,7 +150,7 @@ class DOI(NameResolverDir):
         try:
             headers = {"accept": "*/*"}
             # This next link can fail, it follows a redirection and then can fail on th actual PDF, which isnt what we want cos we'll use a Archive URL
-            request = requests.get(url, headers=headers)
+            request = HTTPSessions.session().get(url, headers=headers)
         except Exception as e:
             raise e
         if verbose: logging.debug("result={0}".format(request.status_code))
@@ -164,7 +165,7 @@ class DOI(NameResolverDir):
         """
         url = "http://dx.doi.org/" + doi
         headers = {"accept": "application/vnd.citationstyles.csl+json"}
-        r = requests.get(url, headers=headers)  # Note that with headers it wont redirect, without it will go to doc which may fail
+        r = HTTPSessions.session().get(url, headers=headers)  # Note that with headers it wont redirect, without it will go to doc which may fail
         if verbose: logging.debug("get_doi_metadata returned: {0}".format(r))
         if r.status_code == 200:
             return r.json()
@@ -229,25 +230,35 @@ class DOIfile(NameResolverFile):    # Note plural
             if verbose: logging.debug("multihash base58={0}".format(self.multihash.multihash58))
             #multihash58_sha256 = Multihash(data=doifile.retrieve(), code=SHA256)
             #logging.debug("Saving location "+ multihash58_sha256+":"+doifile._metadata["urls"][0]  )
-            LocationService.set(self.multihash.multihash58, self._metadata["files"][0], verbose=verbose)
-            MimetypeService.set(self.multihash.multihash58, self._metadata["mimetype"], verbose=verbose)
-            ipldhash = IPLDHashService.get(self.multihash.multihash58)    # May be None, we don't know it
-            if not ipldhash:
-                data = httpget(self._metadata["files"][0])
-                #TODO move this to a URL or better to TransportIPFS when built
-                #ipfsurl = "https://ipfs.dweb.me/api/v0/add"  # note Kyle was using localhost:5001/api/v0/add which wont resolve externally.
-                ipfsurl = "http://localhost:5001/api/v0/add"  # note Kyle was using localhost:5001/api/v0/add which wont resolve externally.
-                if verbose: logging.debug("Fetching IPFS from {0}".format(ipfsurl))
-                #Debugging - running into problems with 404, not sure if laptop/HTTPS issue or server
-                #ipldresp = requests.post(ipfsurl, files={'file': ('', data, self.metadata["mimetype"])})
-                #ipldhash = ipldresp.json()['Hash']
-                res = requests.post(ipfsurl, files={'file': ('', data, self._metadata["mimetype"])}).json()
-                logging.debug("IPFS result={}".format(res))
-                ipldhash = res['Hash']
-                IPLDHashService.set(self.multihash.multihash58, ipldhash)
+            ipldhash, = HashStore.set_many([(self.multihash.multihash58, LocationService, self._metadata["files"][0]),
+                                            (self.multihash.multihash58, MimetypeService, self._metadata["mimetype"])],
+                                           get=[(self.multihash.multihash58, IPLDHashService)], verbose=verbose)    # ipldhash May be None, we don't know it
+            if not ipldhash:    # None if queued to run in the background, metadata will have it next time
+                ipldhash = JobQueue.enqueue("doiipfs", self.multihash.multihash58, self._metadata["files"][0], self._metadata["mimetype"])
             self._metadata["ipldhash"] = ipldhash
             if verbose: logging.debug("sqlite_metadata done")
 
+    @staticmethod
+    def storeipfs(multihash58, url, mimetype, verbose=False):
+        """
+        Add a file's content to IPFS and remember it in IPLDHashService, run as a job by sqlite_metadata
+
+        :return: ipldhash
+        """
+        data = httpget(url)
+        #TODO move this to a URL or better to TransportIPFS when built
+        #ipfsurl = "https://ipfs.dweb.me/api/v0/add"  # note Kyle was using localhost:5001/api/v0/add which wont resolve externally.
+        ipfsurl = "http://localhost:5001/api/v0/add"  # note Kyle was using localhost:5001/api/v0/add which wont resolve externally.
+        if verbose: logging.debug("Fetching IPFS from {0}".format(ipfsurl))
+        #Debugging - running into problems with 404, not sure if laptop/HTTPS issue or server
+        #ipldresp = requests.post(ipfsurl, files={'file': ('', data, self.metadata["mimetype"])})
+        #ipldhash = ipldresp.json()['Hash']
+        res = HTTPSessions.session().post(ipfsurl, files={'file': ('', data, mimetype)}).json()
+        logging.debug("IPFS result={}".format(res))
+        ipldhash = res['Hash']
+        IPLDHashService.set(multihash58, ipldhash)
+        return ipldhash
+
     @property
     def url(self):
         """
@@ -272,7 +283,15 @@ class DOIfile(NameResolverFile):    # Note plural
 
         :return:
         """
-        return httpget(self.url)    #TODO-STREAM handle streams from URl
+        return httpget(self.url)
+
+    def content(self, _headers=None, verbose=False, **kwargs):
+        """
+        Stream content of DOI from its URL straight back to the browser
+
+        :return: { Content-type, data } where data is a stream
+        """
+        return self._streamurl(self.url, _headers=_headers, mimetype=self.mimetype)
 
     def metadata(self, headers=True, verbose=False, **kwargs):
         data = {
@@ -350,7 +369,7 @@ class DOIsearch(NameResolverSearch):
                 "fields": {"_all": {}},
             }
         url = "http://localhost:9200/crossref-works/_search"  # Might parameterise part of this, but unlikely
-        resp = requests.post(url, json=search_request)
+        resp = HTTPSessions.session().post(url, json=search_request)
         if resp.status_code != 200:
             raise SearchException(search="search_request")  # TODO-SEARCH extract useful part of search_request
         return resp.json()
@@ -380,6 +399,9 @@ class DOIsearch(NameResolverSearch):
         mimetype = 'application/json';
         return {"Content-type": mimetype, "data": data} if headers else data
 
+# Jobs that can be run in the background (see JobQueue)
+JobQueue.register("doiipfs", DOIfile.storeipfs)
+
 if __name__ == '__main__':
     import sys
     if len(sys.argv) != 2:
@@ -2,7 +2,7 @@ import logging
 from .NameResolver import NameResolverFile
 from .miscutils import loads, dumps, httpget
 from .Errors import CodingException, NoContentException, ForbiddenException
-from .HashStore import LocationService, MimetypeService
+from .HashStore import HashStore, LocationService, MimetypeService
 from .LocalResolver import LocalResolverFetch
 from .Multihash import Multihash
 from .DOI import DOIfile
@@ -45,9 +45,10 @@ class HashResolver(NameResolverFile):
             raise CodingException(message="namespace != "+self.namespace)
         super(HashResolver, self).__init__(self, namespace, hash, **kwargs)  # Note ignores the name
         self.multihash = Multihash(**{self.multihashfield: hash})
-        self.url = LocationService.get(self.multihash.multihash58, verbose)  #TODO-FUTURE recognize different types of location, currently assumes URL
+        # url: TODO-FUTURE recognize different types of location, currently assumes URL
+        # mimetype: Should be after DOIfile resolution, which will set mimetype in MimetypeService
+        self.url, self.mimetype = HashStore.get_many([(self.multihash.multihash58, LocationService), (self.multihash.multihash58, MimetypeService)], verbose)
         #logging.debug("XXX@HashResolver.__init__ setting {} .url = {}".format(self.multihash.multihash58, self.url))
-        self.mimetype = MimetypeService.get(self.multihash.multihash58, verbose)    # Should be after DOIfile resolution, which will set mimetype in MimetypeService
         self._metadata = None   # Not resolved yet
         self._doifile = None   # Not resolved yet
 
@@ -96,7 +97,7 @@ class HashResolver(NameResolverFile):
         :returns:   content - i.e. bytes
         :raise:     TransportFileNotFound, ForbiddenException, HTTPError if cant find url
         """
-        # TODO-STREAMS future work to return a stream
+        # See content() for a version that streams rather than returning it all
         if not self.url:
             raise NoContentException()
         if self.url.startswith("local:"):
@@ -132,15 +133,17 @@ class HashResolver(NameResolverFile):
         logging.info("ArchiveFile.new({},{},{}".format("archiveid", firstmatch["identifier"][0], firstmatch["name"][0]))
         return ArchiveItem.new("archiveid", firstmatch["identifier"][0], firstmatch["name"][0], verbose=True)  # Note uses ArchiveItem because need to retrieve item level metadata as well
 
-    def content(self, verbose=False, **kwargs):
+    def content(self, verbose=False, _headers=None, **kwargs):
         """
-        :returns:   content - i.e. bytes
+        :returns:   { Content-type, data } where data is a stream of the content from self.url
+        :raise:     TransportFileNotFound, ForbiddenException, HTTPError if cant find url
         """
-        data = self.retrieve()
-        if verbose: logging.debug("Retrieved doc size={}".format(len(data)))
-        return  {'Content-type': self.mimetype,
-                 'data': data,
-                }
+        if not self.url:
+            raise NoContentException()
+        if self.url.startswith("local:"):
+            raise CodingException(message="Shouldnt get here, should convert to LocalResolver in HashResolver.new: {0}".format(self.url))
+        if verbose: logging.debug("Streaming content from {}".format(self.url))
+        return self._streamurl(self.url, _headers=_headers, mimetype=self.mimetype)
 
     def metadata(self, headers=True, verbose=False, **kwargs):
         """
@@ -206,6 +209,9 @@ class HashFileEmpty(HashResolver):
         # Return a empty file
         return ''
 
+    def content(self, verbose=False, _headers=None, **kwargs):
+        return {"Content-type": self.mimetype, "data": self.retrieve(_headers=_headers)}
+
     def metadata(self, headers=None, verbose=False, **kwargs):
         mimetype = 'application/json'   # Note this is the mimetype of the response, not the mimetype of the file
         return {"Content-type": mimetype, "data": self.emptymeta } if headers else self.emptymeta
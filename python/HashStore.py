@@ -1,34 +1,73 @@
 """
 Hash Store set of classes for storage and retrieval
 """
-import redis
 import logging
+import os
+import re
+import threading
+import time
+import base58
 from .Errors import CodingException
 from .TransportIPFS import TransportIPFS
-from .miscutils import loads, dumps
+from .miscutils import loads, dumps, LRUCache
+from .config import config
+from . import HashStoreBackends
 
 class HashStore(object):
     """
     Superclass for key value storage, a shim around REDIS intended to be subclassed (see LocationService for example)
 
-    Will tie to a REDIS database initially.
+    Ties to a REDIS database, or to another backend with the same API (e.g. sqlite) see HashStoreBackends and config["hashstore"]["backend"]
 
     Class Fields:
     _redis: redis object    Redis Connection object once connection to redis once established,
+    _nearcaches: { field: LRUCache } In-process caches in front of redis, for fields in config["hashstore"]["nearcache"]["services"]
+    _subscriber: Thread listening for invalidations from other processes, if config["hashstore"]["nearcache"]["invalidate"]
 
     Fields:
     redisfield: string  name of field in redis store being used.
 
     Class methods:
-    redis()             Initiate connection to redis or return already open one.
+    redis()             Initiate connection to redis (or the configured backend) or return already open one.
+    reset()             Forget the connection and near caches, next call to redis() will open a new one.
 
     Instance methods:
-    hash_set(multihash, field, value, verbose=False)    Set Redis.multihash.field to value
+    hash_set(multihash, field, value, verbose=False, ttl=None)  Set Redis.multihash.field to value
     hash_get(multihash, field, verbose=False)           Retrieve value of Redis.multihash.field
-    set(multihash, value, verbose=False)                Set Redis.multihash.<redisfield> = value
+    set(multihash, value, verbose=False, ttl=None)      Set Redis.multihash.<redisfield> = value
     get(multihash, value, verbose=False)                Retrieve Redis.multihash.<redisfield>
 
-    Delete and Push are not supported but could be if required.
+    Batch class methods, each one round trip to redis however many keys and services
+    hash_get_many(multihash, fields, verbose=False)     Retrieve list of Redis.multihash.field for each field (HMGET)
+    get_many([(multihash, service)], verbose=False)     Retrieve list of Redis.multihash.<service.redisfield> (or field name instead of service)
+    set_many([(multihash, service, value)], get=None, verbose=False)   Set many, and optionally get_many(get) in same round trip
+
+    delete_many([(multihash, service)], verbose=False)  Delete many
+
+    For maintenance
+    scanfields(keys, fields)    Values as stored for keys from scanning redis, in one round trip
+
+    Push is not supported but could be if required.
+
+    Near cache: The values are mostly immutable (e.g. contenthash => location), so gets are served from an in-process LRUCache
+    when possible, sets write through to redis and (optionally) publish on a redis channel so other processes drop their copy.
+    Values not found are not cached, so something added by another process is seen on the next get.
+
+    Expiry: Fields with a TTL in config["hashstore"]["ttl"] (or given to set) have a companion field <field>_x holding
+    the time they expire, and are treated as not there once expired, so stale titles, magnetlinks etc age out as they
+    are next used, without maintenance scanning the whole keyspace. Fields without a TTL (e.g. location of a sha1),
+    fields set before the TTL was configured (so without <field>_x), and fields of keys starting with one of
+    config["hashstore"]["permanentprefixes"] (e.g. btih:<hash> => magnetlink, which cant be looked up again) are permanent.
+
+    DHT index: IPFS hashes in ipldhash and thumbnailipfs fields are also added to sets dht:<7th character of hash> so that
+    each round of maintenance.resetipfs(announcedht=True) can read just the hashes in its round. Hashes are not removed
+    when overwritten, re-announcing them is harmless. maintenance.builddhtindex() backfills from the existing keyspace.
+
+    Compact encoding: If config["hashstore"]["compact"]["enabled"], base58 multihash keys are stored as the raw binary
+    multihash, field names as short codes e.g. "t" for "thumbnailipfs" and common prefixes of values e.g. "ipfs:/ipfs/"
+    as a single control character. This is invisible to callers, keys from scanning redis can be turned back with multihashofkey().
+    maintenance.compact() migrates the existing keyspace (reads fall back to the old layout until then), and
+    maintenance.measurecompact() measures the saving on a sample of keys.
 
     Subclasses map
 
@@ -38,6 +77,7 @@ class HashStore(object):
     Class               StoredAt                        Maps        To
     StateService        __STATE__.<field>               field       arbitraryvalue    For global state
     StateService        __STATE__.LastDHTround          number?     Used by cron_ipfs.py to track whats up next
+    StateService        __STATE__.DHTindexBuilt         time        Set by maintenance.builddhtindex, resetipfs scans until then
     LocationService     <contenthash>.location          url         As returned by rawstore or url of content on IA
     MimetypeService     <contenthash>.mimetype          mimetype
     IPLDService         Not used currently
@@ -46,36 +86,255 @@ class HashStore(object):
     MagnetLinkService   bits:<b32hash>.magnetlink       magnetlink
     MagnetLinkService   archived:<itemid>.magnetlink    magnetlink
     TitleService        archived:<itemid>.title         title       Used to map collection item’s to their titles (cache search query)
+    ItemMetadataService metadata:<itemid>               json        Not a hash, a key that expires, see Archive.ArchiveItem.fetchmetadata
     """
 
     _redis = None   # Will be connected to a redis instance by redis()
+    expiresuffix = "_x"     # Field holding expiry time (seconds since epoch) of field for services with a TTL
+    _base58re = re.compile("^[1-9A-HJ-NP-Za-km-z]{20,}$")
     redisfield = None   # Subclasses define this, and use set & get
+    _nearcaches = None  # { field: LRUCache } built by _nearcache
+    _subscriber = None
+    _lock = threading.Lock()
 
     @classmethod
     def redis(cls):
         if not HashStore._redis:
-            logging.debug("HashStore connecting to Redis")
-            HashStore._redis = redis.StrictRedis(   # Note uses HashStore cos this connection is shared across subclasses
-                host="localhost",
-                port=6379,
-                db=0,
-                decode_responses=True
-            )
+            HashStore._redis = HashStoreBackends.backend()  # Note uses HashStore cos this connection is shared across subclasses
         return HashStore._redis
 
+    @classmethod
+    def reset(cls):
+        """
+        Drop the connection, e.g. in a newly forked process which must not share the parent's connection
+        """
+        HashStore._redis = None
+        HashStore._nearcaches = None
+        HashStore._subscriber = None
+
+    @classmethod
+    def _nearcache(cls, field):
+        """
+        :param field:   Field in redis e.g. "location"
+        :return:        LRUCache for field or None if it isnt near cached
+        """
+        if HashStore._nearcaches is None:
+            with HashStore._lock:
+                if HashStore._nearcaches is None:
+                    conf = config["hashstore"]["nearcache"]
+                    HashStore._nearcaches = {f: LRUCache(c["size"], ttl=c["ttl"]) for f, c in conf["services"].items()} if conf["enabled"] else {}
+                    if HashStore._nearcaches and conf["invalidate"] and hasattr(cls.redis(), "pubsub"):  # Not needed for single node backends
+                        cls._subscribe()
+        return HashStore._nearcaches.get(field)
+
+    @classmethod
+    def _subscribe(cls):
+        # Start a thread dropping near cached values changed by other processes, it resubscribes if the connection is lost
+        conf = config["hashstore"]["nearcache"]
+        nearcaches = HashStore._nearcaches   # Dont want thread to see a new set after reset()
+        pubsub = cls.redis().pubsub(ignore_subscribe_messages=True)    # Uses its own connection
+        pubsub.subscribe(conf["channel"])
+
+        def listen():
+            nonlocal pubsub
+            while HashStore._nearcaches is nearcaches:  # Until reset()
+                try:
+                    if pubsub is None:
+                        pubsub = cls.redis().pubsub(ignore_subscribe_messages=True)
+                        pubsub.subscribe(conf["channel"])
+                        for nearcache in nearcaches.values():   # May have missed invalidations while disconnected
+                            nearcache.clear()
+                        logging.info("HashStore resubscribed to near cache invalidations")
+                    for message in pubsub.listen():
+                        pid, multihash, field = message["data"].split("\n", 2)
+                        if pid != str(os.getpid()) and field in nearcaches:
+                            nearcaches[field].delete(multihash)
+                    raise ConnectionError("subscription ended")
+                except Exception as e:  # e.g. redis restarted, dont let near caches go stale till the process restarts
+                    logging.error("HashStore near cache invalidation failed, resubscribing in {}s: {}".format(conf["reconnectinterval"], e))
+                    try:
+                        if pubsub is not None:
+                            pubsub.close()
+                    except Exception:
+                        pass
+                    pubsub = None
+                    time.sleep(conf["reconnectinterval"])
+        HashStore._subscriber = threading.Thread(target=listen, name="HashStoreInvalidate", daemon=True)
+        HashStore._subscriber.start()
+
+    @classmethod
+    def _nearcached(cls, pipe, multihash, field, value, ttl=None):
+        # Update near cache after a set (or delete if value is None), and queue an invalidation for other processes on pipe (a pipeline or the connection)
+        nearcache = cls._nearcache(field)
+        if nearcache is not None:
+            if value is None:
+                nearcache.delete(multihash)
+            else:
+                nearcache.set(multihash, value, ttl=min(ttl, nearcache.ttl) if ttl and nearcache.ttl else ttl)
+            if config["hashstore"]["nearcache"]["invalidate"]:
+                pipe.publish(config["hashstore"]["nearcache"]["channel"], "{}\n{}\n{}".format(os.getpid(), multihash, field))
+
     def __init__(self):
         raise CodingException(message="It is meaningless to instantiate an instance of HashStore, its all class methods")
 
+    @staticmethod
+    def _binarykey(multihash):
+        """
+        :param multihash:   base58 multihash e.g. "5dqpnTaoMSJPpsHna58ZJHcrcJeAjW"
+        :return:            The raw multihash as a str that the connection (with encoding_errors="surrogateescape") sends
+                            to redis as the original bytes, or None if multihash isnt a base58 multihash e.g. "archiveid:foo"
+        """
+        if not HashStore._base58re.match(multihash):
+            return None
+        try:
+            raw = base58.b58decode(multihash)
+        except ValueError:
+            return None
+        if len(raw) < 3 or raw[1] != len(raw) - 2:  # <code><length><digest>
+            return None
+        return raw.decode('utf-8', 'surrogateescape')
+
+    @classmethod
+    def _rediskey(cls, multihash):
+        # Key as stored in redis
+        return (config["hashstore"]["compact"]["enabled"] and cls._binarykey(multihash)) or multihash
+
+    @staticmethod
+    def multihashofkey(key):
+        """
+        :param key: Key as returned by scanning redis
+        :return:    Key as used by callers of HashStore i.e. a compact binary key turned back into base58
+        """
+        if key[:1] in ("\x11", "\x12"):   # SHA1 or SHA256 multihash
+            res = base58.b58encode(key.encode('utf-8', 'surrogateescape'))
+            return res.decode('ascii') if isinstance(res, bytes) else res
+        return key
+
+    @classmethod
+    def _redisfield(cls, field):
+        # Field as stored in redis, e.g. "t" for "thumbnailipfs", "t_x" for "thumbnailipfs_x"
+        compact = config["hashstore"]["compact"]
+        if not compact["enabled"]:
+            return field
+        if field.endswith(cls.expiresuffix):
+            return compact["fields"].get(field[:-len(cls.expiresuffix)], field[:-len(cls.expiresuffix)]) + cls.expiresuffix
+        return compact["fields"].get(field, field)
+
+    @classmethod
+    def _encodevalue(cls, field, value):
+        # Strip a known prefix from value, replacing it with a control character identifying the prefix
+        compact = config["hashstore"]["compact"]
+        if compact["enabled"] and isinstance(value, str):
+            for n, prefix in enumerate(compact["prefixes"].get(field, [])):
+                if value.startswith(prefix):
+                    return chr(n + 1) + value[len(prefix):]
+        return value
+
+    @classmethod
+    def _decodevalue(cls, field, value):
+        compact = config["hashstore"]["compact"]
+        if compact["enabled"] and value and 1 <= ord(value[0]) <= len(compact["prefixes"].get(field, [])):
+            return compact["prefixes"][field][ord(value[0]) - 1] + value[1:]
+        return value
+
+    @classmethod
+    def compactencoding(cls, key, fields):
+        """
+        :param key:     Key as stored in redis
+        :param fields:  { field: value } as stored in redis e.g. from hgetall
+        :return:        (key, { field: value }) compact encoding, same as passed if already compact
+        """
+        return cls._rediskey(key), {cls._redisfield(f): cls._encodevalue(f, v) for f, v in fields.items()}
+
+    @classmethod
+    def compactkey(cls, key):
+        """
+        Migrate a hash to the compact encoding, merging with anything already written in compact form (which wins)
+
+        :param key: Key as stored in redis
+        :return:    True if anything changed
+        """
+        r = cls.redis()
+        fields = r.hgetall(key)
+        newkey, mapping = cls.compactencoding(key, fields)
+        if newkey == key and mapping == fields:
+            return False
+        pipe = r.pipeline(transaction=False)
+        for field, value in mapping.items():
+            pipe.hsetnx(newkey, field, value)
+        if newkey != key:
+            pipe.delete(key)
+        else:
+            pipe.hdel(key, *[f for f in fields if f not in mapping])
+        pipe.execute()
+        return True
+
+    @classmethod
+    def _compactfallback(cls, multihash, fields):
+        # True if should also read multihash.fields from the layout before compact encoding, as they are stored differently
+        return config["hashstore"]["compact"]["enabled"] and config["hashstore"]["compact"]["fallback"] and (
+            cls._rediskey(multihash) != multihash or any(cls._redisfield(f) != f for f in fields))
+
+    @staticmethod
+    def ipfshash(value):
+        # e.g. ipfs:/ipfs/Q123 => Q123
+        return value.replace("ipfs:/ipfs/", "")
+
+    @staticmethod
+    def dhtbucketkey(ipfshash_or_letter):
+        """
+        :param ipfshash_or_letter:  IPFS hash e.g. "Qm..." or a base58 letter (a round of DHT announces)
+        :return:                    Key of the set of IPFS hashes in the same round, which is the 7th character of the hash
+        """
+        letter = ipfshash_or_letter[6] if len(ipfshash_or_letter) > 1 else ipfshash_or_letter
+        return config["hashstore"]["dhtindex"]["prefix"] + letter
+
+    @classmethod
+    def dhtbucket(cls, letter):
+        """
+        :param letter:  base58 letter of the round
+        :return:        Iterator over IPFS hashes in the round, fetched in pages from redis
+        """
+        return cls.redis().sscan_iter(cls.dhtbucketkey(letter), count=1000)
+
+    @classmethod
+    def dhtindex(cls, ipfshashes):
+        """
+        Add IPFS hashes to the DHT round index in one round trip, set_many does this as they are set, this is for backfilling
+
+        :param ipfshashes:  IPFS hashes or urls e.g. ipfs:/ipfs/Q123
+        """
+        pipe = cls.redis().pipeline(transaction=False)
+        for ipfshash in ipfshashes:
+            ipfshash = cls.ipfshash(ipfshash)
+            pipe.sadd(cls.dhtbucketkey(ipfshash), ipfshash)
+        if len(pipe):
+            pipe.execute()
+
+    @classmethod
+    def _ttl(cls, field, ttl=None, multihash=None):
+        """
+        :param field:       Field in redis e.g. "title"
+        :param ttl:         Seconds, overrides config for this entry
+        :param multihash:   Key, if it starts with one of config["hashstore"]["permanentprefixes"] its fields dont expire
+        :return:            Seconds an entry in field is valid for, or None if it doesnt expire
+        """
+        if ttl is not None:
+            return ttl
+        if multihash and multihash.startswith(tuple(config["hashstore"]["permanentprefixes"])):
+            return None
+        return config["hashstore"]["ttl"].get(field)
+
     @classmethod
-    def hash_set(cls, multihash, field, value, verbose=False):
+    def hash_set(cls, multihash, field, value, verbose=False, ttl=None):
         """
         :param multihash:
         :param field:
         :param value:
+        :param ttl:     Seconds before it expires, overrides config["hashstore"]["ttl"]
         :return:
         """
-        if verbose: logging.debug("Hash set: {0} {1}={2}".format(multihash, field, value))
-        cls.redis().hset(multihash, field, value)
+        cls.set_many([(multihash, field, value, ttl)], verbose=verbose)
 
     @classmethod
     def hash_get(cls, multihash, field, verbose=False):
@@ -83,28 +342,206 @@ class HashStore(object):
 
         :param multihash:
         :param field:
-        :return:
+        :return: value or None if not set or expired
+        """
+        return cls.get_many([(multihash, field)], verbose=verbose)[0]
+
+    @classmethod
+    def hash_get_many(cls, multihash, fields, verbose=False):
+        """
+        :param multihash:
+        :param fields:  list of field names
+        :return:        list of values, None where not set
+        """
+        return cls.get_many([(multihash, field) for field in fields], verbose=verbose)
+
+    @staticmethod
+    def _field(service):
+        # Allow either a service e.g. LocationService or a field name e.g. "location"
+        return service if isinstance(service, str) else service.redisfield
+
+    @classmethod
+    def _queue_get_many(cls, pipe, pairs):
+        # Queue one HMGET per key on pipe for values not near cached, return function to turn the pipeline's results into values in order of pairs
+        found = {}
+        fieldsbykey = {}
+        for multihash, service in pairs:
+            field = cls._field(service)
+            nearcache = cls._nearcache(field)
+            value = nearcache.get(multihash) if nearcache is not None else None
+            if value is not None:
+                found[(multihash, field)] = value
+            else:
+                fields = fieldsbykey.setdefault(multihash, [])
+                if field not in fields:
+                    fields.append(field)
+        queries = {}    # multihash => fields with expiry timestamps of those that expire
+        legacy = []     # multihashes also read from the layout before compact encoding
+        for multihash, fields in fieldsbykey.items():
+            queries[multihash] = fields + [f + cls.expiresuffix for f in fields if cls._ttl(f, multihash=multihash)]
+            pipe.hmget(cls._rediskey(multihash), [cls._redisfield(f) for f in queries[multihash]])
+            if cls._compactfallback(multihash, fields):
+                pipe.hmget(multihash, queries[multihash])
+                legacy.append(multihash)
+
+        def results(pipelineresults):
+            now = time.time()
+            pipelineresults = iter(pipelineresults)
+            for multihash, fields in fieldsbykey.items():
+                got = {f: cls._decodevalue(f, v) for f, v in zip(queries[multihash], next(pipelineresults))}
+                if multihash in legacy:     # Values not yet migrated by maintenance.compact
+                    for f, v in zip(queries[multihash], next(pipelineresults)):
+                        if got[f] is None:
+                            got[f] = v
+                for field in fields:
+                    value = got[field]
+                    ttl = None
+                    if value is not None and cls._ttl(field, multihash=multihash):
+                        expires = got[field + cls.expiresuffix]
+                        if expires:     # Else set before the field had a ttl, which doesnt expire until it is next set
+                            ttl = float(expires) - now
+                            if ttl <= 0:
+                                value = None    # Lazy expiry, the next set will overwrite it
+                    found[(multihash, field)] = value
+                    nearcache = cls._nearcache(field)
+                    if nearcache is not None and value is not None:
+                        nearcache.set(multihash, value, ttl=min(ttl, nearcache.ttl) if ttl and nearcache.ttl else ttl)
+            return [found[(multihash, cls._field(service))] for multihash, service in pairs]
+        return results
+
+    @classmethod
+    def get_many(cls, pairs, verbose=False):
+        """
+        Get values from any services for any keys, in one round trip (or none if all near cached)
+
+        :param pairs:   list of (multihash, service) where service is a subclass e.g. LocationService, or a field name
+        :return:        list of values (None where not set or expired) in the same order as pairs
+        """
+        pipe = cls.redis().pipeline(transaction=False)
+        results = cls._queue_get_many(pipe, pairs)
+        res = results(pipe.execute() if len(pipe) else [])
+        if verbose: logging.debug("Hash found: {0}".format(["{0} {1}={2}".format(m, cls._field(s), v) for (m, s), v in zip(pairs, res)]))
+        return res
+
+    @classmethod
+    def set_many(cls, triples, get=None, verbose=False):
+        """
+        Set values in any services for any keys, in one round trip
+
+        :param triples: list of (multihash, service, value) or (multihash, service, value, ttl) where ttl in seconds overrides
+                        config["hashstore"]["ttl"], where value is None it is not set
+        :param get:     optional list of (multihash, service) to get (after the sets) in the same round trip
+        :return:        list of values from get, or None
         """
-        res = cls.redis().hget(multihash, field)
-        if verbose: logging.debug("Hash found: {0} {1}={2}".format(multihash, field, res))
+        mappings = {}
+        ttls = {}
+        now = time.time()
+        for multihash, service, value, *ttl in triples:
+            if value is not None:
+                field = cls._field(service)
+                mapping = mappings.setdefault(multihash, {})
+                mapping[field] = value
+                ttl = cls._ttl(field, ttl[0] if ttl else None, multihash=multihash)
+                if ttl:
+                    mapping[field + cls.expiresuffix] = int(now + ttl)
+                    ttls[(multihash, field)] = ttl
+        if verbose: logging.debug("Hash set: {0}".format(mappings))
+        pipe = cls.redis().pipeline(transaction=False)
+        dhtfields = config["hashstore"]["dhtindex"]["fields"] if config["hashstore"]["dhtindex"]["enabled"] else ()
+        for multihash, mapping in mappings.items():
+            pipe.hset(cls._rediskey(multihash), mapping={cls._redisfield(f): cls._encodevalue(f, v) for f, v in mapping.items()})
+            for field, value in mapping.items():
+                if not field.endswith(cls.expiresuffix):
+                    cls._nearcached(pipe, multihash, field, value, ttl=ttls.get((multihash, field)))
+                if field in dhtfields:
+                    ipfshash = cls.ipfshash(value)
+                    pipe.sadd(cls.dhtbucketkey(ipfshash), ipfshash)
+        queued = len(pipe)
+        results = cls._queue_get_many(pipe, get) if get else None
+        res = pipe.execute() if len(pipe) else []
+        return results(res[queued:]) if get else None
+
+    @classmethod
+    def delete_many(cls, pairs, verbose=False):
+        """
+        Delete values (and their expiry) from any services for any keys, in one round trip
+
+        :param pairs:   list of (multihash, service) where service is a subclass e.g. LocationService, or a field name
+        """
+        fieldsbykey = {}
+        for multihash, service in pairs:
+            fields = fieldsbykey.setdefault(multihash, [])
+            if cls._field(service) not in fields:
+                fields.append(cls._field(service))
+        if verbose: logging.debug("Hash delete: {0}".format(fieldsbykey))
+        pipe = cls.redis().pipeline(transaction=False)
+        for multihash, fields in fieldsbykey.items():
+            pipe.hdel(cls._rediskey(multihash), *[cls._redisfield(f) for f in fields + [f + cls.expiresuffix for f in fields]])
+            if cls._compactfallback(multihash, fields):     # Else would still be read from the layout before compact encoding
+                pipe.hdel(multihash, *(fields + [f + cls.expiresuffix for f in fields]))
+            for field in fields:
+                cls._nearcached(pipe, multihash, field, None)
+        if len(pipe):
+            pipe.execute()
+
+    @classmethod
+    def scanfields(cls, keys, fields):
+        """
+        Get values as stored, ignoring expiry and near cache, for maintenance, in one round trip
+
+        :param keys:    Keys as returned from scanning redis
+        :param fields:  list of field names
+        :return:        list of { field: value } in order of keys, None for keys that are not hashes (e.g. dht: sets)
+        """
+        pipe = cls.redis().pipeline(transaction=False)
+        legacy = []     # For each key, True if also read with the field names from before compact encoding
+        for key in keys:
+            pipe.hmget(key, [cls._redisfield(f) for f in fields])
+            legacy.append(cls._compactfallback(key, fields))
+            if legacy[-1]:
+                pipe.hmget(key, fields)
+        pipelineresults = iter(pipe.execute(raise_on_error=False) if len(pipe) else [])
+        res = []
+        for islegacy in legacy:
+            values = next(pipelineresults)
+            if islegacy:    # Values not yet migrated by maintenance.compact
+                legacyvalues = next(pipelineresults)
+                if not isinstance(values, Exception) and not isinstance(legacyvalues, Exception):
+                    values = [v if v is not None else l for v, l in zip(values, legacyvalues)]
+            res.append(None if isinstance(values, Exception) else {f: cls._decodevalue(f, v) for f, v in zip(fields, values)})
         return res
 
     @classmethod
-    def set(cls, multihash, value, verbose=False):
+    def dhtunindex(cls, ipfshashes):
+        """
+        Remove IPFS hashes from the DHT round index in one round trip e.g. after deleting them
+
+        :param ipfshashes:  IPFS hashes or urls e.g. ipfs:/ipfs/Q123
+        """
+        pipe = cls.redis().pipeline(transaction=False)
+        for ipfshash in ipfshashes:
+            ipfshash = cls.ipfshash(ipfshash)
+            pipe.srem(cls.dhtbucketkey(ipfshash), ipfshash)
+        if len(pipe):
+            pipe.execute()
+
+    @classmethod
+    def set(cls, multihash, value, verbose=False, ttl=None):
         """
 
         :param multihash:
         :param value:   What we want to store in the redisfield
+        :param ttl:     Seconds before it expires, overrides config["hashstore"]["ttl"]
         :return:
         """
-        return cls.hash_set(multihash, cls.redisfield, value, verbose)
+        return cls.hash_set(multihash, cls.redisfield, value, verbose, ttl=ttl)
 
     @classmethod
     def get(cls, multihash, verbose=False):
         """
 
         :param multihash:
-        :return: string stored in Redis
+        :return: string stored in Redis, or None if not there or expired
         """
         return cls.hash_get(multihash, cls.redisfield, verbose)
 
@@ -131,6 +568,7 @@ class StateService(HashStore):
 
     Field   Value   Means
     LastDHTround    ??  Used by cron_ipfs.py to record which part of hash table it last worked on
+    DHTindexBuilt   time    When maintenance.builddhtindex last finished, so the DHT index can be used
     """
 
     @classmethod
@@ -194,7 +632,32 @@ class MagnetLinkService(HashStore):
     redisfield = "magnetlink"
 
 class TitleService(HashStore):
-    # Cache collection names, they dont change often enough to worry
+    # Cache collection names, they dont change often, expire after config["hashstore"]["ttl"]["title"]
     # uses archiveidset/get
-    # TODO-REDIS note this is caching for ever, which is generally a bad idea ! Should figure out how to make Redis expire this cache every few days
     redisfield = "title"
+
+class ItemMetadataService(HashStore):
+    """
+    Shared cache of archive.org/metadata/<itemid> JSON, unlike other services each item is a key (not a hash field)
+    so that redis expires them, metadata can be large and there are many items.
+    """
+
+    @classmethod
+    def set(cls, itemid, value, ttl=None, verbose=False):
+        """
+        :param itemid:  Archive item id
+        :param value:   string to store
+        :param ttl:     Seconds before redis forgets it
+        """
+        if verbose: logging.debug("Item metadata set: {0} ({1} bytes)".format(itemid, len(value)))
+        cls.redis().set("metadata:" + itemid, value, ex=ttl)
+
+    @classmethod
+    def get(cls, itemid, verbose=False):
+        """
+        :param itemid:  Archive item id
+        :return:        string stored or None
+        """
+        res = cls.redis().get("metadata:" + itemid)
+        if verbose: logging.debug("Item metadata {0}: {1}".format("found" if res else "not found", itemid))
+        return res
@@ -0,0 +1,528 @@
+# encoding: utf-8
+"""
+Storage backends for HashStore, selected by config["hashstore"]["backend"]
+
+redis:  A redis server (the default), config["hashstore"]["redis"] has host, port, db
+sqlite: Embedded store in a sqlite file, for small gateways without redis, or ":memory:" for a fast deterministic store for tests.
+        config["hashstore"]["sqlite"]["path"] is the file.
+sharded: Keys spread over several redis nodes by a consistent hash ring, config["hashstore"]["sharded"] has
+        nodes:          list of {host, port, db}
+        vnodes:         points on the ring per node, more gives a more even spread
+        previousnodes:  nodes before the last change, or None. While set, fields not found on their new node are read from
+                        their old one, deletes go to both, and maintenance.reshard moves them. Set back to None once
+                        reshard has finished.
+
+HashStore (and the code that uses HashStore.redis() directly, such as maintenance and Singleflight) only uses a subset of
+the redis-py API, so SqliteBackend implements that subset with the same signatures and return values
+(strings, as redis-py does with decode_responses=True), and backend() returns either it or a redis.StrictRedis.
+Redis connections use encoding_errors="surrogateescape" so that binary keys (see HashStore compact encoding) round trip as str.
+
+deleteifequal(r, key, value) is the one operation outside that API, a Lua script on redis.
+
+Not supported by SqliteBackend: pubsub (so HashStore near cache invalidation is off, which is fine for a single node) and
+memory_usage.
+"""
+import logging
+import sqlite3
+import threading
+import time
+import fnmatch
+import hashlib
+import bisect
+import redis
+from .config import config
+
+
+def backend():
+    """
+    :return: new connection to the backend in config["hashstore"]["backend"]
+    """
+    name = config["hashstore"]["backend"]
+    if name == "redis":
+        logging.debug("HashStore connecting to Redis")
+        return redis.StrictRedis(decode_responses=True, encoding_errors="surrogateescape", **config["hashstore"]["redis"])
+    elif name == "sqlite":
+        logging.debug("HashStore opening sqlite {}".format(config["hashstore"]["sqlite"]["path"]))
+        return SqliteBackend(config["hashstore"]["sqlite"]["path"])
+    elif name == "sharded":
+        conf = config["hashstore"]["sharded"]
+        logging.debug("HashStore connecting to {} Redis shards".format(len(conf["nodes"])))
+        return ShardedBackend(conf["nodes"], vnodes=conf["vnodes"], previousnodes=conf["previousnodes"])
+    else:
+        raise ValueError("Unknown hashstore backend {}".format(name))
+
+
+_deleteifequalscript = 'if redis.call("get", KEYS[1]) == ARGV[1] then return redis.call("del", KEYS[1]) else return 0 end'
+
+
+def deleteifequal(r, key, value):
+    """
+    Delete string key only if it still holds value, atomically, e.g. to release a lock only if this caller still holds it
+
+    :param r:   connection from backend() e.g. HashStore.redis()
+    :return:    1 if deleted, 0 if not there or holding something else
+    """
+    if isinstance(r, (SqliteBackend, ShardedBackend)):
+        return r.deleteifequal(key, value)
+    return r.eval(_deleteifequalscript, 1, key, value)
+
+
+class SqliteBackend(object):
+    """
+    Subset of redis-py's StrictRedis API on a sqlite database
+
+    Hashes are rows of (key, field, value) in table hashes, strings are rows of (key, value, expiry) in table strings,
+    sets are rows of (key, member) in table sets, sorted sets are rows of (key, member, score) in table zsets.
+    Expired strings are ignored on read and deleted on write.
+    A single connection is shared by all threads (and serialized by a lock) since ":memory:" databases are per connection.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)   # Autocommit, pipelines use BEGIN
+        if path != ":memory:":
+            self._db.execute("PRAGMA journal_mode=WAL")     # Lets other processes e.g. maintenance read while we write
+            self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS hashes (key TEXT, field TEXT, value TEXT, PRIMARY KEY (key, field)) WITHOUT ROWID")
+        self._db.execute("CREATE TABLE IF NOT EXISTS strings (key TEXT PRIMARY KEY, value TEXT, expiry REAL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS sets (key TEXT, member TEXT, PRIMARY KEY (key, member)) WITHOUT ROWID")
+        self._db.execute("CREATE TABLE IF NOT EXISTS zsets (key TEXT, member TEXT, score REAL, PRIMARY KEY (key, member)) WITHOUT ROWID")
+        self._db.execute("CREATE INDEX IF NOT EXISTS zsetscores ON zsets (key, score)")
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    @staticmethod
+    def _str(value):
+        # redis stores everything as a string
+        return value.decode('utf-8') if isinstance(value, bytes) else str(value)
+
+    # Hashes
+    def hget(self, key, field):
+        rows = self._execute("SELECT value FROM hashes WHERE key = ? AND field = ?", (key, field))
+        return rows[0][0] if rows else None
+
+    def hmget(self, key, fields):
+        found = dict(self._execute("SELECT field, value FROM hashes WHERE key = ? AND field IN ({})".format(",".join("?" * len(fields))),
+                                   [key] + list(fields)))
+        return [found.get(f) for f in fields]
+
+    def hgetall(self, key):
+        return dict(self._execute("SELECT field, value FROM hashes WHERE key = ?", (key,)))
+
+    def hset(self, key, field=None, value=None, mapping=None):
+        items = dict(mapping or {})
+        if field is not None:
+            items[field] = value
+        with self._lock:
+            existing = self.hmget(key, list(items))
+            self._db.executemany("INSERT OR REPLACE INTO hashes (key, field, value) VALUES (?, ?, ?)",
+                                 [(key, f, self._str(v)) for f, v in items.items()])
+        return len([e for e in existing if e is None])  # Number of new fields, as redis
+
+    def hsetnx(self, key, field, value):
+        with self._lock:
+            cur = self._db.execute("INSERT OR IGNORE INTO hashes (key, field, value) VALUES (?, ?, ?)", (key, field, self._str(value)))
+        return cur.rowcount    # 1 if set, 0 if field already existed, as redis
+
+    def hdel(self, key, *fields):
+        with self._lock:
+            return self._db.execute("DELETE FROM hashes WHERE key = ? AND field IN ({})".format(",".join("?" * len(fields))),
+                                    [key] + list(fields)).rowcount
+
+    # Strings
+    def get(self, key):
+        rows = self._execute("SELECT value FROM strings WHERE key = ? AND (expiry IS NULL OR expiry > ?)", (key, time.time()))
+        return rows[0][0] if rows else None
+
+    def set(self, key, value, ex=None, px=None, nx=False):
+        expiry = time.time() + ex if ex else time.time() + px / 1000 if px else None
+        with self._lock:
+            self._db.execute("DELETE FROM strings WHERE key = ? AND expiry <= ?", (key, time.time()))
+            if nx:
+                cur = self._db.execute("INSERT OR IGNORE INTO strings (key, value, expiry) VALUES (?, ?, ?)", (key, self._str(value), expiry))
+                return True if cur.rowcount else None
+            self._db.execute("INSERT OR REPLACE INTO strings (key, value, expiry) VALUES (?, ?, ?)", (key, self._str(value), expiry))
+            return True
+
+    def deleteifequal(self, key, value):
+        # See deleteifequal()
+        with self._lock:
+            return self._db.execute("DELETE FROM strings WHERE key = ? AND value = ? AND (expiry IS NULL OR expiry > ?)",
+                                    (key, self._str(value), time.time())).rowcount
+
+    # Sets
+    def sadd(self, key, *members):
+        with self._lock:
+            return self._db.executemany("INSERT OR IGNORE INTO sets (key, member) VALUES (?, ?)", [(key, self._str(m)) for m in members]).rowcount
+
+    def srem(self, key, *members):
+        with self._lock:
+            return self._db.execute("DELETE FROM sets WHERE key = ? AND member IN ({})".format(",".join("?" * len(members))),
+                                    [key] + [self._str(m) for m in members]).rowcount
+
+    def smembers(self, key):
+        return {r[0] for r in self._execute("SELECT member FROM sets WHERE key = ?", (key,))}
+
+    def sismember(self, key, member):
+        return bool(self._execute("SELECT 1 FROM sets WHERE key = ? AND member = ?", (key, self._str(member))))
+
+    def scard(self, key):
+        return self._execute("SELECT COUNT(*) FROM sets WHERE key = ?", (key,))[0][0]
+
+    def sscan_iter(self, key, match=None, count=None):
+        last = ""
+        while True:
+            rows = self._execute("SELECT member FROM sets WHERE key = ? AND member > ? ORDER BY member LIMIT ?", (key, last, count or 1000))
+            for (member,) in rows:
+                if not match or fnmatch.fnmatchcase(member, match):
+                    yield member
+            if len(rows) < (count or 1000):
+                break
+            last = rows[-1][0]
+
+    # Sorted sets
+    def zadd(self, key, mapping):
+        with self._lock:
+            new = len([m for m in mapping if not self._db.execute("SELECT 1 FROM zsets WHERE key = ? AND member = ?", (key, self._str(m))).fetchone()])
+            self._db.executemany("INSERT OR REPLACE INTO zsets (key, member, score) VALUES (?, ?, ?)",
+                                 [(key, self._str(m), float(score)) for m, score in mapping.items()])
+        return new  # Number of new members, as redis
+
+    def zrem(self, key, *members):
+        with self._lock:
+            return self._db.execute("DELETE FROM zsets WHERE key = ? AND member IN ({})".format(",".join("?" * len(members))),
+                                    [key] + [self._str(m) for m in members]).rowcount
+
+    def zrangebyscore(self, key, min, max, start=None, num=None):
+        # min and max are numbers or "-inf"/"+inf", as redis-py
+        return [r[0] for r in self._execute("SELECT member FROM zsets WHERE key = ? AND score >= ? AND score <= ? ORDER BY score, member LIMIT ? OFFSET ?",
+                                            (key, float(min), float(max), -1 if num is None else num, start or 0))]
+
+    def zcard(self, key):
+        return self._execute("SELECT COUNT(*) FROM zsets WHERE key = ?", (key,))[0][0]
+
+    # Keys
+    def type(self, key):
+        for keytype, table in (("hash", "hashes"), ("string", "strings"), ("set", "sets"), ("zset", "zsets")):
+            if self._execute("SELECT 1 FROM {} WHERE key = ? LIMIT 1".format(table), (key,)):
+                return keytype
+        return "none"
+
+    def delete(self, *keys):
+        marks = ",".join("?" * len(keys))
+        with self._lock:
+            hashes = self._db.execute("SELECT COUNT(DISTINCT key) FROM hashes WHERE key IN ({})".format(marks), keys).fetchone()[0]
+            self._db.execute("DELETE FROM hashes WHERE key IN ({})".format(marks), keys)
+            strings = self._db.execute("DELETE FROM strings WHERE key IN ({}) AND (expiry IS NULL OR expiry > ?)".format(marks),
+                                       list(keys) + [time.time()]).rowcount
+            self._db.execute("DELETE FROM strings WHERE key IN ({})".format(marks), keys)
+            sets = self._db.execute("SELECT COUNT(DISTINCT key) FROM sets WHERE key IN ({})".format(marks), keys).fetchone()[0]
+            self._db.execute("DELETE FROM sets WHERE key IN ({})".format(marks), keys)
+            zsets = self._db.execute("SELECT COUNT(DISTINCT key) FROM zsets WHERE key IN ({})".format(marks), keys).fetchone()[0]
+            self._db.execute("DELETE FROM zsets WHERE key IN ({})".format(marks), keys)
+        return hashes + strings + sets + zsets
+
+    def scan(self, cursor=0, match=None, count=None):
+        """
+        Like redis SCAN, 0 when finished. The cursor encodes the last key returned, so keys deleted during a scan dont
+        cause others to be skipped. Keys added during a scan may or may not be returned, as with redis.
+        """
+        count = count or 10
+        last = int(cursor).to_bytes((int(cursor).bit_length() + 7) // 8, 'big')[1:].decode('utf-8', 'surrogateescape') if cursor else ""
+        rows = self._execute("SELECT key FROM (SELECT DISTINCT key FROM hashes UNION SELECT key FROM strings UNION SELECT DISTINCT key FROM sets "
+                             "UNION SELECT DISTINCT key FROM zsets) "
+                             "WHERE key > ? ORDER BY key LIMIT ?", (last, count))
+        keys = [r[0] for r in rows]
+        if len(rows) < count:
+            cursor = 0
+        else:   # b"\x01" so that cursor is never 0
+            cursor = int.from_bytes(b"\x01" + keys[-1].encode('utf-8', 'surrogateescape'), 'big')
+        if match:
+            keys = [k for k in keys if fnmatch.fnmatchcase(k, match)]
+        return cursor, keys
+
+    def scan_iter(self, match=None, count=None):
+        cursor = 0
+        while True:
+            cursor, keys = self.scan(cursor, match=match, count=count or 1000)
+            yield from keys
+            if not cursor:
+                break
+
+    def publish(self, channel, message):
+        return 0    # No subscribers, there is only this process
+
+    def pipeline(self, transaction=True):
+        return SqlitePipeline(self)
+
+
+class SqlitePipeline(object):
+    """
+    Queues commands like a redis-py pipeline, execute() runs them in one sqlite transaction and returns a list of results
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._commands = []
+
+    def __len__(self):
+        return len(self._commands)
+
+    def __getattr__(self, name):
+        func = getattr(self.backend, name)  # AttributeError if not supported by backend
+
+        def queue(*args, **kwargs):
+            self._commands.append((func, args, kwargs))
+            return self
+        return queue
+
+    def execute(self, raise_on_error=True):
+        # raise_on_error is for compatibility, sqlite has no per command errors such as redis's WRONGTYPE
+        commands, self._commands = self._commands, []
+        with self.backend._lock:
+            self.backend._db.execute("BEGIN")
+            try:
+                res = [func(*args, **kwargs) for func, args, kwargs in commands]
+            except Exception:
+                self.backend._db.execute("ROLLBACK")
+                raise
+            self.backend._db.execute("COMMIT")
+        return res
+
+
+class HashRing(object):
+    """
+    Consistent hash ring, adding a node to N moves about 1/(N+1) of the keys, all of them to the new node.
+
+    Fields:
+    names:  names of the nodes e.g. "localhost:6379/0", each is hashed to vnodes points on the ring
+    """
+
+    def __init__(self, names, vnodes):
+        self.names = names
+        ring = sorted((self._hash("{}#{}".format(name, i)), n) for n, name in enumerate(names) for i in range(vnodes))
+        self._points = [point for point, _ in ring]
+        self._owners = [n for _, n in ring]
+
+    @staticmethod
+    def _hash(key):
+        if isinstance(key, str):
+            key = key.encode('utf-8', 'surrogateescape')
+        return int.from_bytes(hashlib.md5(key).digest()[:8], 'big')
+
+    def node(self, key):
+        """
+        :return: index into names of the node holding key
+        """
+        return self._owners[bisect.bisect(self._points, self._hash(key)) % len(self._points)]
+
+
+class ShardedBackend(object):
+    """
+    Subset of redis-py's StrictRedis API spread over several redis nodes with a HashRing
+
+    Commands on a single key go to its node. Pipelines are split into one pipeline per node, so a batch of reads
+    costs one round trip per node touched rather than one per key. Scan goes through the nodes in turn.
+    publish and pubsub use the first node, so all processes see the same channel.
+    """
+    readcommands = ("hget", "hmget", "hgetall", "get", "exists", "type", "smembers", "sismember", "scard", "zrangebyscore", "zcard")
+    keycommands = readcommands + ("hset", "hsetnx", "hdel", "set", "expire", "pexpire", "ttl", "pttl", "sadd", "srem",
+                                  "sscan_iter", "memory_usage", "zadd", "zrem")
+    removecommands = ("hdel", "srem", "zrem")    # Also sent to the previous node, like delete
+
+    def __init__(self, nodes, vnodes=160, previousnodes=None):
+        self.names = [self._name(n) for n in nodes]
+        self.connections = [redis.StrictRedis(decode_responses=True, encoding_errors="surrogateescape", **n) for n in nodes]
+        self.ring = HashRing(self.names, vnodes)
+        self.previousring = None
+        if previousnodes:
+            self.previousring = HashRing([self._name(n) for n in previousnodes], vnodes)
+            self.previousconnections = [self.connections[self.names.index(self._name(n))] if self._name(n) in self.names
+                                        else redis.StrictRedis(decode_responses=True, encoding_errors="surrogateescape", **n) for n in previousnodes]
+
+    @staticmethod
+    def _name(node):
+        return "{}:{}/{}".format(node["host"], node["port"], node.get("db", 0))
+
+    def connection(self, key):
+        return self.connections[self.ring.node(key)]
+
+    def previousconnection(self, key):
+        """
+        :return: Connection to the node key was on before the last change of nodes, or None if it hasnt moved
+        """
+        if not self.previousring:
+            return None
+        previous = self.previousconnections[self.previousring.node(key)]
+        return None if previous is self.connection(key) else previous
+
+    @staticmethod
+    def _incomplete(name, res):
+        """
+        :return: True if some of the result of read command name may still be on the key's previous node
+        """
+        if name in ("hgetall", "smembers"):
+            return True     # A key part way through resharding can be split between nodes
+        return not res or (isinstance(res, list) and any(r is None for r in res))
+
+    @staticmethod
+    def _merge(name, res, previous):
+        """
+        Combine the result of read command name from the key's node with that from its previous node, current values win
+        """
+        if name == "hmget":
+            return [r if r is not None else p for r, p in zip(res, previous)]
+        if name == "hgetall":
+            return {**previous, **res}
+        if name == "smembers":
+            return set(previous) | set(res)
+        return previous
+
+    def __getattr__(self, name):
+        if name not in self.keycommands:
+            raise AttributeError(name)
+
+        def command(key, *args, **kwargs):
+            res = getattr(self.connection(key), name)(key, *args, **kwargs)
+            if name in self.readcommands and self._incomplete(name, res):
+                previous = self.previousconnection(key)
+                if previous:    # Not moved yet by reshard
+                    res = self._merge(name, res, getattr(previous, name)(key, *args, **kwargs))
+            elif name in self.removecommands:
+                previous = self.previousconnection(key)
+                if previous:    # Else would be found again via previousconnection, or put back by migrate
+                    res += getattr(previous, name)(key, *args, **kwargs)
+            return res
+        return command
+
+    def delete(self, *keys):
+        deleted = 0
+        for key in keys:
+            deleted += self.connection(key).delete(key)
+            previous = self.previousconnection(key)
+            if previous:    # Else would be found again via previousconnection
+                deleted += previous.delete(key)
+        return deleted
+
+    def deleteifequal(self, key, value):
+        # See deleteifequal(), locks are only taken on the key's current node
+        return deleteifequal(self.connection(key), key, value)
+
+    def publish(self, channel, message):
+        return self.connections[0].publish(channel, message)
+
+    def pubsub(self, **kwargs):
+        return self.connections[0].pubsub(**kwargs)
+
+    def scan(self, cursor=0, match=None, count=None):
+        """
+        Scan each node in turn, the cursor combines the node and that node's cursor, 0 when all nodes finished
+        """
+        n = len(self.connections)
+        node = cursor % n
+        nodecursor, keys = self.connections[node].scan(cursor // n, match=match, count=count)
+        if nodecursor:
+            return nodecursor * n + node, keys
+        return (node + 1 if node + 1 < n else 0), keys
+
+    def scan_iter(self, match=None, count=None):
+        for connection in self.connections:
+            yield from connection.scan_iter(match=match, count=count)
+
+    def pipeline(self, transaction=True):
+        return ShardedPipeline(self)
+
+    def migrate(self, key, source):
+        """
+        Move key from source (a previous node) to its current node, merging with anything written there since, without overwriting it.
+
+        :return: True if moved, False if it belongs on source
+        """
+        target = self.connection(key)
+        if target is source:
+            return False
+        keytype = source.type(key)
+        if keytype == "hash":
+            pipe = target.pipeline(transaction=False)
+            for field, value in source.hgetall(key).items():
+                pipe.hsetnx(key, field, value)
+            pipe.execute()
+        elif keytype == "string":
+            value = source.get(key)
+            pttl = source.pttl(key)
+            if value is not None:
+                target.set(key, value, px=pttl if pttl > 0 else None, nx=True)
+        elif keytype == "set":
+            members = source.smembers(key)
+            if members:
+                target.sadd(key, *members)
+        elif keytype == "zset":
+            members = source.zrangebyscore(key, "-inf", "+inf", withscores=True)
+            if members:
+                target.zadd(key, dict(members), nx=True)
+        elif keytype != "none":
+            logging.warning("Not resharding {} of type {}".format(key, keytype))
+            return False
+        source.delete(key)
+        return True
+
+
+class ShardedPipeline(object):
+    """
+    Queues commands like a redis-py pipeline, execute() sends one pipeline to each node involved
+    and returns the results in the order the commands were queued.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._commands = []     # (name, key, args, kwargs)
+
+    def __len__(self):
+        return len(self._commands)
+
+    def __getattr__(self, name):
+        if name not in ShardedBackend.keycommands and name not in ("delete", "publish"):
+            raise AttributeError(name)
+
+        def queue(key, *args, **kwargs):
+            self._commands.append((name, key, args, kwargs))
+            return self
+        return queue
+
+    def _execute(self, commands, connectionof, raise_on_error=True):
+        # Run commands in one pipeline per connection, return results in order of commands
+        pipes = {}
+        slots = []
+        for name, key, args, kwargs in commands:
+            connection = connectionof(name, key)
+            pipe, queued = pipes.setdefault(id(connection), (connection.pipeline(transaction=False), []))
+            slots.append((id(connection), len(queued)))
+            queued.append(getattr(pipe, name)(key, *args, **kwargs))
+        results = {k: pipe.execute(raise_on_error=raise_on_error) for k, (pipe, _) in pipes.items()}
+        return [results[k][i] for k, i in slots]
+
+    def execute(self, raise_on_error=True):
+        commands, self._commands = self._commands, []
+        backend = self.backend
+        res = self._execute(commands, lambda name, key: backend.connections[0] if name == "publish" else backend.connection(key),
+                            raise_on_error=raise_on_error)
+        if backend.previousring:
+            # Read anything not found from where it was before resharding, and remove from there too
+            retry = [i for i, (name, key, args, kwargs) in enumerate(commands) if backend.previousconnection(key) and (
+                        (name in ShardedBackend.readcommands and backend._incomplete(name, res[i]))
+                        or name in ShardedBackend.removecommands or name == "delete")]
+            if retry:
+                retried = self._execute([commands[i] for i in retry], lambda name, key: backend.previousconnection(key),
+                                        raise_on_error=raise_on_error)
+                for i, r in zip(retry, retried):
+                    name = commands[i][0]
+                    if isinstance(r, Exception) or isinstance(res[i], Exception):
+                        continue    # Only when not raise_on_error, keep what the current node returned
+                    if name in ShardedBackend.readcommands:
+                        res[i] = backend._merge(name, res[i], r)
+                    else:
+                        res[i] += r
+        return res
@@ -0,0 +1,227 @@
+# encoding: utf-8
+"""
+Background jobs, so that slow side-effects of a request (e.g. storing a thumbnail to IPFS, pinging the ipfs.io gateway)
+dont delay the response. The request answers with what it has (typically the HTTP urls), and the IPFS links are
+there for later requests once the job completes.
+
+Jobs are a name and a list of JSON-able arguments, the name is registered with the function that does it, e.g.
+    JobQueue.register("pinggateway", lambda ipldhash: TransportIPFS().pinggateway(ipldhash))
+    JobQueue.enqueue("pinggateway", ipldhash)
+The function must be registered in a module the worker imports, and should be safe to run twice.
+
+The queue is a hash in the HashStore backend (so it is durable, and works with any of the backends) of job id => job,
+where the id is a hash of the name and args, so that e.g. many requests for the same item only queue one thumbnail job.
+A sorted set of job id scored by the time it is due indexes the hash, so a worker reads only the jobs that are due
+(ZRANGEBYSCORE) rather than the whole queue, which would cost most when the queue is longest.
+A worker takes a job by setting a lease key (SET NX with expiry), so if a worker dies its jobs are picked up by another
+once the lease expires. A job that raises is retried with exponential backoff up to a limit.
+
+Parameters come from config["jobs"]
+enabled:        If False enqueue runs the job immediately and returns its result, as the code did before there was a queue
+workers:        Threads running jobs in each gateway process, can be 0 if jobs are run by jobworker.py instead
+workerprocessthreads: Threads running jobs in jobworker.py
+attempts:       Times a job is tried before giving up
+backoff:        Seconds before the first retry, doubled for each retry after that
+lease:          Seconds a worker holds a job for at most, should be longer than any job takes
+pollinterval:   Seconds an idle worker waits before looking for jobs again
+batch:          Due jobs a worker reads each time it looks
+"""
+import logging
+import hashlib
+import os
+import random
+import socket
+import threading
+import time
+from .config import config
+from .miscutils import loads, dumps
+from .HashStoreBackends import deleteifequal
+
+
+class JobQueue(object):
+    """
+    Class Fields:
+    _jobs:      { name: function } registered by register()
+    _workers:   Threads started by startworkers()
+    _stop:      Event set to stop the workers
+
+    Class methods:
+    enabled()               True if jobs run in the background
+    register(name, func)    Register func to run jobs called name, can be used as a decorator
+    enqueue(name, *args)    Queue a job, or run it if not enabled
+    runpending()            Run any jobs that are due, return how many were run
+    startworkers(n)         Start n threads running jobs
+    run(n)                  Run jobs with n threads until interrupted, e.g. in jobworker.py
+    """
+    queuekey = "jobs:queue"
+    duekey = "jobs:due"
+    leaseprefix = "jobs:lease:"
+    _jobs = {}
+    _workers = []
+    _stop = threading.Event()
+
+    @classmethod
+    def redis(cls):
+        from .HashStore import HashStore   # Not at top, HashStore imports TransportIPFS which imports this
+        return HashStore.redis()
+
+    @classmethod
+    def enabled(cls):
+        return config["jobs"]["enabled"]
+
+    @classmethod
+    def register(cls, name, func=None):
+        if func is None:
+            return lambda f: cls.register(name, f) or f
+        cls._jobs[name] = func
+
+    @classmethod
+    def jobid(cls, name, args):
+        return hashlib.sha1(dumps([name, list(args)]).encode('utf-8')).hexdigest()
+
+    @classmethod
+    def enqueue(cls, name, *args):
+        """
+        Queue a job to run in the background
+
+        :param name:    as registered
+        :param args:    arguments to the job, must be JSON-able
+        :return:        result of the job if it was run (config["jobs"]["enabled"] is False) or None if queued
+        :raises:        whatever the job raises if it was run
+        """
+        if not cls.enabled():
+            return cls._jobs[name](*args)
+        jobid = cls.jobid(name, args)
+        r = cls.redis()
+        if r.hsetnx(cls.queuekey, jobid, dumps({"name": name, "args": list(args), "attempts": 0, "due": 0})):
+            r.zadd(cls.duekey, {jobid: 0})
+            logging.debug("Queued job {} {}".format(name, args))
+        return None
+
+    @classmethod
+    def runpending(cls):
+        """
+        Run the jobs that are due and not taken by another worker
+
+        :return: number of jobs run (whether or not they succeeded)
+        """
+        r = cls.redis()
+        lease = int(config["jobs"]["lease"] * 1000)
+        workerid = "{}:{}:{}".format(socket.gethostname(), os.getpid(), threading.get_ident())
+        jobids = r.zrangebyscore(cls.duekey, "-inf", time.time(), start=0, num=config["jobs"]["batch"])
+        random.shuffle(jobids)    # So workers dont all contend for the same job
+        ran = 0
+        for jobid in jobids:
+            if cls._stop.is_set():
+                break
+            if not r.set(cls.leaseprefix + jobid, workerid, nx=True, px=lease):
+                continue    # Another worker has it
+            try:
+                value = r.hget(cls.queuekey, jobid)  # Reread, another worker may have run it since zrangebyscore
+                if value is None:   # Finished, but not removed from the index e.g. the worker died
+                    r.zrem(cls.duekey, jobid)
+                elif loads(value)["due"] <= time.time():    # Else failed since and waiting to retry
+                    cls._run(r, jobid, loads(value))
+                    ran += 1
+            finally:
+                deleteifequal(r, cls.leaseprefix + jobid, workerid)    # Unless it expired and another worker has it
+        return ran
+
+    @classmethod
+    def _run(cls, r, jobid, job):
+        conf = config["jobs"]
+        func = cls._jobs.get(job["name"])
+        if not func:
+            logging.error("No job registered called {}, dropping {}".format(job["name"], job))
+            cls._remove(r, jobid)
+            return
+        try:
+            func(*job["args"])
+            cls._remove(r, jobid)
+            logging.debug("Job {} {} done".format(job["name"], job["args"]))
+        except Exception as e:
+            job["attempts"] += 1
+            if job["attempts"] >= conf["attempts"]:
+                logging.error("Job {} {} failed {} times, giving up: {}".format(job["name"], job["args"], job["attempts"], e))
+                cls._remove(r, jobid)
+            else:
+                job["due"] = time.time() + conf["backoff"] * 2 ** (job["attempts"] - 1)
+                logging.warning("Job {} {} failed, will retry: {}".format(job["name"], job["args"], e))
+                r.hset(cls.queuekey, jobid, dumps(job))
+                r.zadd(cls.duekey, {jobid: job["due"]})
+
+    @classmethod
+    def _remove(cls, r, jobid):
+        # Job out of the queue, then out of the index, so if interrupted runpending finds it isnt there and tidies up
+        r.hdel(cls.queuekey, jobid)
+        r.zrem(cls.duekey, jobid)
+
+    @classmethod
+    def work(cls):
+        """
+        Run jobs until stopworkers() is called
+        """
+        while not cls._stop.is_set():
+            try:
+                ran = cls.runpending()
+            except Exception as e:  # e.g. redis restarting, dont let the worker die
+                logging.error("Job worker failed: {}".format(e))
+                ran = 0
+            if not ran:
+                cls._stop.wait(config["jobs"]["pollinterval"])
+
+    @classmethod
+    def startworkers(cls, n=None):
+        """
+        Start threads running jobs, if config["jobs"]["enabled"]
+
+        :param n:   number of threads, default config["jobs"]["workers"]
+        """
+        if not cls.enabled():
+            return
+        n = config["jobs"]["workers"] if n is None else n
+        cls._stop.clear()
+        for i in range(n):
+            t = threading.Thread(target=cls.work, name="jobworker{}".format(i), daemon=True)
+            t.start()
+            cls._workers.append(t)
+        if n: logging.info("Started {} job workers".format(n))
+
+    @classmethod
+    def run(cls, n=None):
+        """
+        Run jobs in this process until interrupted (e.g. by Ctrl-C), for a worker process separate from the gateway
+
+        :param n:   number of threads, default config["jobs"]["workerprocessthreads"]
+        """
+        if not cls.enabled():
+            logging.error("JobQueue not enabled in config jobs.enabled")
+            return
+        n = config["jobs"]["workerprocessthreads"] if n is None else n
+        if n < 1:
+            logging.error("JobQueue.run needs at least one thread, not {}".format(n))
+            return
+        cls.startworkers(n)
+        try:
+            while not cls._stop.wait(1):
+                pass
+        except KeyboardInterrupt:
+            cls.stopworkers()
+
+    @classmethod
+    def stopworkers(cls):
+        """
+        Stop the workers, waiting for their current jobs to finish
+        """
+        cls._stop.set()
+        for t in cls._workers:
+            t.join()
+        cls._workers = []
+
+    @classmethod
+    def reset(cls):
+        """
+        Forget the workers, e.g. in a newly forked process where their threads dont exist
+        """
+        cls._workers = []
+        cls._stop = threading.Event()
@@ -138,6 +138,19 @@ class Multihash(object):
         self.assertions(self.SHA1)
         return binascii.hexlify(self.digest).decode('utf-8')  # The decode is turn bytes b'a1b2' to str 'a1b2'
 
+    @staticmethod
+    def multihash58fromsha1hex(sha1hex):
+        """
+        Same as Multihash(sha1hex=sha1hex).multihash58 without creating a Multihash, for converting many e.g. all files of an item
+
+        :raises: ValueError if not hex
+        """
+        digest = bytes.fromhex(sha1hex)
+        if len(digest) != Multihash.LENGTHS[Multihash.SHA1]:
+            raise MultihashError(message="Invalid lengths: expect {}, len {}".format(Multihash.LENGTHS[Multihash.SHA1], len(digest)))
+        foo = base58.b58encode(bytes([Multihash.SHA1, len(digest)]) + digest)
+        return foo.decode('ascii') if isinstance(foo, bytes) else foo
+
     @property
     def multihash58(self):
         foo = base58.b58encode(bytes(self._multihash_binary)) # Documentation says returns bytes, Mac returns string, want string
@@ -3,10 +3,11 @@ import requests
 from urllib.parse import urlparse
 from .Errors import ToBeImplementedException, NoContentException, IPFSException
 from .Multihash import Multihash
-from .HashStore import LocationService, MimetypeService, IPLDHashService
+from .HashStore import HashStore, LocationService, MimetypeService, IPLDHashService
 from .config import config
-from .miscutils import httpget
+from .miscutils import httpget, httpgetstream
 from .TransportIPFS import TransportIPFS
+from .JobQueue import JobQueue
 
 
 
@@ -21,7 +22,7 @@ class NameResolver(object):
     and may have default code for some of them based on assumptions about the data structure of subclasses.
 
     Each subclass of NameResolver must support:
-    content()   Generate an output to return to a browser. (Can be a dict, array or string, later will add Streams) (?? Not sure if should implement content for dirs)
+    content()   Generate an output to return to a browser. (Can be a dict, array, string or a stream e.g. from _streamurl) (?? Not sure if should implement content for dirs)
 
     Each subclass of NameResolver can provide, but can also use default:
     contenthash()   The hash of the content
@@ -72,6 +73,23 @@ class NameResolver(object):
         """
         return {"Content-type": self.mimetype, "data": self.retrieve(_headers=_headers)}
 
+    def _streamurl(self, url, _headers=None, mimetype=None):
+        """
+        Return a url's content as a stream to pass straight back to the browser, so first byte goes out as soon as it arrives from upstream.
+        Passes on the range header and returns the upstream status (e.g. 206) and headers like Content-Range
+
+        :param url:         URL to retrieve, typically on archive.org
+        :param _headers:    Headers from the browser, especially "range"
+        :param mimetype:    Mimetype to return, if not set then use upstream's
+        :return:            { Content-type, Content-Length, status, headers, data: iterator of bytes } suitable for ServerBase._dispatch
+        :raises:            TransportURLNotFound, ForbiddenException, HTTPError if cant get url
+        """
+        status, headers, chunks = httpgetstream(url, range=(_headers or {}).get("range"))
+        upstreammimetype = headers.pop("Content-Type", None)
+        contentlength = headers.pop("Content-Length", None)
+        return {"Content-type": mimetype or upstreammimetype or "application/octet-stream",
+                "Content-Length": contentlength, "status": status, "headers": headers, "data": chunks}
+
     def metadata(self, verbose=False, **kwargs):
         """
 
@@ -185,19 +203,34 @@ class NameResolverFile(NameResolver):
         forceurlstore && url => urlstore
         forceurlstore && !url => error
         forceadd && data => add
-        forceadd && !data && url => fetch data then add
+        forceadd && !data && url => fetch data then add, streamed through without buffering if config["ipfs"]["streamadd"]
         url && data && !forceurl && !forcedata => default to urlstore (ignore data)
         """
         if not config["ipfs"].get("url_urlstore"):  # If not running on machine with urlstore
             forceadd = True
-        if url and forceadd:  # To "add" from an URL we need to retrieve and then urlstore
+        stream = url and forceadd and not data and config["ipfs"].get("streamadd")  # Fetch and add in one pass, without holding the file in memory
+        if url and forceadd and not stream:  # To "add" from an URL we need to retrieve and then urlstore
             (data, self.mimetype) = httpget(url, wantmime=True)
             if not self.multihash:  # Since we've got the data, we can compute SHA1 from it
                 if verbose: logging.debug("Computing SHA1 hash of url {}".format(url))
                 self.multihash = Multihash(data=data, code=Multihash.SHA1)
             # Since we retrieved mimetype we can save it, since not set in metadata
             MimetypeService.set(self.multihash.multihash58, self.mimetype, verbose=verbose)
-        if (url and not forceadd):
+        if stream:
+            did = "add"
+            stored = TransportIPFS().storeurlstream(url, pinggateway=False, verbose=verbose)  # Can throw IPFSExeption
+            ipldurl = stored["url"]
+            self.mimetype = stored["mimetype"]
+            if self.multihash and self.multihash.sha1hex != stored["sha1hex"]:
+                # Record what was added under its own SHA1, so a contenthash lookup never gets different bytes
+                logging.warning("SHA1 mismatch on {} expected {} got {}".format(url, self.multihash.sha1hex, stored["sha1hex"]))
+                self.multihash = None
+            if not self.multihash:  # Since we've seen the data, we have its SHA1
+                self.multihash = Multihash(sha1hex=stored["sha1hex"])
+            MimetypeService.set(self.multihash.multihash58, self.mimetype, verbose=verbose)
+            if size and (stored["size"] != size):
+                size = "{}!={}".format(size, stored["size"])
+        elif (url and not forceadd):
             did = "urlstore"
             ipldurl = TransportIPFS().store(urlfrom=url, pinggateway=False, verbose=verbose)  # Can throw IPFSExeption
         elif data:  # Either provided or fetched from URL
@@ -209,7 +242,7 @@ class NameResolverFile(NameResolver):
         # Each of the successful routes through above leaves us with ipldurl
         ipldhash = urlparse(ipldurl).path.split('/')[2]
         if announcedht:
-            TransportIPFS().announcedht(ipldhash)  # Let DHT know - dont wait for up to 10 hours for next cycle
+            JobQueue.enqueue("announcedht", ipldhash)  # Let DHT know - dont wait for up to 10 hours for next cycle
         IPLDHashService.set(self.multihash.multihash58, ipldhash)
         #("URL", "Add/Urlstore", "Hash", "Size", "Announced")
         if size and data and (len(data) != size):
@@ -231,10 +264,11 @@ class NameResolverFile(NameResolver):
         :param verbose:
         :return:
         """
-        ipldhash = self.multihash and IPLDHashService.get(self.multihash.multihash58)    # May be None, we don't know it
+        ipldhash = None     # May stay None, we don't know it
+        if self.multihash:
+            ipldhash, mimetype = HashStore.get_many([(self.multihash.multihash58, IPLDHashService), (self.multihash.multihash58, MimetypeService)], verbose=verbose)
         if ipldhash:
-            self.mimetype = MimetypeService.get(self.multihash.multihash58, verbose=verbose)
-            ipldhash = IPLDHashService.get(self.multihash.multihash58, verbose=verbose)
+            self.mimetype = mimetype
         else:
             if wantipfs:
                 #TODO could check sha1 here, but would be slow
@@ -0,0 +1,405 @@
+# encoding: utf-8
+"""
+asyncio engine for serving a MyHTTPRequestHandler subclass (e.g. DwebGatewayHTTPRequestHandler)
+
+Connections are held by the event loop, so idle keep-alive connections (e.g. webseeds, range requests from video players)
+cost a coroutine rather than a thread. Each request is then run through the handler's normal do_GET/do_POST > _dispatch
+code in a bounded executor, so the same @exposed methods and namespaceclasses are used as with the threaded servers.
+
+Upstream streams (miscutils.httpgetstream e.g. NameResolver._streamurl) are fetched by AsyncUpstream on the event loop,
+the handler's thread is only held until the upstream headers arrive, and the body is then relayed from upstream to the
+client by the loop, so a long download holds no thread however slow either end is.
+Other streamed responses (e.g. files, or content from IPFS) are pulled a chunk at a time from the executor and written by
+the event loop, so a thread is only held while a chunk is being fetched, not while a slow client drains it.
+Redis and IPFS calls made by the handlers are still blocking, and are made from the executor.
+
+Like ServerBase, this file is intended to be Application independent.
+
+Parameters come from config["httpserver"]
+asyncworkers:       Size of the executor running handlers and fetching chunks of non-upstream streams
+idletimeout:        Seconds an idle keep-alive connection is kept open
+chunksize:          Largest read from upstream
+upstreamtimeout:    Seconds to wait for upstream to connect, send its headers, or send more of its body
+
+shutdown() stops accepting and lets in-flight requests finish, it is used by ServerBase.PreforkMaster workers on SIGTERM.
+"""
+import asyncio
+import logging
+import ssl
+from io import BytesIO
+from http.client import parse_headers
+from urllib.parse import urlsplit, urljoin
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from .config import config
+from . import miscutils
+
+
+class AsyncChunks(object):
+    """
+    Body of an upstream response from AsyncUpstream.
+
+    An async iterator for the event loop (as used by AsyncHTTPServer._pumpstream), or an ordinary iterator for code running
+    in a thread (e.g. TransportIPFS.storestream), each chunk then being read by the loop.
+    close() or aclose() release the upstream connection, including when the consumer gives up part way.
+    """
+
+    def __init__(self, loop, body):
+        self.loop = loop
+        self.body = body    # async generator of bytes
+
+    def __aiter__(self):
+        return self.body
+
+    def __iter__(self):
+        while True:
+            try:
+                chunk = asyncio.run_coroutine_threadsafe(self.body.__anext__(), self.loop).result()
+            except StopAsyncIteration:
+                return
+            yield chunk
+
+    async def aclose(self):
+        await self.body.aclose()
+
+    def close(self):
+        """
+        Close from a thread other than the event loop's, from the loop use aclose()
+        """
+        asyncio.run_coroutine_threadsafe(self.aclose(), self.loop).result()
+
+
+class AsyncUpstream(object):
+    """
+    Minimal HTTP/1.1 GET client running on the event loop, used for streams via miscutils.httpgetstream.
+    Follows redirects (archive.org download urls redirect to the server holding the file), and reads bodies delimited by
+    Content-Length, chunked Transfer-Encoding, or the connection closing. Each stream has its own connection.
+    """
+    maxredirects = 10       # Same limit as requests
+    maxheaders = 100        # Same limit as http.client
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.timeout = config["httpserver"]["upstreamtimeout"]
+        self.chunksize = config["httpserver"]["chunksize"]
+        self.sslcontext = ssl.create_default_context()
+
+    def fetch(self, url, headers):
+        """
+        Called from a handler's thread (see miscutils.httpgetstream_local), returns once the upstream headers have arrived
+
+        :param url:     URL to GET
+        :param headers: dict of headers to send
+        :return:        (status, headers, AsyncChunks) headers is a http.client.HTTPMessage
+        :raises:        requests.exceptions.ConnectionError if cant connect, or upstream fails before sending its headers
+        """
+        try:
+            return asyncio.run_coroutine_threadsafe(self._open(url, headers), self.loop).result()
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError) as e:
+            raise requests.exceptions.ConnectionError("Upstream {} failed: {}".format(url, e)) from e
+
+    async def _open(self, url, headers):
+        for _ in range(self.maxredirects + 1):
+            parts = urlsplit(url)
+            secure = parts.scheme == "https"
+            if parts.scheme not in ("http", "https"):
+                raise ValueError("Unsupported scheme {}".format(parts.scheme))
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(parts.hostname, parts.port or (443 if secure else 80),
+                                        ssl=self.sslcontext if secure else None), self.timeout)
+            try:
+                path = (parts.path or "/") + ("?" + parts.query if parts.query else "")
+                request = "GET {} HTTP/1.1\r\nHost: {}\r\n".format(path, parts.netloc) \
+                          + "".join("{}: {}\r\n".format(k, v) for k, v in headers.items()) \
+                          + "Connection: close\r\n\r\n"
+                writer.write(request.encode("latin-1"))
+                status, upstreamheaders = await asyncio.wait_for(self._readhead(reader), self.timeout)
+            except BaseException:
+                writer.close()
+                raise
+            location = upstreamheaders.get("Location")
+            if status in (301, 302, 303, 307, 308) and location:
+                writer.close()
+                url = urljoin(url, location)
+                continue
+            return status, upstreamheaders, AsyncChunks(self.loop, self._body(reader, writer, upstreamheaders))
+        raise ValueError("More than {} redirects".format(self.maxredirects))
+
+    async def _readhead(self, reader):
+        """
+        :return: (status, headers) skipping any 1xx responses
+        """
+        while True:
+            statusline = await reader.readline()
+            parts = statusline.split(None, 2)
+            if len(parts) < 2 or not parts[0].startswith(b"HTTP/"):
+                raise ValueError("Bad status line {}".format(statusline))
+            lines = []
+            while True:
+                line = await reader.readline()
+                lines.append(line)
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                if len(lines) > self.maxheaders:
+                    raise ValueError("Too many headers")
+            status = int(parts[1])
+            if status >= 200:
+                return status, parse_headers(BytesIO(b"".join(lines)))
+
+    async def _read(self, coro):
+        return await asyncio.wait_for(coro, self.timeout)
+
+    async def _body(self, reader, writer, headers):
+        """
+        Async generator of the body, the connection is closed when it finishes or is closed
+
+        :raises: requests.exceptions.ChunkedEncodingError if upstream fails part way, as requests would
+        """
+        try:
+            if "chunked" in headers.get("Transfer-Encoding", "").lower():
+                while True:
+                    size = int((await self._read(reader.readline())).split(b";")[0].strip() or b"x", 16)  # ValueError if not hex
+                    if not size:
+                        break
+                    async for chunk in self._fixedlength(reader, size):
+                        yield chunk
+                    await self._read(reader.readline())    # CRLF after each chunk
+            elif headers.get("Content-Length") is not None:
+                async for chunk in self._fixedlength(reader, int(headers["Content-Length"])):
+                    yield chunk
+            else:   # Ends when upstream closes the connection
+                while True:
+                    chunk = await self._read(reader.read(self.chunksize))
+                    if not chunk:
+                        break
+                    yield chunk
+        except (OSError, EOFError, asyncio.TimeoutError, asyncio.LimitOverrunError, ValueError) as e:
+            raise requests.exceptions.ChunkedEncodingError("Upstream failed part way: {}".format(e)) from e
+        finally:
+            writer.close()
+
+    async def _fixedlength(self, reader, length):
+        while length > 0:
+            chunk = await self._read(reader.read(min(length, self.chunksize)))
+            if not chunk:
+                raise EOFError("Upstream closed with {} bytes still to send".format(length))
+            length -= len(chunk)
+            yield chunk
+
+
+class AsyncWFile(object):
+    """
+    Stands in for a handler's wfile, when the handler is running in an executor thread.
+    Writes are passed to the event loop, and wait for the transport to drain so that buffering is bounded.
+    """
+
+    def __init__(self, loop, writer):
+        self.loop = loop
+        self.writer = writer
+        self.stream = None  # (framed chunks, data, chunked) set by deferstream
+
+    def write(self, data):
+        asyncio.run_coroutine_threadsafe(self._write(bytes(data)), self.loop).result()  # Raises BrokenPipeError if gone
+        return len(data)
+
+    async def _write(self, data):
+        if self.writer.is_closing():
+            raise BrokenPipeError()
+        self.writer.write(data)
+        try:
+            await self.writer.drain()
+        except ConnectionError as e:
+            raise BrokenPipeError() from e
+
+    def flush(self):
+        pass
+
+    def deferstream(self, framed, data, chunked):
+        """
+        Called by MyHTTPRequestHandler._sendstream, the stream is sent by AsyncHTTPServer after the handler returns
+
+        :param framed:  Iterator of bytes to write
+        :param data:    The original data, closed when finished, if an AsyncChunks it is read directly instead of framed
+        :param chunked: True if the response uses chunked Transfer-Encoding
+        """
+        self.stream = (framed, data, chunked)
+
+
+class AsyncHTTPServer(object):
+    """
+    Serve handlercls on ipandport from an asyncio event loop
+
+    Fields:
+    handlercls:     subclass of MyHTTPRequestHandler
+    executor:       ThreadPoolExecutor that runs the (blocking) handlers
+    upstream:       AsyncUpstream fetching streams for the handlers
+    """
+    maxheaders = 100        # Same limit as http.client
+    maxline = 65536         # Longest request or header line
+
+    def __init__(self, ipandport, handlercls, reuse_port=False):
+        self.server_address = ipandport
+        self.handlercls = handlercls
+        self.reuse_port = reuse_port    # Set for workers of ServerBase.PreforkMaster
+        self.idletimeout = config["httpserver"]["idletimeout"]
+        self.executor = ThreadPoolExecutor(max_workers=config["httpserver"]["asyncworkers"])
+        self.loop = None
+        self.upstream = None
+        self.draining = False
+        self._server = None
+        self._idle = set()  # Tasks of connections waiting for their next request, closed when draining
+
+    def serve_forever(self):
+        """
+        Serve until shutdown() then return once in-flight requests have finished
+        """
+        asyncio.run(self._serve())
+
+    def shutdown(self):
+        """
+        Stop accepting, and close connections as they become idle. Can be called from any thread or a signal handler.
+        """
+        if self.loop:
+            self.loop.call_soon_threadsafe(self._drain)
+
+    def server_close(self):
+        self.executor.shutdown(wait=True)
+
+    def _drain(self):
+        self.draining = True
+        self._server.close()
+        for task in self._idle:
+            task.cancel()
+
+    async def _serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.upstream = AsyncUpstream(self.loop)
+        self._server = await asyncio.start_server(self._connection, self.server_address[0], self.server_address[1],
+                                                  limit=self.maxline, reuse_port=self.reuse_port or None)
+        try:
+            await self._server.serve_forever()
+        except asyncio.CancelledError:
+            pass    # Closed by _drain
+        await self._server.wait_closed()   # Waits for the connections to finish (Python 3.12 and later)
+        while [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]:
+            await asyncio.sleep(0.1)
+
+    async def _readhead(self, reader):
+        """
+        :return: (requestline, headerbytes) or (None, None) if connection closed or idle too long
+        """
+        if self.draining:
+            return None, None
+        task = asyncio.current_task()
+        self._idle.add(task)
+        try:
+            requestline = await asyncio.wait_for(reader.readline(), self.idletimeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            return None, None
+        finally:
+            self._idle.discard(task)
+        if not requestline:
+            return None, None
+        lines = []
+        while True:
+            line = await reader.readline()
+            lines.append(line)
+            if line in (b"\r\n", b"\n", b"") or len(lines) > self.maxheaders:
+                break
+        return requestline, b"".join(lines)
+
+    async def _connection(self, reader, writer):
+        peer = writer.get_extra_info("peername") or ("", 0)
+        try:
+            while True:
+                requestline, headerbytes = await self._readhead(reader)
+                if requestline is None:
+                    break
+                headers = parse_headers(BytesIO(headerbytes))
+                length = int(headers.get("content-length") or 0)
+                if length and headers.get("expect", "").lower() == "100-continue":
+                    writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")    # Else client waits before sending the body we are about to read
+                    await writer.drain()
+                body = await reader.readexactly(length) if length else b""
+                handler = self._newhandler(requestline, headerbytes + body, writer, peer[:2])
+                await self.loop.run_in_executor(self.executor, self._runhandler, handler)
+                if handler.wfile.stream:
+                    await self._pumpstream(handler)
+                if handler.close_connection or self.draining:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError) as e:
+            logging.debug("Async connection from {} closed: {}".format(peer, e))
+        finally:
+            writer.close()
+
+    def _newhandler(self, requestline, rest, writer, client_address):
+        """
+        Build a handler without running BaseHTTPRequestHandler's socket handling, its rfile holds the headers and body already read
+        """
+        handler = self.handlercls.__new__(self.handlercls)    # Carefull - handlers dont define __init__
+        handler.server = self
+        handler.client_address = client_address
+        handler.raw_requestline = requestline
+        handler.rfile = BytesIO(rest)
+        handler.wfile = AsyncWFile(self.loop, writer)
+        handler.close_connection = True
+        handler.handle_expect_100 = lambda: True    # 100 Continue was sent by _connection before reading the body
+        return handler
+
+    def _runhandler(self, handler):
+        """
+        Run in executor - same steps as BaseHTTPRequestHandler.handle_one_request after reading the request line
+        """
+        miscutils.httpgetstream_local.fetch = self.upstream.fetch
+        try:
+            if not handler.parse_request():     # Sends its own error
+                return
+            method = getattr(handler, "do_" + handler.command, None)
+            if not method:
+                handler.send_error(501, "Unsupported method ({})".format(handler.command))
+                return
+            method()
+        except BrokenPipeError:
+            handler.close_connection = True
+        finally:
+            miscutils.httpgetstream_local.fetch = None    # Executor threads are reused
+
+    async def _pumpstream(self, handler):
+        """
+        Send a stream deferred by the handler, reading an upstream stream on the event loop,
+        or fetching each chunk of any other stream in the executor, and writing from the event loop
+        """
+        framed, data, chunked = handler.wfile.stream
+        writer = handler.wfile.writer
+        try:
+            if isinstance(data, AsyncChunks):
+                async for chunk in data:
+                    piece = handler._framechunk(chunk, chunked)
+                    if piece:
+                        writer.write(piece)
+                        await writer.drain()    # ConnectionError if browser has gone away
+                if chunked:
+                    writer.write(b"0\r\n\r\n")
+                    await writer.drain()
+            else:
+                while True:
+                    piece = await self.loop.run_in_executor(self.executor, next, framed, None)
+                    if piece is None:
+                        break
+                    writer.write(piece)
+                    await writer.drain()    # ConnectionError if browser has gone away
+        except ConnectionError:
+            logging.error("Broken Pipe Error (browser probably gave up waiting) url={}".format(handler.path))
+            handler.close_connection = True
+        except requests.exceptions.RequestException as e:
+            logging.error("Upstream failed while streaming url={} err={}".format(handler.path, e))
+            handler.close_connection = True
+        except Exception as e:
+            # Too late to send an error, the headers are gone, so drop the connection so client sees truncated response
+            logging.error("Error while streaming url={} err={}".format(handler.path, e), exc_info=True)
+            handler.close_connection = True
+        finally:
+            if isinstance(data, AsyncChunks):
+                await data.aclose()
+            elif hasattr(data, "close"):
+                await self.loop.run_in_executor(self.executor, data.close)
@@ -7,6 +7,11 @@ from cgi import parse_header, parse_multipart
 #from Dweb import Dweb      # Import Dweb library (wont use for Academic project
 #TODO-API needs writing up
 import html
+import io
+import os
+import signal
+import socket
+import time
 from http import HTTPStatus
 from .config import config
 
@@ -18,10 +23,13 @@ if python_version.startswith('3'):
     from urllib.parse import parse_qs, parse_qsl, urlparse, unquote
     from http.server import BaseHTTPRequestHandler, HTTPServer
     from socketserver import ThreadingMixIn
+    from queue import Queue, Full
+    import threading
 else:   # Python 2
     from urlparse import parse_qs, parse_qsl, urlparse        # See https://docs.python.org/2/library/urlparse.html
     from urllib import unquote
     from SocketServer import ThreadingMixIn
+    from Queue import Queue, Full
     import threading
     from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
             # See https://docs.python.org/2/library/basehttpserver.html for docs on how servers work
@@ -45,15 +53,174 @@ class DWEBMalformedURLException(MyBaseException):
     httperror = 400
     msg = "Malformed URL {path}"
 
-class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+class ReusePortMixIn(object):
+    """
+    Set SO_REUSEPORT so that several processes can each bind a listening socket to the same port and the kernel
+    spreads connections between them, used by PreforkMaster.
+    """
+    reuse_port = False  # Set on class by PreforkMaster in the worker
+
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super(ReusePortMixIn, self).server_bind()
+
+class ThreadedHTTPServer(ReusePortMixIn, ThreadingMixIn, HTTPServer):
     """Handle requests in a separate thread."""
 
+class PooledHTTPServer(ReusePortMixIn, HTTPServer):
+    """
+    Handle requests on a fixed size pool of worker threads, with a bounded queue of connections waiting for a worker.
+    When the queue is full the connection gets a fast 503 with Retry-After, rather than another thread as ThreadedHTTPServer would do.
+
+    Parameters come from config["httpserver"]
+    threads:        Number of worker threads
+    queuedepth:     Number of accepted connections that can wait for a worker
+    retryafter:     Seconds to tell a client to wait when rejected
+    idletimeout:    Seconds a keep-alive connection can hold a worker without sending anything
+    """
+    busymessage = b"Server busy, please retry later\n"
+
+    def __init__(self, server_address, RequestHandlerClass):
+        HTTPServer.__init__(self, server_address, RequestHandlerClass)
+        self.retryafter = config["httpserver"]["retryafter"]
+        self.idletimeout = config["httpserver"]["idletimeout"]
+        self._queue = Queue(maxsize=config["httpserver"]["queuedepth"])
+        self._busy = 0      # Number of workers handling a connection, so server_close can wait for them
+        self._busylock = threading.Lock()
+        for i in range(config["httpserver"]["threads"]):
+            t = threading.Thread(target=self._worker, name="HTTPworker{}".format(i))
+            t.daemon = True
+            t.start()
+
+    def process_request(self, request, client_address):
+        try:
+            self._queue.put_nowait((request, client_address))
+        except Full:
+            logging.warning("Server busy, rejecting request from {}".format(client_address))
+            self._sendbusy(request)
+            self.shutdown_request(request)
+
+    def _sendbusy(self, request):
+        try:
+            request.sendall("HTTP/1.1 503 Service Unavailable\r\nRetry-After: {}\r\nContent-Type: text/plain\r\nContent-Length: {}\r\nConnection: close\r\n\r\n"
+                            .format(self.retryafter, len(self.busymessage)).encode("ascii") + self.busymessage)
+        except OSError:
+            pass    # Client has gone already
+
+    def _worker(self):
+        while True:
+            request, client_address = self._queue.get()
+            with self._busylock:
+                self._busy += 1
+            try:
+                request.settimeout(self.idletimeout)    # Stop idle keep-alive connections holding a worker forever
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+                with self._busylock:
+                    self._busy -= 1
+
+    def server_close(self):
+        """
+        Stop listening, then wait for queued and in-flight connections to finish (like ThreadingMixIn does with its threads)
+        """
+        HTTPServer.server_close(self)
+        while not self._queue.empty() or self._busy:
+            time.sleep(0.1)
+
+class PreforkMaster(object):
+    """
+    Run a server in several worker processes, each with its own listening socket on the same port (SO_REUSEPORT)
+    and its own connections to redis, upstream HTTP etc. (see MyHTTPRequestHandler.afterfork)
+
+    The master restarts workers that die, and on SIGHUP does a graceful reload - starts a new set of workers, then sends
+    SIGTERM to the old ones which stop accepting, finish in-flight requests (up to config httpserver.draintimeout) and exit.
+    SIGTERM or SIGINT to the master stops all the workers the same way.
+    Note a reload re-forks from the master so it doesnt load new code, restart the master (e.g. supervisorctl restart) for that.
+    """
+
+    def __init__(self, handlercls, processes):
+        self.handlercls = handlercls
+        self.processes = processes
+        self.workers = {}       # pid => generation
+        self.generation = 0
+        self.reloadwanted = False
+        self.stopwanted = False
+
+    def run(self):
+        signal.signal(signal.SIGHUP, self._onhup)
+        signal.signal(signal.SIGTERM, self._onterm)
+        signal.signal(signal.SIGINT, self._onterm)
+        self._spawnall()
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid:
+                generation = self.workers.pop(pid, None)
+                if generation == self.generation and not self.stopwanted:
+                    logging.error("Worker {} exited with status {} restarting".format(pid, status))
+                    time.sleep(1)   # Dont spin if workers are failing on startup
+                    self._spawn()
+                continue
+            if self.reloadwanted:
+                self.reloadwanted = False
+                old = list(self.workers)
+                self.generation += 1
+                logging.info("Reloading, new workers generation {}".format(self.generation))
+                self._spawnall()
+                self._signal(old, signal.SIGTERM)
+            if self.stopwanted:
+                self.stopwanted = False
+                self.generation += 1    # So no worker will be restarted
+                self._signal(list(self.workers), signal.SIGTERM)
+            time.sleep(0.5)
+        logging.info("All workers exited")
+
+    def _onhup(self, signum, frame):
+        self.reloadwanted = True
+
+    def _onterm(self, signum, frame):
+        self.stopwanted = True
+
+    def _signal(self, pids, signum):
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def _spawnall(self):
+        for i in range(self.processes):
+            self._spawn()
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = self.generation
+            return
+        # In worker
+        try:
+            for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+                signal.signal(signum, signal.SIG_DFL)
+            self.handlercls.afterfork()
+            self.handlercls._serve(reuse_port=True)
+        except Exception:
+            logging.error("Worker {} failed".format(os.getpid()), exc_info=True)
+            os._exit(1)
+        os._exit(0)
+
 class MyHTTPRequestHandler(BaseHTTPRequestHandler):
     """
     Generic HTTPRequestHandler, extends BaseHTTPRequestHandler, to make it easier to use
     """
     # Carefull - do not define __init__ as it is run for each incoming request.
-    # TODO-STREAMS add support for longer (streamed) files on both upload and download, allow a stream to be passed back from the subclasses routines.
+    # Downloads can be streamed - the subclasses routines can return an iterator, generator or file-like object as "data" (see _sendstream)
+    # TODO-STREAMS add support for longer (streamed) files on upload.
 
     """
     Simple (standard) HTTPdispatcher,
@@ -64,6 +231,72 @@ class MyHTTPRequestHandler(BaseHTTPRequestHandler):
     onlyexposed = False  # Dont Limit to @exposed functions (override in subclass if using @exposed)
     defaultipandport = { "ipandport": ('localhost', 8080) }
     expectedExceptions = () # List any exceptions that you "expect" (and dont want stacktraces for)
+    _routes = {}        # (HTTP method or None, first segment) => function, built by _buildroutes when class created
+    _subroutes = {}     # (first segment, "sub/segments") => function, from @route
+    _subroutedepths = {}    # first segment => number of sub segments to try, deepest first
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._buildroutes()
+
+    @classmethod
+    def _buildroutes(cls):
+        """
+        Build the route table once per class, so _dispatch does a dict lookup rather than searching for a method each request.
+        Methods named GET_foo or POST_foo are only for that HTTP method, foo for any. Methods decorated with @route are in _subroutes.
+        """
+        routes = {}
+        subroutes = {}
+        depths = {}
+        for name in dir(cls):
+            func = getattr(cls, name, None)
+            if name.startswith("_") or not callable(func):
+                continue
+            for path in getattr(func, "routes", []):
+                subroutes[(path[0], "/".join(path[1:]))] = func
+                depths.setdefault(path[0], set()).add(len(path) - 1)
+            if getattr(func, "exposed", False) or not cls.onlyexposed:
+                method, _, rest = name.partition("_")
+                if rest and method in ("GET", "POST"):
+                    routes[(method, rest)] = func
+                else:
+                    routes[(None, name)] = func
+        cls._routes = routes
+        cls._subroutes = subroutes
+        cls._subroutedepths = {k: sorted(v, reverse=True) for k, v in depths.items()}
+
+    @classmethod
+    def routelist(cls):
+        """
+        :return: Sorted list of the paths served e.g. ["* /info", "* /arc/archive.org/metadata"] for introspection
+        """
+        return sorted(["{} /{}".format(method or "*", cmd) for (method, cmd), func in cls._routes.items() if getattr(func, "exposed", False)]
+                      + ["* /{}/{}".format(cmd, sub) for (cmd, sub) in cls._subroutes])
+
+    @classmethod
+    def _subroute(cls, cmd, args):
+        """
+        Find a @route for /cmd/args...
+
+        :return: (function, remaining args) or (None, args)
+        """
+        for depth in cls._subroutedepths.get(cmd, ()):
+            func = cls._subroutes.get((cmd, "/".join(args[:depth])))
+            if func and len(args) >= depth:
+                return func, list(args[depth:])
+        return None, args
+
+    def _route(self, cmd, args):
+        """
+        Find the function to handle /cmd/args... for this HTTP method, checking @route first
+
+        :return: (function, remaining args) or (None, args), function should be passed self as first argument
+        """
+        func, rest = self._subroute(cmd, args)
+        if func:
+            return func, rest
+        c = cmd.replace(".", "_")   # e.g. archive.org => archive_org
+        return self._routes.get((self.command, c)) or self._routes.get((None, c)), args
 
     @classmethod
     def serve_forever(cls, ipandport=None, verbose=False, **options):
@@ -81,8 +314,57 @@ class MyHTTPRequestHandler(BaseHTTPRequestHandler):
         cls.options = options
         #HTTPServer(cls.ipandport, cls).serve_forever()  # Start http server
         logging.info("Server starting on {0}:{1}:{2}".format(cls.ipandport[0], cls.ipandport[1], cls.options or ""))
-        ThreadedHTTPServer(cls.ipandport, cls).serve_forever()  # OR Start http server
-        logging.error("Server exited") # It never should
+        processes = config["httpserver"]["processes"]
+        if processes > 1:
+            PreforkMaster(cls, processes).run()     # Returns when all workers stopped
+        else:
+            cls._serve()
+            logging.error("Server exited") # It never should
+
+    @classmethod
+    def _serve(cls, reuse_port=False):
+        """
+        Run the server selected by config httpserver.server in this process.
+        If reuse_port it is a prefork worker, SIGTERM makes it stop accepting and return once in-flight requests are done.
+        """
+        if config["httpserver"]["server"] == "async":
+            from .ServerAsync import AsyncHTTPServer  # Only imported if used, its Python3 only
+            server = AsyncHTTPServer(cls.ipandport, cls, reuse_port=reuse_port)
+            stop = server.shutdown
+        else:
+            servercls = PooledHTTPServer if config["httpserver"]["server"] == "pooled" else ThreadedHTTPServer
+            servercls.reuse_port = reuse_port
+            server = servercls(cls.ipandport, cls)
+            def stop():
+                threading.Thread(target=server.shutdown).start()    # shutdown waits for serve_forever, so cant call from its thread
+        if reuse_port:
+            def onterm(signum, frame):
+                logging.info("Worker {} draining".format(os.getpid()))
+                watchdog = threading.Timer(config["httpserver"]["draintimeout"], os._exit, [0])   # Dont wait forever on idle keep-alive
+                watchdog.daemon = True
+                watchdog.start()
+                stop()
+            signal.signal(signal.SIGTERM, onterm)
+        server.serve_forever()
+        server.server_close()   # Waits for in-flight requests
+
+    @classmethod
+    def afterfork(cls):
+        """
+        Called in each worker process started by PreforkMaster, subclasses should drop anything that must not be shared
+        across processes e.g. connections to databases.
+        """
+        pass
+
+    @classmethod
+    def serve_forever_async(cls, ipandport=None, verbose=False, **options):
+        """
+        Start a server using the asyncio engine in ServerAsync, parameters as for serve_forever
+
+        :return: Never returns
+        """
+        config["httpserver"]["server"] = "async"     # So that prefork workers also use it
+        cls.serve_forever(ipandport=ipandport, verbose=verbose, **options)
 
     def _dispatch(self, **postvars):
         """
@@ -120,25 +402,25 @@ class MyHTTPRequestHandler(BaseHTTPRequestHandler):
             else:
                 kwargs.update(postvars)
 
-                cmds = [self.command + "_" + cmd, cmd, self.command + "_" + cmd.replace(".","_"), cmd.replace(".","_")]
-                try:
-                    func = next(getattr(self, c, None) for c in cmds if getattr(self, c, None))
-                except StopIteration:
-                    func = None
-                #func = getattr(self, self.command + "_" + cmd, None) or getattr(self, cmd, None) # self.POST_foo or self.foo (should be a method)
-                if not func or (self.onlyexposed and not func.exposed):
+                func, args = self._route(cmd, args)     # Lookup in table built by _buildroutes
+                if not func:
                     raise HTTPdispatcherException(req=cmd)  # Will be caught in except
-                res = func(*args, **kwargs)
+                res = func(self, *args, **kwargs)
                 # Function should return
 
                 # Send the content-type
-                self.send_response(200)  # Send an ok response
+                self.send_response(res.get("status", 200))  # Send an ok response (or e.g. 206 passed on from upstream for a range)
                 contenttype = res.get("Content-type","application/octet-stream")
                 self.send_header('Content-type', contenttype)
+                for k, v in (res.get("headers") or {}).items():    # Any other headers e.g. Content-Range
+                    self.send_header(k, v)
                 if self.headers.get('Origin'):  # Handle CORS (Cross-Origin)
                     self.send_header('Access-Control-Allow-Origin', '*')
                     # self.send_header('Access-Control-Allow-Origin', self.headers['Origin'])  # '*' didnt work
                 data = res.get("data","")
+                if self._isstream(data):    # Iterator, generator or file-like, send in chunks rather than buffering it all
+                    self._sendstream(data, contentlength=res.get("Content-Length"))
+                    return
                 if data or isinstance(data, (list, tuple, dict)): # Allow empty arrays toreturn as [] or empty dict as {}
                     if isinstance(data, (dict, list, tuple)):    # Turn it into JSON
                         data = dumps(data)        # Does our own version to handle classes like datetime
@@ -179,6 +461,94 @@ class MyHTTPRequestHandler(BaseHTTPRequestHandler):
             self.send_error(httperror, str(e))    # Send an error response
 
 
+    @staticmethod
+    def _isstream(data):
+        """
+        True if data should be streamed back rather than written in one go,
+        i.e. a file-like object (has read) or an iterator/generator of chunks.
+        """
+        return hasattr(data, "read") or \
+            (hasattr(data, "__iter__") and not isinstance(data, (str, bytes, bytearray, dict, list, tuple)))
+
+    def _sendstream(self, data, contentlength=None):
+        """
+        Send a streamed body, finishing the headers started by _dispatch.
+        Uses Content-Length if the length is known (passed in, or the size of a real file) otherwise chunked
+        Transfer-Encoding (or close at end for HTTP/1.0 clients). At most one chunk is held in memory at a time.
+
+        :param data:            file-like (with read) or iterator of bytes or str
+        :param contentlength:   Length of the data if known
+        :raises:                BrokenPipeError if browser has gone away
+        """
+        chunksize = config["httpserver"]["chunksize"]
+        if contentlength is None and hasattr(data, "fileno") and not isinstance(data, io.TextIOBase):  # Text is re-encoded, so may change length
+            try:
+                contentlength = os.fstat(data.fileno()).st_size - data.tell()
+            except (OSError, ValueError, AttributeError):  # Not a real file e.g. a socket or a wrapper
+                pass
+        chunks = self._readchunks(data, chunksize) if hasattr(data, "read") else iter(data)
+        chunked = contentlength is None and self.request_version != "HTTP/1.0"
+        if contentlength is not None:
+            self.send_header('content-length', str(contentlength))
+        elif chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:   # HTTP/1.0 client and unknown length, end of data is marked by closing the connection
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        self.end_headers()
+        framed = self._framestream(chunks, chunked)
+        if hasattr(self.wfile, "deferstream"):  # e.g. ServerAsync, which pulls the chunks itself so a slow client doesnt hold a thread
+            self.wfile.deferstream(framed, data, chunked)
+            return
+        try:
+            for piece in framed:
+                self.wfile.write(piece)  # Thows BrokenPipeError if browser has gone away
+        except BrokenPipeError:
+            raise   # Handled by _dispatch
+        except Exception as e:
+            # Too late to send an error, the headers are gone, so drop the connection so client sees truncated response
+            logging.error("Error while streaming url={} err={}".format(self.path, e), exc_info=True)
+            self.close_connection = True
+        finally:
+            if hasattr(data, "close"):
+                data.close()
+
+    @staticmethod
+    def _readchunks(data, chunksize):
+        """
+        Generator of chunks read from file-like data until it returns an empty chunk, b"" or "" for a text mode file
+        """
+        while True:
+            chunk = data.read(chunksize)
+            if not chunk:
+                return
+            yield chunk
+
+    @staticmethod
+    def _framestream(chunks, chunked):
+        """
+        Generator of the bytes to write for a stream of chunks, adding the chunked Transfer-Encoding framing if chunked
+        """
+        for chunk in chunks:
+            piece = MyHTTPRequestHandler._framechunk(chunk, chunked)
+            if piece:
+                yield piece
+        if chunked:
+            yield b"0\r\n\r\n"
+
+    @staticmethod
+    def _framechunk(chunk, chunked):
+        """
+        :return: bytes to write for one chunk, b"" for an empty chunk, which would otherwise mark the end of a chunked response
+        """
+        if isinstance(chunk, str):
+            chunk = bytes(chunk, "utf-8")
+        if not chunk:
+            return b""
+        if chunked:
+            return "{:X}\r\n".format(len(chunk)).encode("ascii") + chunk + b"\r\n"
+        return chunk
+
     def do_GET(self):
         #logging.debug(self.headers)
         self._dispatch()
@@ -294,3 +664,19 @@ def exposed(func):
 
     wrapped.exposed = True
     return wrapped
+
+def route(cmd, *subpath):
+    """
+    Decorator to handle URLs starting /cmd/subpath..., the rest of the path and query are passed to the method,
+    e.g. @route("arc", "archive.org", "metadata") on foo(self, *args, **kwargs) handles /arc/archive.org/metadata/commute as foo("commute").
+    Can be used more than once on a method. These are found by _dispatch before methods for /cmd
+
+    :param cmd:     First segment of path
+    :param subpath: Following segments
+    """
+    def decorate(func):
+        func.routes = getattr(func, "routes", []) + [(cmd,) + subpath]
+        return func
+    return decorate
+
+MyHTTPRequestHandler._buildroutes()     # Subclasses are built by __init_subclass__
@@ -2,8 +2,8 @@
 # from sys import version as python_version
 import logging
 from .config import config
-from .miscutils import mergeoptions
-from .ServerBase import MyHTTPRequestHandler, exposed, HTTPdispatcherException
+from .miscutils import mergeoptions, HTTPSessions, FanOut
+from .ServerBase import MyHTTPRequestHandler, exposed, route, HTTPdispatcherException
 from .DOI import DOI
 from .Errors import ToBeImplementedException, NoContentException, SearchException, TransportFileNotFound, ForbiddenException
 # !SEE-OTHERNAMESPACE add new namespaces here and see other #!SEE-OTHERNAMESPACE
@@ -12,6 +12,9 @@ from .LocalResolver import LocalResolverStore, LocalResolverFetch, LocalResolver
 from .Archive import AdvancedSearch, ArchiveItem, ArchiveItemNotFound
 from .Btih import BtihResolver
 from .LocalResolver import KeyValueTable
+from .HashStore import HashStore
+from .Singleflight import Singleflight
+from .JobQueue import JobQueue
 import json
 
 """
@@ -53,8 +56,8 @@ class DwebGatewayHTTPRequestHandler(MyHTTPRequestHandler):
     Notes:
     *The namespace is passed to the specific constructor since a single name resolver might implement multiple namespaces.
 
-    Future Work:
-    #TODO-STREAM Expand the ServerBase classes to support streams as a return from these routines
+    Handlers can return a stream (iterator, generator or file-like) as "data" and ServerBase will send it in chunks,
+    optionally with "Content-Length" in the result if the length is known.
     """
     defaulthttpoptions = {"ipandport": ('localhost', 4244)}
     onlyexposed = True          # Only allow calls to @exposed methods
@@ -90,8 +93,42 @@ class DwebGatewayHTTPRequestHandler(MyHTTPRequestHandler):
         httpoptions = mergeoptions(cls.defaulthttpoptions, httpoptions or {})  # Deepcopy to merge options
         logging.info("Starting server with options={0}".format(httpoptions))
         # any code needed once (not per thread) goes here.
+        cls.startjobworkers()
         cls.serve_forever(ipandport=httpoptions["ipandport"], verbose=verbose)  # Uses defaultipandport
 
+    @classmethod
+    def afterfork(cls):
+        """
+        Each worker process needs its own redis and upstream HTTP connections (sqlite is already opened per request, see DOI)
+        """
+        HashStore.reset()
+        HTTPSessions.reset()
+        FanOut.reset()
+        JobQueue.reset()
+        JobQueue.startworkers()
+
+    @classmethod
+    def startjobworkers(cls):
+        """
+        Start background job workers (see JobQueue) in this process, unless forking workers which start their own in afterfork
+        """
+        if config["httpserver"]["processes"] <= 1:
+            JobQueue.startworkers()
+
+    # noinspection PyPep8Naming
+    @classmethod
+    def DwebGatewayAsyncServeForever(cls, httpoptions=None, verbose=False):
+        """
+        Alternative to DwebGatewayHTTPServeForever using the asyncio engine (ServerAsync), same dispatch and namespaces.
+        Suits many mostly idle connections e.g. webseeds and range requests.
+
+        :return: Never Returns
+        """
+        httpoptions = mergeoptions(cls.defaulthttpoptions, httpoptions or {})  # Deepcopy to merge options
+        logging.info("Starting async server with options={0}".format(httpoptions))
+        cls.startjobworkers()
+        cls.serve_forever_async(ipandport=httpoptions["ipandport"], verbose=verbose)
+
     @exposed  # Exposes this function for outside use
     def sandbox(self, foo, bar, **kwargs):
         # Changeable, just for testing HTTP etc, feel free to play with in your branch, and expect it to be overwritten on master branch.
@@ -113,7 +150,9 @@ class DwebGatewayHTTPRequestHandler(MyHTTPRequestHandler):
         """
         return {'Content-type': 'application/json',
                 'data': {"type": "gateway",
-                         "services": []}     # A list of names of services supported below  (not currently consumed anywhere)
+                         "services": [],     # A list of names of services supported below  (not currently consumed anywhere)
+                         "routes": self.routelist(),     # Paths served, from the route table
+                         "httppools": HTTPSessions.stats()}     # Upstream connections opened and reused per host
                }
 
     @exposed
@@ -193,45 +232,65 @@ class DwebGatewayHTTPRequestHandler(MyHTTPRequestHandler):
         /arc/archive.org/advancedsearch => metadata/advancedsearch
         /arc/archive.org/details => html file, but this should be done by nginx
 
+        _dispatch normally goes straight to the @route("arc", ...) methods below, this handles the rest, and direct calls.
+
         :param arg1: Must be "archive.org"
         :param args: Remainder of path
         :return:
         """
-        verbose = kwargs.get("verbose")
-        if arg1 == "archive.org":
+        func, rest = self._subroute("arc", [arg1] + list(args))
+        if func:
+            return func(self, *rest, **kwargs)
+        if arg1 == "archive.org" and args:
             arg2 = args[0]
             args = list(args[1:])
-            if (arg2 == "download") or (arg2 == "serve"):
-                return ArchiveItem.new("archiveid", *args, **kwargs).content(verbose=verbose, _headers=self.headers)   # { Content-Type: xxx; data: "bytes" }
-            if arg2 == "advancedsearch":
-                try:
-                    return AdvancedSearch.new("advancedsearch", *args, **kwargs).metadata(headers=True, **kwargs)  # { Content-Type: xxx; data: "bytes" }
-                except json.decoder.JSONDecodeError:
-                    raise SearchException(search=kwargs)
-            if arg2 == "leaf":  # This needs to catch the special case of /arc/archive.org/leaf?key=xyz
-                args = list(args)
-                if kwargs.get("key"):
-                    args.append(kwargs["key"])  # Push key into place normally held by itemid in URL of archiveid/xyz
-                    del kwargs["key"]
-                return ArchiveItem.new("archiveid", *args, **kwargs).leaf(headers=True, **kwargs)    # ERR: ArchiveItemNotFound if invalid id
-            if arg2 == "service" and args[0] == "img":
-                args.pop(0)
-                arg2 = "thumbnail"
-            if arg2 in ["torrent", "metadata", "thumbnail"]:
-                if arg2 == "torrent":
-                    # Need to pass these to new
-                    kwargs["transport"] = "WEBTORRENT"
-                    kwargs["wanttorrent"] = True
-                obj = ArchiveItem.new("archiveid", *args, **kwargs)
-                func = getattr(obj, arg2, None)
-                return func(headers=True, **kwargs)
             if arg2 == "details" or arg2 == "search":
-                raise ToBeImplementedException(name="forwarding to details html for name /arc/%s/%s which should be intercepted by nginx first".format(arg1, '/'.join(args)))
+                raise ToBeImplementedException(name="forwarding to details html for name /arc/{}/{} which should be intercepted by nginx first".format(arg1, '/'.join(args)))
             if arg2 in config["ignoreurls"]:    # Looks like hacking or ignorable e.g. robots.txt, note this just ignores /arc/archive.org/xyz
                 raise TransportFileNotFound(file="/arc/{}/{}/{}".format(arg1, arg2, '/'.join(args)))
             raise ToBeImplementedException(name="name /arc/{}/{}/{}".format(arg1, arg2, '/'.join(args)))
         raise ToBeImplementedException(name="name /arc/{}/{}".format(arg1, '/'.join(args)))
 
+    @route("arc", "archive.org", "download")
+    @route("arc", "archive.org", "serve")
+    def arc_download(self, *args, **kwargs):
+        return ArchiveItem.new("archiveid", *args, **kwargs).content(verbose=kwargs.get("verbose"), _headers=self.headers)   # { Content-Type: xxx; data: "bytes" }
+
+    @route("arc", "archive.org", "advancedsearch")
+    def arc_advancedsearch(self, *args, **kwargs):
+        try:
+            return AdvancedSearch.new("advancedsearch", *args, **kwargs).metadata(headers=True, **kwargs)  # { Content-Type: xxx; data: "bytes" }
+        except json.decoder.JSONDecodeError:
+            raise SearchException(search=kwargs)
+
+    @route("arc", "archive.org", "leaf")
+    def arc_leaf(self, *args, **kwargs):
+        # This needs to catch the special case of /arc/archive.org/leaf?key=xyz
+        args = list(args)
+        if kwargs.get("key"):
+            args.append(kwargs["key"])  # Push key into place normally held by itemid in URL of archiveid/xyz
+            del kwargs["key"]
+        return ArchiveItem.new("archiveid", *args, **kwargs).leaf(headers=True, **kwargs)    # ERR: ArchiveItemNotFound if invalid id
+
+    @route("arc", "archive.org", "metadata")
+    def arc_metadata(self, *args, **kwargs):
+        # Concurrent requests for the same item share one ArchiveItem.new
+        return Singleflight.do(Singleflight.key("archiveid", *args, **dict(kwargs, output="metadata")),
+                               lambda: ArchiveItem.new("archiveid", *args, **kwargs).metadata(headers=True, **kwargs))
+
+    @route("arc", "archive.org", "thumbnail")
+    @route("arc", "archive.org", "service", "img")
+    def arc_thumbnail(self, *args, **kwargs):
+        return ArchiveItem.new("archiveid", *args, **kwargs).thumbnail(headers=True, **kwargs)
+
+    @route("arc", "archive.org", "torrent")
+    def arc_torrent(self, *args, **kwargs):
+        # Need to pass these to new
+        kwargs["transport"] = "WEBTORRENT"
+        kwargs["wanttorrent"] = True
+        return Singleflight.do(Singleflight.key("archiveid", *args, **dict(kwargs, output="torrent")),
+                               lambda: ArchiveItem.new("archiveid", *args, **kwargs).torrent(headers=True, **kwargs))
+
     def _namedclass(self, namespace, *args, **kwargs):
         namespaceclass = self.namespaceclasses[namespace]  # e.g. doi=>DOI, sha1hex => Sha1Hex
         output = kwargs.get("output")
@@ -240,12 +299,14 @@ class DwebGatewayHTTPRequestHandler(MyHTTPRequestHandler):
             # btih:zzzz?output=magnetlink - get a Webtorrent magnetlink only currently supported by btih - could (easily) be supported on ArchiveFile, ArchiveItem
             # btih:zzzz?output=archiveid - get the archiveid, only currently supported by btih - could (easily) be supported on ArchiveFile, ArchiveItem
             # btih:zzzz?output=torrent - get a torrentfile, only currently supported by btih - could (easily) be supported on ArchiveFile, ArchiveItem
-            obj = namespaceclass.new(namespace, *args, **kwargs)
-            func = getattr(obj, output, None)
-            if func:
-                return func(headers=True, **kwargs)
-            else:
-                raise ToBeImplementedException(name="{}/{}?{}".format(namespace, "/".join(args), kwargs))
+            def _output():
+                obj = namespaceclass.new(namespace, *args, **kwargs)
+                func = getattr(obj, output, None)
+                if func:
+                    return func(headers=True, **kwargs)
+                else:
+                    raise ToBeImplementedException(name="{}/{}?{}".format(namespace, "/".join(args), kwargs))
+            return Singleflight.do(Singleflight.key(namespace, *args, **kwargs), _output)
         elif output:
             raise ToBeImplementedException(name="{}/{}?{}".format(namespace, "/".join(args), kwargs))
         else:  # Default to returning content
@@ -318,5 +379,8 @@ class DwebGatewayHTTPRequestHandler(MyHTTPRequestHandler):
 
 if __name__ == "__main__":
     logging.basicConfig(**config["logging"])
-    DwebGatewayHTTPRequestHandler.DwebGatewayHTTPServeForever({'ipandport': ('localhost', 4244)}, verbose=True)  # Run local gateway
+    if config["httpserver"]["server"] == "async":
+        DwebGatewayHTTPRequestHandler.DwebGatewayAsyncServeForever({'ipandport': ('localhost', 4244)}, verbose=True)  # Run local gateway
+    else:
+        DwebGatewayHTTPRequestHandler.DwebGatewayHTTPServeForever({'ipandport': ('localhost', 4244)}, verbose=True)  # Run local gateway
 
@@ -0,0 +1,161 @@
+# encoding: utf-8
+"""
+Coalesce identical requests that are in flight at the same time, so that when an item goes viral,
+hundreds of concurrent /arc/archive.org/metadata/<id> requests cause one ArchiveItem.new (and its fetches of metadata,
+torrent, thumbnail and pushes to IPFS) rather than hundreds.
+
+Within a process, callers with the same key wait on the first caller's computation and share its result (or exception).
+Optionally (config["singleflight"]["redis"]) this works across processes (e.g. ServerBase.PreforkMaster workers) by
+taking a lock in redis, the process holding the lock publishes the result for a few seconds for the others to pick up.
+
+Parameters come from config["singleflight"]
+enabled:        If False, do() just calls the function
+redis:          If True coalesce across processes via redis as well as within the process
+waittimeout:    Seconds a caller waits for another's computation before doing it itself
+locktimeout:    Seconds a redis lock is held for at most, in case the holder dies
+resultttl:      Seconds a result is kept in redis for other processes to pick up
+pollinterval:   Seconds between checks for the result from another process
+"""
+import threading
+import logging
+import time
+import base64
+import hashlib
+import uuid
+from .config import config
+from .miscutils import dumps, loads
+from .HashStore import HashStore
+from .HashStoreBackends import deleteifequal
+
+
+class _Call(object):
+    """
+    A computation in flight in this process
+    """
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.exception = None
+        self.waiters = 0
+
+
+class Singleflight(object):
+    """
+    Class Fields:
+    _inflight:  { key: _Call } computations in flight in this process
+    _lock:      Protects _inflight
+
+    Class methods:
+    key(namespace, *args, **kwargs)     Normalized key for a request
+    do(key, func)                       Return func(), or result of an identical call already in flight
+    """
+    _inflight = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def key(cls, namespace, *args, **kwargs):
+        """
+        Normalize a request, so that e.g. ?verbose=1 or order of query parameters dont stop requests being coalesced
+
+        :param namespace:   e.g. "archiveid"
+        :param args:        Remainder of path
+        :param kwargs:      Query parameters, including output
+        :return:            string key
+        """
+        params = {k: v for k, v in kwargs.items() if k not in ("verbose", "output")}
+        return dumps([namespace, list(args), kwargs.get("output"), params])   # dumps sorts keys
+
+    @classmethod
+    def do(cls, key, func):
+        """
+        Run func() unless an identical call is in flight, in which case wait for, and return, its result.
+
+        :param key:     from key()
+        :param func:    function of no arguments, typically a lambda around the handler
+        :return:        result of func() - shared between callers so must not be modified by them
+        :raises:        whatever func() raises, in all the callers waiting on it
+        """
+        if not config["singleflight"]["enabled"]:
+            return func()
+        with cls._lock:
+            call = cls._inflight.get(key)
+            leader = not call
+            if leader:
+                call = _Call()
+                cls._inflight[key] = call
+            else:
+                call.waiters += 1
+        if not leader:
+            if not call.event.wait(config["singleflight"]["waittimeout"]):
+                logging.warning("Singleflight gave up waiting for {}".format(key))
+                return func()
+            if call.exception:
+                raise call.exception
+            if cls._isshareable(call.result):
+                return call.result
+            return func()   # e.g. a stream, which can only be consumed once
+        try:
+            if config["singleflight"]["redis"]:
+                call.result = cls._doredis(key, func)
+            else:
+                call.result = func()
+            if call.waiters:
+                logging.debug("Singleflight shared result of {} with {} callers".format(key, call.waiters))
+            return call.result
+        except Exception as e:
+            call.exception = e
+            raise e
+        finally:
+            with cls._lock:
+                del cls._inflight[key]
+            call.event.set()
+
+    @staticmethod
+    def _isshareable(res):
+        data = res.get("data") if isinstance(res, dict) else res
+        return data is None or isinstance(data, (bytes, str, dict, list, int, float))
+
+    @classmethod
+    def _doredis(cls, key, func):
+        """
+        Run func() if we can get the lock for key in redis, otherwise wait for the process that has it to publish its result
+        """
+        conf = config["singleflight"]
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        lockkey = "singleflight:lock:" + digest
+        resultkey = "singleflight:result:" + digest
+        r = HashStore.redis()
+        token = uuid.uuid4().hex    # So only this call releases the lock it took
+        deadline = time.time() + conf["waittimeout"]
+        while not r.set(lockkey, token, nx=True, px=int(conf["locktimeout"] * 1000)):
+            res = r.get(resultkey)
+            if res is not None:
+                return cls._decode(res)
+            if time.time() > deadline:
+                logging.warning("Singleflight gave up waiting for another process on {}".format(key))
+                return func()
+            time.sleep(conf["pollinterval"])
+            # Loop will take the lock if the holder finished without a result (e.g. an exception) or died
+        try:
+            res = func()
+            if cls._isshareable(res):
+                r.set(resultkey, cls._encode(res), px=int(conf["resultttl"] * 1000))
+            return res
+        finally:
+            deleteifequal(r, lockkey, token)  # Unless it expired and another caller has it
+
+    @staticmethod
+    def _encode(res):
+        # Result is typically { Content-type, data } where data may be bytes e.g. a torrent file
+        if isinstance(res, dict) and isinstance(res.get("data"), bytes):
+            res = dict(res)
+            res["data"] = {"base64": base64.b64encode(res["data"]).decode('ascii')}
+            res["_singleflightbytes"] = True
+        return dumps(res)
+
+    @staticmethod
+    def _decode(s):
+        res = loads(s)
+        if isinstance(res, dict) and res.pop("_singleflightbytes", False):
+            res["data"] = base64.b64decode(res["data"]["base64"])
+        return res
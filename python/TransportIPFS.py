@@ -1,12 +1,16 @@
 # encoding: utf-8
 import json
 import logging
+import hashlib
+import uuid
 from .miscutils import loads, dumps
 from .Transport import Transport
 from .config import config
 import requests # HTTP requests
-from .miscutils import httpget
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from .miscutils import httpget, httpgetstream, readahead, HTTPSessions, RateLimiter
 from .Errors import IPFSException
+from .JobQueue import JobQueue
 
 
 class TransportIPFS(Transport):
@@ -66,7 +70,7 @@ class TransportIPFS(Transport):
                 self.pinggateway(i)
         headers = { "Connection": "keep-alive"}
         ipfsgatewayurl = "https://ipfs.io/ipfs/{}".format(ipldhash)
-        res = requests.head(ipfsgatewayurl, headers=headers);  # Going to ignore the result
+        res = HTTPSessions.session().head(ipfsgatewayurl, headers=headers);  # Going to ignore the result
         logging.debug("Transportipfs.pinggateway workaround for JS-IPFS issue #1156 - pin gateway for {}".format(ipfsgatewayurl))
 
     def announcedht(self, ipldhash):
@@ -76,13 +80,46 @@ class TransportIPFS(Transport):
         : param ipldhash    Hash of form z... or Q....  or array of ipldhash
         """
         if isinstance(ipldhash, (list,tuple,set)):
-            for i in ipldhash:
-                self.announcedht(i)
+            self.announcedhtmany(ipldhash)
+            return
         headers = { "Connection": "keep-alive"}
         ipfsurl = config["ipfs"]["url_dht_provide"]
-        res = requests.get(ipfsurl, headers=headers, params={'arg': ipldhash})  # Ignoring result
+        res = HTTPSessions.session().get(ipfsurl, headers=headers, params={'arg': ipldhash})  # Ignoring result
         logging.debug("Transportipfs.announcedht for {}?arg={}".format(ipfsurl, ipldhash))   # Log whether verbose or not
 
+    def announcedhtmany(self, ipldhashes, workers=None, rate=None):
+        """
+        Announce many hashes to the DHT concurrently, with a bounded pool of workers and a limit on the rate of announces,
+        only a few more than workers are read from ipldhashes at a time so it can be a long iterator e.g. from HashStore.dhtbucket
+
+        : param ipldhashes  Iterable of hashes of form z... or Q....
+        : param workers     Number of announces in parallel, default config["ipfs"]["announceworkers"]
+        : param rate        Maximum announces per second, default config["ipfs"]["announcerate"]
+        : return            Number successfully announced
+        """
+        workers = workers or config["ipfs"]["announceworkers"]
+        limiter = RateLimiter(rate or config["ipfs"]["announcerate"])
+
+        def announce(ipldhash):
+            limiter.wait()
+            try:
+                self.announcedht(ipldhash)
+                return 1
+            except requests.exceptions.RequestException as e:
+                logging.warning("Transportipfs.announcedht failed for {}: {}".format(ipldhash, e))
+                return 0
+
+        announced = 0
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="announcedht") as executor:
+            pending = set()
+            for ipldhash in ipldhashes:
+                if len(pending) >= 2 * workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    announced += sum(f.result() for f in done)
+                pending.add(executor.submit(announce, ipldhash))
+            announced += sum(f.result() for f in wait(pending).done)
+        return announced
+
     def rawstore(self, data=None, verbose=False, returns=None, pinggateway=True, mimetype=None, **options):
         """
         Store the data on IPFS
@@ -98,7 +135,7 @@ class TransportIPFS(Transport):
         if verbose: logging.debug("Posting IPFS to {0}".format(ipfsurl))
         headers = { "Connection": "keep-alive"}
         try:
-            res = requests.post(ipfsurl, headers=headers, params={ 'trickle': 'true', 'pin': 'true'}, files={'file': ('', data, mimetype)}).json()
+            res = HTTPSessions.session().post(ipfsurl, headers=headers, params={ 'trickle': 'true', 'pin': 'true'}, files={'file': ('', data, mimetype)}).json()
         #except ConnectionError as e:  # TODO - for some reason this never catches even though it reports "ConnectionError" as the class
         except requests.exceptions.ConnectionError as e:  # Alternative - too broad a catch but not expecting other errors
             pass
@@ -106,7 +143,7 @@ class TransportIPFS(Transport):
         logging.debug("IPFS result={}".format(res))
         ipldhash = res['Hash']
         if pinggateway:
-            self.pinggateway(ipldhash)
+            JobQueue.enqueue("pinggateway", ipldhash)   # In background if config jobs.enabled
         return "ipfs:/ipfs/{}".format(ipldhash)
 
     def store(self, data=None, urlfrom=None, verbose=False, mimetype=None, pinggateway=True, returns=None, **options):
@@ -127,14 +164,16 @@ class TransportIPFS(Transport):
             headers = { "Connection": "keep-alive"}
             if urlfrom and config["ipfs"].get("url_urlstore"):              # On a machine with urlstore and passed a url
                     ipfsurl = config["ipfs"]["url_urlstore"]
-                    res = requests.get(ipfsurl, headers=headers, params={'arg': urlfrom, 'trickle': 'true'}).json()
+                    res = HTTPSessions.session().get(ipfsurl, headers=headers, params={'arg': urlfrom, 'trickle': 'true'}).json()
                     ipldhash = res['Key']
                     # Now pin to gateway or JS clients wont see it  TODO remove this when client relay working (waiting on IPFS)
                     # This next line is to get around bug in IPFS propogation
                     # See https://github.com/ipfs/js-ipfs/issues/1156
                     if pinggateway:
-                        self.pinggateway(ipldhash)
+                        JobQueue.enqueue("pinggateway", ipldhash)   # In background if config jobs.enabled
                     url = "ipfs:/ipfs/{}".format(ipldhash)
+            elif urlfrom and not data and config["ipfs"].get("streamadd"):   # Add without holding it all in memory
+                url = self.storeurlstream(urlfrom, pinggateway=pinggateway, verbose=verbose)["url"]
             else:   # Need to store via "add"
                 if not data or not mimetype and urlfrom:
                     (data, mimetype) = httpget(urlfrom, wantmime=True) # This is a fetch from somewhere else before putting to gateway
@@ -149,3 +188,79 @@ class TransportIPFS(Transport):
         except (requests.exceptions.ConnectionError) as e:
             raise IPFSException(message="IPFS refused connection;"+str(e))
 
+    def storestream(self, chunks, mimetype=None, pinggateway=True, verbose=False):
+        """
+        Store data on IPFS via "add" without holding it in memory, the chunks are sent as they are read,
+        in a chunked multipart body.
+
+        :param chunks:      iterator of bytes e.g. from httpgetstream
+        :param mimetype:    of the data
+        :param pinggateway: True to ping ipfs.io as for store
+        :raises:            IPFSException if cant reach server or doesnt return JSON, or whatever chunks raises (unchanged)
+        :return:            url of data e.g. ipfs:/ipfs/Qm123abc
+        """
+        ipfsurl = config["ipfs"]["url_add_data"]
+        boundary = uuid.uuid4().hex
+        upstreamerrors = []     # Exception reading chunks, which aborts the add but isnt a failure of IPFS
+
+        def body():
+            yield '--{}\r\nContent-Disposition: form-data; name="file"; filename=""\r\nContent-Type: {}\r\n\r\n'\
+                .format(boundary, mimetype or "application/octet-stream").encode('utf-8')
+            try:
+                for chunk in chunks:
+                    if chunk:
+                        yield chunk
+            except Exception as e:
+                upstreamerrors.append(e)
+                raise
+            yield '\r\n--{}--\r\n'.format(boundary).encode('utf-8')
+
+        if verbose: logging.debug("Streaming to IPFS at {0}".format(ipfsurl))
+        headers = {"Connection": "keep-alive", "Content-Type": "multipart/form-data; boundary={}".format(boundary)}
+        res = None
+        try:
+            res = HTTPSessions.session().post(ipfsurl, headers=headers, params={'trickle': 'true', 'pin': 'true'}, data=body()).json()
+            ipldhash = res['Hash']
+        except requests.exceptions.ConnectionError as e:
+            if upstreamerrors:  # e.g. archive.org dropped the connection, requests reports that as a ConnectionError too
+                raise upstreamerrors[0]
+            raise IPFSException(message="Unable to stream to local IPFS at {} it is probably not running or wedged;{}".format(ipfsurl, e))
+        except (KeyError, TypeError) as e:
+            raise IPFSException(message="Bad format back from IPFS - no Hash field" + json.dumps(res))
+        except json.decoder.JSONDecodeError as e:
+            raise IPFSException(message="Bad format back from IPFS - not JSON;"+str(e))
+        logging.debug("IPFS result={}".format(res))
+        if pinggateway:
+            JobQueue.enqueue("pinggateway", ipldhash)   # In background if config jobs.enabled
+        return "ipfs:/ipfs/{}".format(ipldhash)
+
+    def storeurlstream(self, url, pinggateway=True, verbose=False):
+        """
+        Fetch url and add it to IPFS in one pass, the download is read ahead (config["ipfs"]["streamreadahead"] chunks)
+        while the upload proceeds, and the SHA1 computed on the way through, so memory is constant whatever the size.
+
+        :param url:         to fetch e.g. https://archive.org/download/foo/bar.mp4
+        :param pinggateway: True to ping ipfs.io as for store
+        :raises:            IPFSException, or TransportURLNotFound etc as for httpgetstream
+        :return:            { url: ipfs:/ipfs/Q..., sha1hex: of the content, mimetype: from upstream, size: bytes }
+        """
+        status, headers, chunks = httpgetstream(url)
+        sha1 = hashlib.sha1()
+        res = {"mimetype": headers.get("Content-Type"), "size": 0}
+
+        def hashed():   # Runs in the readahead thread, so hashing overlaps with the upload as well
+            for chunk in chunks:
+                sha1.update(chunk)
+                res["size"] += len(chunk)
+                yield chunk
+
+        res["url"] = self.storestream(readahead(hashed(), config["ipfs"]["streamreadahead"]), mimetype=res["mimetype"],
+                                      pinggateway=pinggateway, verbose=verbose)
+        res["sha1hex"] = sha1.hexdigest()
+        return res
+
+
+
+# Jobs that can be run in the background (see JobQueue)
+JobQueue.register("pinggateway", lambda ipldhash: TransportIPFS().pinggateway(ipldhash))
+JobQueue.register("announcedht", lambda ipldhash: TransportIPFS().announcedht(ipldhash))
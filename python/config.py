@@ -11,6 +11,7 @@ config = {
         "url_metadata": "https://archive.org/metadata/",
         "url_btihsearch": 'https://archive.org/advancedsearch.php?fl=identifier,btih&output=json&rows=1&q=btih:',
         "url_sha1search": "http://archive.org/services/dwhf.php?key=sha1&val=",
+        "titlemissingttl": 3600,    # Seconds to remember that a collection has no title, so it isnt searched for on every request
     },
     "ipfs": {
         "url_add_data": "http://localhost:5001/api/v0/add", # FOr use on gateway or if run "ipfs daemon" on test machine
@@ -18,6 +19,28 @@ config = {
         # "url_add_url": "http://localhost:5001/api/v0/add",  #TODO-IPFS move uses of url_add_data to urladd when its working
         "url_urlstore": "http://localhost:5001/api/v0/urlstore/add",    # Should have "ipfs daemon" running locally
         "url_dht_provide": "http://localhost:5001/api/v0/dht/provide",
+        "announceworkers": 16,  # Parallel DHT announces by TransportIPFS.announcedhtmany
+        "announcerate": 50,     # Maximum DHT announces per second
+        "streamadd": True,      # Add from a url by streaming it through (TransportIPFS.storeurlstream) rather than fetching it into memory first
+        "streamreadahead": 16,  # Chunks (of httpserver.chunksize) of download read ahead of the upload when streaming
+    },
+    "jobs": {   # Background jobs for slow IPFS side-effects of requests, see JobQueue
+        "enabled": False,       # If False jobs are run immediately in the request, as before
+        "workers": 4,           # Threads running jobs in each gateway process, 0 if run by jobworker.py instead
+        "workerprocessthreads": 8,  # Threads running jobs in jobworker.py
+        "attempts": 5,          # Tries before giving up on a job
+        "backoff": 10,          # Seconds before first retry, doubled for each retry after that
+        "lease": 300,           # Seconds a worker holds a job for at most, if it dies another worker takes it after this
+        "pollinterval": 1,      # Seconds an idle worker waits before looking for jobs again
+        "batch": 100,           # Due jobs a worker reads each time it looks
+    },
+    "bulkload": {   # BulkLoader, used by bulkload_ipfs.py
+        "metadataworkers": 4,   # Threads fetching item metadata
+        "fetchworkers": 16,     # Threads fetching file content from archive.org, unused if ipfs.streamadd as then addworkers fetch
+        "addworkers": 8,        # Threads adding to IPFS
+        "recordworkers": 2,     # Threads recording hashes in IPLDHashService
+        "queuedepth": 32,       # Waiting in front of each stage, bounds memory
+        "reportinterval": 10,   # Seconds between logging throughput
     },
     "gateway": {
         "url_metadata": "https://https://dweb.me/arc/archive.org/metadata/",
@@ -28,6 +51,87 @@ config = {
     "httpserver": {  # Configuration used by generic HTTP server
         "favicon_url": "https://dweb.me/favicon.ico",
         "root_path": "info",
+        "chunksize": 65536,     # Size of chunks when streaming a response, bounds memory per download
+        "server": "threaded",   # "threaded" for a thread per connection, "pooled" for a fixed pool of workers (PooledHTTPServer), or "async" (ServerAsync)
+        "threads": 64,          # Worker threads in pooled server
+        "queuedepth": 256,      # Connections that can wait for a worker in pooled server, beyond that get a 503
+        "retryafter": 5,        # Seconds for Retry-After header on a 503 when too busy
+        "idletimeout": 30,      # Seconds an idle keep-alive connection can hold a worker in pooled server, or is kept open by async server
+        "asyncworkers": 64,     # Threads running handlers for the async server (ServerAsync), idle connections and upstream streams dont use one
+        "upstreamtimeout": 60,  # Seconds the async server waits for upstream to connect, send headers, or send more of a stream
+        "processes": 1,         # If more than 1, fork this many worker processes sharing the port (ServerBase.PreforkMaster)
+        "draintimeout": 600,    # Seconds a stopping worker process waits for in-flight downloads before exiting
+    },
+    "fanout": {     # Pool shared by requests for concurrent sub-calls, see miscutils.FanOut
+        "workers": 32,          # Threads in the pool, in each process
+        "timeout": 5,           # Default seconds to wait, e.g. for enrichment of a search page, after which results are returned without the slow parts
+    },
+    "httppools": {  # Keep-alive connection pools for upstream HTTP, by url prefix, see miscutils.HTTPSessions
+        "default": {"pool_connections": 10, "pool_maxsize": 10},  # pool_connections is number of hosts, pool_maxsize is connections per host
+        "https://archive.org/": {"pool_maxsize": 50},
+        "http://localhost:5001/": {"pool_maxsize": 20},  # IPFS
+        "http://dx.doi.org/": {"pool_maxsize": 10},
+    },
+    "hashstore": {  # See HashStore.py
+        "backend": "redis",     # "redis", "sqlite" for an embedded store without a redis server, or "sharded", see HashStoreBackends.py
+        "redis": {"host": "localhost", "port": 6379, "db": 0},
+        "sqlite": {"path": "/usr/local/dweb-gateway/.cache/hashstore.sqlite"},  # ":memory:" for tests and benchmarks
+        "sharded": {    # Consistent hash across redis nodes, see HashStoreBackends.ShardedBackend
+            "nodes": [{"host": "localhost", "port": 6379, "db": 0}],
+            "vnodes": 160,          # Points on the ring per node
+            "previousnodes": None,  # When adding a node, set this to the old nodes, run maintenance.reshard, then set back to None
+        },
+        "ttl": {    # Seconds before fields expire, fields not listed (e.g. location, mimetype, ipldhash) are permanent, as are entries set before their field was listed
+            "title": 7 * 86400,             # Collection titles
+            "magnetlink": 30 * 86400,       # Tracker lists change
+            "thumbnailipfs": 30 * 86400,
+        },
+        "permanentprefixes": ["btih:"],     # Keys whose fields never expire, btih:<hash> => magnetlink cant be looked up again
+        "compact": {    # Compact encoding of keys, fields and values, needs a redis or sharded backend, see HashStore
+            "enabled": False,
+            "fallback": True,   # Also read the old layout, set False once maintenance.compact has finished
+            "fields": {"location": "l", "mimetype": "m", "ipld": "d", "ipldhash": "i", "thumbnailipfs": "t", "magnetlink": "g", "title": "n"},
+            "prefixes": {   # Per field, list of prefixes stripped from values, do not reorder or remove any once in use
+                "location": ["https://archive.org/download/", "http://archive.org/download/"],
+                "thumbnailipfs": ["ipfs:/ipfs/"],
+                "magnetlink": ["magnet:?xt=urn:btih:"],
+            },
+        },
+        "dhtindex": {   # Sets of IPFS hashes by round letter, so maintenance.resetipfs(announcedht=True) only reads its round
+            "enabled": True,
+            "fields": ["ipldhash", "thumbnailipfs"],
+            "prefix": "dht:",   # Sets are dht:<7th character of IPFS hash>
+        },
+        "nearcache": {  # In-process caches in front of redis
+            "enabled": True,
+            "invalidate": True,         # Publish sets and deletes on channel, so other processes (e.g. maintenance) dont leave stale copies near cached
+            "channel": "hashstore:invalidate",
+            "reconnectinterval": 5,     # Seconds before resubscribing to channel after losing the connection
+            "services": {   # Fields cached, with number of keys and seconds each is kept
+                "location": {"size": 20000, "ttl": 3600},
+                "mimetype": {"size": 20000, "ttl": 3600},
+                "ipldhash": {"size": 20000, "ttl": 3600},
+                "magnetlink": {"size": 5000, "ttl": 3600},
+                "title": {"size": 5000, "ttl": 3600},
+                "thumbnailipfs": {"size": 5000, "ttl": 3600},
+            },
+        },
+    },
+    "metadatacache": {  # Cache of archive.org/metadata/<itemid>, see Archive.ArchiveItem.fetchmetadata
+        "enabled": True,
+        "size": 1000,           # Items held in each process
+        "ttl": 300,             # Seconds metadata is used without checking archive.org
+        "revalidate": True,     # After ttl, check item_last_updated and only refetch if the item changed
+        "redis": True,          # Share the cache between processes and servers via redis
+        "maxstale": 86400,      # Seconds redis keeps an entry, so it can be revalidated rather than refetched
+    },
+    "singleflight": {  # Coalescing of identical concurrent requests, see Singleflight.py
+        "enabled": True,
+        "redis": False,         # True to also coalesce across processes e.g. when httpserver.processes > 1
+        "waittimeout": 60,      # Seconds to wait for another caller's result before doing it ourselves
+        "locktimeout": 60,      # Seconds before a redis lock expires, in case its holder died
+        "resultttl": 5,         # Seconds a result is left in redis for other processes
+        "pollinterval": 0.05,   # Seconds between checks for another process's result
     },
     "domains": {
         # This is also name of directory in /usr/local/dweb-gateway/.cache/table, if change this then can safely rename that directory to new name to retain metadata saved
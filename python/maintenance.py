@@ -1,20 +1,69 @@
 import logging
 # This is run every 10 minutes by Cron (10 * 58 = 580 ~ 10 hours)
 from python.config import config
-import redis
 import base58
-from .HashStore import StateService
+import itertools
+import time
+from .HashStore import HashStore, StateService
 from .TransportIPFS import TransportIPFS
 
 logging.basicConfig(**config["logging"])    # For server
 
+def batchmaintenance(fields, action, predicate=None, checkpoint=None, count=1000, verbose=False):
+    """
+    Apply action to every hash in the keyspace, a page of keys at a time: one SCAN, one pipeline reading fields of all
+    the keys, and one pipeline deleting whatever action asks for, rather than several round trips per key.
+
+    :param fields:      list of field names action is interested in e.g. ["magnetlink"]
+    :param action:      f(multihash, values) called for each key matching predicate, values is { field: value or None },
+                        returns list of fields to delete (or None), can have other side effects e.g. announce to IPFS
+    :param predicate:   f(multihash, values) => True if action should be called, default is if any of fields are set
+    :param checkpoint:  If set, a name under which the scan cursor is saved in StateService after each page, so that an
+                        interrupted run with the same checkpoint resumes where it left off
+    :param count:       Keys per page
+    :return:            { scanned, matched, deleted }
+    """
+    r = HashStore.redis()
+    predicate = predicate or (lambda multihash, values: any(values.values()))
+    dhtfields = config["hashstore"]["dhtindex"]["fields"] if config["hashstore"]["dhtindex"]["enabled"] else ()
+    statefield = checkpoint and "MaintenanceCursor_" + checkpoint
+    cursor = (statefield and StateService.get(statefield, verbose)) or 0
+    if cursor:
+        logging.info("Maintenance {} resuming at cursor {}".format(checkpoint, cursor))
+    stats = {"scanned": 0, "matched": 0, "deleted": 0}
+    while True:
+        cursor, keys = r.scan(cursor, count=count)
+        deletes = []
+        unindex = []
+        for key, values in zip(keys, HashStore.scanfields(keys, fields)):
+            if values is None:  # Not a hash
+                continue
+            multihash = HashStore.multihashofkey(key)
+            if predicate(multihash, values):
+                stats["matched"] += 1
+                for field in action(multihash, values) or []:
+                    deletes.append((multihash, field))
+                    if field in dhtfields and values.get(field):
+                        unindex.append(values[field])
+        HashStore.delete_many(deletes, verbose=verbose)
+        HashStore.dhtunindex(unindex)
+        stats["scanned"] += len(keys)
+        stats["deleted"] += len(deletes)
+        if statefield:
+            StateService.set(statefield, cursor, verbose)   # 0 when finished, so next run starts again
+        if verbose: logging.debug("Maintenance {} {}".format(checkpoint or "", stats))
+        if not cursor:
+            break
+    return stats
+
 def resetipfs(removeipfs=False, reseedipfs=False, removemagnet=False, announcedht=False, verbose=False, fixbadurls=False):
     """
     Loop over and "reset" ipfs
     :param removeipfs:      If set will remove all cached pointers to IPFS - note this is part of a three stage process see notes in cleanipfs.sh
     :param reseedipfs:      If set we will ping the ipfs.io gateway to make sure it knows about our files, this isn't used any more
     :param removemagnet:    Remove all cached magnet links (e.g. to add a new default tracker
-    :param announcedht:     Announce our files to the DHT - currently run by cron regularly
+    :param announcedht:     Announce our files to the DHT - currently run by cron regularly, 1/58th each time, read from the
+                            DHT index (see HashStore) if config["hashstore"]["dhtindex"]["enabled"] rather than by scanning
     :param verbose:         Generate verbose debugging - the code below could use more of this
     :param fixbadurls:      Removes some historically bad URLs, this was done so isn't needed again - just left as a modifyable stub.
     :return:
@@ -24,54 +73,163 @@ def resetipfs(removeipfs=False, reseedipfs=False, removemagnet=False, announcedh
         "zb2rhiSEszTZ4YuY7GJScy6jKZTJuR97MLs7KSe2nKLHwb4A7", # texts
         "zb2rhk2FYVEy5VRHmaEzor7NuA936E8GGaokZFurKmUE959zx", # movies
     ]
-    r = redis.StrictRedis(host="localhost", port=6379, db=0, decode_responses=True)
-    reseeded = 0
-    removed = 0
-    magremoved = 0
-    total = 0
-    withipfs = 0
-    withmagnet = 0
-    announceddht = 0
+    counts = {"reseeded": 0, "removed": 0, "magremoved": 0, "withipfs": 0, "withmagnet": 0, "announceddht": 0}
     if announcedht:
         dhtround = ((int(((StateService.get("LastDHTround", verbose)) or 0)) + 1) % 58)
         StateService.set("LastDHTround", dhtround, verbose)
         dhtroundletter = base58.b58encode_int(dhtround)
+        if isinstance(dhtroundletter, bytes):   # base58 >= 1.0 returns bytes
+            dhtroundletter = dhtroundletter.decode('ascii')
         logging.debug("DHT round: {}".format(dhtroundletter))
-    for i in r.scan_iter():
-        total = total+1
-        if fixbadurls:
-            url = r.hget(i, "url")
-            if urls.startswith("ipfs:"):
-                logging.debug("Would delete {} .url= {}".format(i,url))
-                #r.hdel(i, "url")
-        for k in ["magnetlink"]:
-            magnetlink = r.hget(i, k)
-            if magnetlink:
-                withmagnet = withmagnet + 1
-                if removemagnet:
-                    r.hdel(i, k)
-                    magremoved = magremoved + 1
+        if config["hashstore"]["dhtindex"]["enabled"] and not (StateService.get("DHTindexBuilt", verbose)
+                                                                and HashStore.redis().scard(HashStore.dhtbucketkey(dhtroundletter))):
+            # Until builddhtindex has finished, the index only has hashes set since it was enabled
+            logging.warning("DHT index not built or empty for round {}, announcing by scanning instead, run maintenance.builddhtindex"
+                            .format(dhtroundletter))
+        elif config["hashstore"]["dhtindex"]["enabled"]:
+            counts["announceddht"] = TransportIPFS().announcedhtmany(HashStore.dhtbucket(dhtroundletter))
+            announcedht = False     # Done, dont need to check each key in scan below
+            if not (removeipfs or reseedipfs or removemagnet or fixbadurls):
+                logging.debug("Announced {} from DHT index".format(counts["announceddht"]))
+                return
 
+    def action(multihash, values):
+        delete = []
+        if fixbadurls:
+            url = values.get("url")
+            if url and url.startswith("ipfs:"):
+                logging.debug("Would delete {} .url= {}".format(multihash, url))
+                #delete.append("url")
+        if values.get("magnetlink"):
+            counts["withmagnet"] += 1
+            if removemagnet:
+                delete.append("magnetlink")
+                counts["magremoved"] += 1
         for k in [ "ipldhash", "thumbnailipfs" ]:
-            ipfs = r.hget(i, k)
-            #print(i, ipfs)
+            ipfs = values.get(k)
             if ipfs:
-                withipfs = withipfs + 1
-                ipfs = ipfs.replace("ipfs:/ipfs/", "")  # The hash
+                counts["withipfs"] += 1
+                ipfs = HashStore.ipfshash(ipfs)  # The hash
                 if removeipfs or (ipfs in knownbadhashes):
-                    r.hdel(i, k)
-                    removed = removed + 1
+                    delete.append(k)
+                    counts["removed"] += 1
                 if reseedipfs:
-                    #logging.debug("Reseeding {} {}".format(i, ipfs))  # Logged in TransportIPFS
+                    #logging.debug("Reseeding {} {}".format(multihash, ipfs))  # Logged in TransportIPFS
                     TransportIPFS().pinggateway(ipfs)
-                    reseeded = reseeded + 1
-                if announcedht:
-                    #print("Testing ipfs {} .. {} from {}".format(ipfs[6],dhtroundletter,ipfs))
-                    if dhtroundletter == ipfs[6]:  # Compare far enough into string to be random
-                        # logging.debug("Announcing {} {}".format(i, ipfs))  # Logged in TransportIPFS
-                        TransportIPFS().announcedht(ipfs)
-                        announceddht = announceddht + 1
-    logging.debug("Scanned {}, withipfs {}, deleted {}, reseeded {}, announced {}, magremoved {}".format(total, withipfs, removed, reseeded, announceddht, magremoved))
+                    counts["reseeded"] += 1
+                if announcedht and dhtroundletter == ipfs[6]:  # Compare far enough into string to be random
+                    TransportIPFS().announcedht(ipfs)
+                    counts["announceddht"] += 1
+        return delete
+
+    fields = ["magnetlink", "ipldhash", "thumbnailipfs"] + (["url"] if fixbadurls else [])
+    # Checkpoint per mode, so an interrupted run only resumes a run doing the same thing
+    modes = [name for name, flag in (("removeipfs", removeipfs), ("reseedipfs", reseedipfs), ("removemagnet", removemagnet),
+                                     ("fixbadurls", fixbadurls)) if flag]
+    stats = batchmaintenance(fields, action, checkpoint=None if announcedht else "resetipfs:" + ",".join(modes), verbose=verbose)
+    logging.debug("Scanned {}, withipfs {}, deleted {}, reseeded {}, announced {}, magremoved {}".format(
+        stats["scanned"], counts["withipfs"], counts["removed"], counts["reseeded"], counts["announceddht"], counts["magremoved"]))
+
+def builddhtindex(verbose=False):
+    """
+    Backfill the DHT index (see HashStore) from the existing keyspace, run once when enabling config["hashstore"]["dhtindex"],
+    the index is maintained as hashes are set after that. Safe to rerun.
+    """
+    r = HashStore.redis()
+    fields = config["hashstore"]["dhtindex"]["fields"]
+    total = 0
+    indexed = 0
+    keys = r.scan_iter(count=1000)
+    while True:
+        batch = list(itertools.islice(keys, 1000))
+        if not batch:
+            break
+        total += len(batch)
+        pipe = r.pipeline(transaction=False)
+        for key in batch:
+            pipe.type(key)
+        batch = [HashStore.multihashofkey(key) for key, keytype in zip(batch, pipe.execute()) if keytype == "hash"]   # Skip e.g. the dht: sets themselves
+        ipfshashes = [v for v in HashStore.get_many([(key, field) for key in batch for field in fields]) if v]
+        HashStore.dhtindex(ipfshashes)
+        indexed += len(ipfshashes)
+        if verbose: logging.debug("DHT index scanned {} keys, indexed {}".format(total, indexed))
+    logging.info("DHT index scanned {} keys, indexed {} hashes".format(total, indexed))
+    StateService.set("DHTindexBuilt", int(time.time()), verbose)   # resetipfs uses the index from now on
+
+def reshard(verbose=False):
+    """
+    Move keys to their node after adding (or removing) a redis node with the "sharded" backend.
+    Set config["hashstore"]["sharded"]["previousnodes"] to the old nodes and "nodes" to the new ones, restart the gateway
+    (which then reads keys not yet moved from their old node), run this, then set previousnodes back to None.
+    Safe to run while serving, and to rerun if interrupted.
+    """
+    r = HashStore.redis()
+    if not getattr(r, "previousring", None):
+        logging.error("reshard needs the sharded backend with previousnodes set")
+        return
+    total = 0
+    moved = 0
+    for source in set(r.previousconnections):
+        for key in source.scan_iter(count=1000):
+            total = total + 1
+            if r.migrate(key, source):
+                moved = moved + 1
+                if verbose: logging.debug("Moved {}".format(key))
+    logging.info("Resharding scanned {}, moved {}".format(total, moved))
+
+def compact(verbose=False):
+    """
+    Migrate the keyspace to the compact encoding (see HashStore), run after setting config["hashstore"]["compact"]["enabled"]
+    and restarting the gateway (which reads the old layout as well until then). Safe to run while serving, and to rerun.
+    """
+    if not config["hashstore"]["compact"]["enabled"]:
+        logging.error("compact needs config hashstore.compact.enabled")
+        return
+    r = HashStore.redis()
+    total = 0
+    changed = 0
+    for key in r.scan_iter(count=1000):
+        total = total + 1
+        if r.type(key) == "hash" and HashStore.compactkey(key):
+            changed = changed + 1
+            if verbose: logging.debug("Compacted {}".format(HashStore.multihashofkey(key)))
+    logging.info("Compact scanned {}, changed {}".format(total, changed))
+
+def measurecompact(sample=10000, verbose=False):
+    """
+    Measure how much memory the compact encoding would save, by writing compact copies of a sample of hashes and comparing
+    redis MEMORY USAGE. Works whether or not compact is enabled, needs the redis or sharded backend.
+
+    :param sample:  Number of hashes to measure
+    :return:        { keys, bytes, compactbytes }
+    """
+    savedenabled = config["hashstore"]["compact"]["enabled"]
+    config["hashstore"]["compact"]["enabled"] = True    # So compactencoding encodes, only affects this process
+    r = HashStore.redis()
+    tempprefix = "measurecompact:"
+    res = {"keys": 0, "bytes": 0, "compactbytes": 0}
+    try:
+        for key in r.scan_iter(count=1000):
+            if res["keys"] >= sample:
+                break
+            if key.startswith(tempprefix) or r.type(key) != "hash":
+                continue
+            fields = r.hgetall(key)
+            newkey, mapping = HashStore.compactencoding(key, fields)
+            if newkey == key and mapping == fields:
+                continue    # Already compact
+            r.hset(tempprefix + newkey, mapping=mapping)
+            try:
+                res["bytes"] += r.memory_usage(key, samples=0)
+                res["compactbytes"] += r.memory_usage(tempprefix + newkey, samples=0) - len(tempprefix.encode('utf-8'))
+                res["keys"] += 1
+            finally:
+                r.delete(tempprefix + newkey)
+    finally:
+        config["hashstore"]["compact"]["enabled"] = savedenabled
+    logging.info("Compact encoding of {} keys: {} bytes => {} bytes ({:.0%})".format(
+        res["keys"], res["bytes"], res["compactbytes"], res["compactbytes"] / res["bytes"] if res["bytes"] else 1))
+    return res
 
 # To announce DHT under cron
 #logging.basicConfig(**config["logging"])    # For server
@@ -4,7 +4,14 @@ This is a place to put miscellaneous utilities, not specific to this project
 import json  # Note dont "from json import dumps" as clashes with overdefined dumps below
 from datetime import datetime
 import requests
+from requests.adapters import HTTPAdapter
+from http.cookiejar import DefaultCookiePolicy
+import threading
+import queue
 import logging
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
 from magneturi import bencode
 import base64
 import hashlib
@@ -73,17 +80,232 @@ def json_default(obj): #TODO-BACKPORT FROM GATEWAY TO DWEB - moved from Transpor
         raise TypeError("Type {0} not serializable".format(obj.__class__.__name__)) from e
 
 
+class LRUCache(object):
+    """
+    Thread safe, in-process, Least Recently Used cache with optional expiry
+
+    Fields:
+    maxsize:    Number of entries kept, least recently used are dropped beyond this
+    ttl:        Default seconds an entry is valid for, None for no expiry
+
+    Methods:
+    get(key)                Return value or None if not present or expired
+    set(key, value, ttl)    Store value, ttl overrides the default
+    delete(key)             Forget key if present
+    clear()                 Forget everything
+    """
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()   # key => (expiry or None, value), most recently used last
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] is not None and entry[0] < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl if ttl is not None else self.ttl
+        with self._lock:
+            self._entries[key] = (time.time() + ttl if ttl is not None else None, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RateLimiter(object):
+    """
+    Thread safe limit on how often something is done, callers of wait() are spaced at least 1/rate seconds apart
+
+    Fields:
+    rate:   Calls per second, None or 0 for no limit
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._next = 0  # time.monotonic() when next call allowed
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + 1.0 / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+
+class FanOut(object):
+    """
+    Run independent calls concurrently on a pool of threads shared by all requests, and wait for them up to a deadline.
+    The pool is bounded (config["fanout"]["workers"]) so a burst of requests cant start unlimited threads.
+    Calls made from inside the pool run inline, so a nested fan-out cant deadlock waiting for the pool it is using.
+
+    Class Fields:
+    _executor:  ThreadPoolExecutor created on first use
+    _local:     Marks threads of the pool
+
+    Class methods:
+    run(calls, timeout, required)   Run { key: function }, return { key: result } for those that finished in time, or are required
+    reset()                 Drop the pool, e.g. in a newly forked process
+    """
+    _executor = None
+    _lock = threading.Lock()
+    _local = threading.local()
+
+    @classmethod
+    def run(cls, calls, timeout=None, required=()):
+        """
+        :param calls:       { key: function of no arguments }
+        :param timeout:     Seconds to wait for all of them, default config["fanout"]["timeout"]
+        :param required:    Keys of calls the result cant do without, these are waited for however long they take
+        :return:            { key: result } for calls that finished in time (or were required) without raising,
+                            others are logged and left out
+        """
+        timeout = config["fanout"]["timeout"] if timeout is None else timeout
+        if getattr(cls._local, "inpool", False):
+            return cls._runinline(calls)
+        if not calls:
+            return {}
+        if not cls._executor:
+            with cls._lock:
+                if not cls._executor:
+                    cls._executor = ThreadPoolExecutor(max_workers=config["fanout"]["workers"], thread_name_prefix="fanout")
+        futures = {cls._executor.submit(cls._call, func): key for key, func in calls.items()}
+        done, notdone = wait(futures, timeout=timeout)
+        waitfor = [f for f in notdone if futures[f] in required]
+        if waitfor:
+            done |= wait(waitfor)[0]
+            notdone -= done
+        for f in notdone:
+            f.cancel()  # Those not started yet, those running finish in the background (and e.g. cache their results)
+        if notdone:
+            logging.debug("FanOut {} of {} calls not done in {}s".format(len(notdone), len(futures), timeout))
+        res = {}
+        for f in done:
+            try:
+                res[futures[f]] = f.result()
+            except Exception as e:
+                logging.error("FanOut call {} failed: {}".format(futures[f], e))
+        return res
+
+    @classmethod
+    def _call(cls, func):
+        cls._local.inpool = True
+        return func()
+
+    @staticmethod
+    def _runinline(calls):
+        res = {}
+        for key, func in calls.items():
+            try:
+                res[key] = func()
+            except Exception as e:
+                logging.error("FanOut call {} failed: {}".format(key, e))
+        return res
+
+    @classmethod
+    def reset(cls):
+        """
+        Forget the pool, e.g. in a newly forked process where its threads dont exist
+        """
+        cls._executor = None
+        cls._lock = threading.Lock()
+
+
+class HTTPSessions(object):
+    """
+    Shared pools of keep-alive connections for all upstream HTTP (archive.org, local IPFS, dx.doi.org etc)
+    so that TCP and TLS connections are reused across requests and threads, rather than one per call as with requests.get
+
+    Pool sizes per url prefix are in config["httppools"], urllib3 keeps a pool per host under each prefix.
+
+    Class Fields:
+    _session:   requests.Session shared by all threads once created by session()
+
+    Class methods:
+    session()   Return the shared session, creating it on first use
+    reset()     Drop the session, so next call to session() makes a new one
+    stats()     Counters of connections opened and requests made per host, the difference is connections reused
+    """
+    _session = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def session(cls):
+        if not cls._session:
+            with cls._lock:
+                if not cls._session:
+                    logging.debug("HTTPSessions creating connection pools")
+                    session = requests.Session()
+                    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))  # Dont keep cookies, each request should be independent as it was with requests.get
+                    pools = config["httppools"]
+                    for prefix in ["http://", "https://"] + [p for p in pools if p != "default"]:
+                        poolconfig = mergeoptions(pools["default"], pools.get(prefix, {}))
+                        session.mount(prefix, HTTPAdapter(pool_connections=poolconfig["pool_connections"], pool_maxsize=poolconfig["pool_maxsize"]))
+                    cls._session = session
+        return cls._session
+
+    @classmethod
+    def reset(cls):
+        """
+        Forget the session, e.g. in a newly forked process which must not share the parent's connections
+        """
+        cls._session = None
+        cls._lock = threading.Lock()
+
+    @classmethod
+    def stats(cls):
+        """
+        :return: { host: { connections: n opened, requests: n made, reused: requests that didnt need new connection } }
+        """
+        res = {}
+        if cls._session:
+            for adapter in cls._session.adapters.values():
+                for key in adapter.poolmanager.pools.keys():
+                    pool = adapter.poolmanager.pools.get(key)
+                    if pool is None:  # Discarded since got the keys
+                        continue
+                    hs = res.setdefault("{}://{}:{}".format(pool.scheme, pool.host, pool.port), {"connections": 0, "requests": 0})
+                    hs["connections"] += pool.num_connections
+                    hs["requests"] += pool.num_requests
+            for hs in res.values():
+                hs["reused"] = max(hs["requests"] - hs["connections"], 0)
+        return res
+
+
 def httpget(url, wantmime=False, range=None):
     # Returns the content - i.e. bytes
     # Raises TransportFileNotFound or HTTPError TODO latter error should be caughts
-    #TODO-STREAMS future work to return a stream
+    # See httpgetstream if want to pass the content on without holding it all in memory
 
     r = None  # So that if exception in get, r is still defined and can be tested for None
     try:
         logging.debug("GET {} {}".format(url, range if range else ""))
         headers = { "Connection": "keep-alive"}
         if range: headers["range"] = range
-        r = requests.get(url, headers=headers)
+        r = HTTPSessions.session().get(url, headers=headers)
         r.raise_for_status()
         if not r.encoding or ("application/pdf" in r.headers.get('content-type')) or ("image/" in r.headers.get('content-type')):
             data = r.content  # Should work for PDF or other binary types
@@ -93,7 +315,6 @@ def httpget(url, wantmime=False, range=None):
             return data, r.headers.get('content-type')
         else:
             return data
-        #TODO-STREAM support streams in future
 
     except (requests.exceptions.RequestException, requests.exceptions.HTTPError, requests.exceptions.InvalidSchema) as e:
         if r is not None and (r.status_code == 404):
@@ -107,3 +328,119 @@ def httpget(url, wantmime=False, range=None):
             logging.error("HTTP request failed", exc_info=True)
             raise e  # For now just raise it
 
+
+# Headers from upstream that are meaningful to pass on to our client when streaming
+httpgetstream_passheaders = ["Content-Type", "Content-Length", "Content-Range", "Accept-Ranges", "Last-Modified", "ETag"]
+# .fetch(url, headers) is set by ServerAsync while it runs a handler, so that streams are fetched on its event loop
+httpgetstream_local = threading.local()
+
+def httpgetstream(url, range=None):
+    """
+    Streaming version of httpget, returns as soon as the upstream headers arrive, the content is read as the iterator is consumed.
+
+    :param url:     URL to fetch
+    :param range:   Optional value of a HTTP range header e.g. "bytes=0-1023"
+    :returns:       (status, headers, chunks) status is upstream HTTP status (e.g. 200, or 206 for a range),
+                    headers is a dict of httpgetstream_passheaders that upstream sent, chunks an iterator of bytes
+    :raises:        TransportURLNotFound, ForbiddenException or requests exceptions as for httpget
+
+    When called by a handler run by ServerAsync, the fetch is done by ServerAsync.AsyncUpstream on the event loop, and
+    chunks is an AsyncChunks that the server relays without holding a thread.
+    """
+    fetch = getattr(httpgetstream_local, "fetch", None)
+    if fetch:
+        return _httpgetstreamasync(fetch, url, range)
+    r = None  # So that if exception in get, r is still defined and can be tested for None
+    try:
+        logging.debug("GET stream {} {}".format(url, range if range else ""))
+        # identity so that Content-Length matches the bytes we pass on (requests would otherwise decompress)
+        headers = { "Connection": "keep-alive", "Accept-Encoding": "identity"}
+        if range: headers["range"] = range
+        r = HTTPSessions.session().get(url, headers=headers, stream=True)
+        r.raise_for_status()
+    except (requests.exceptions.RequestException, requests.exceptions.HTTPError, requests.exceptions.InvalidSchema) as e:
+        if r is not None:
+            r.close()
+        if r is not None and (r.status_code == 404):
+            raise TransportURLNotFound(url=url)
+        elif r is not None and (r.status_code == 403):
+            raise ForbiddenException(what=e)
+        else:
+            logging.error("HTTP request failed err={}".format(e))
+            raise e
+
+    def chunks():
+        try:
+            for chunk in r.iter_content(chunk_size=config["httpserver"]["chunksize"]):
+                yield chunk
+        finally:
+            r.close()   # Release connection, including when consumer gives up part way (generator close)
+
+    return r.status_code, {h: r.headers[h] for h in httpgetstream_passheaders if h in r.headers}, chunks()
+
+def _httpgetstreamasync(fetch, url, range):
+    """
+    httpgetstream via fetch (ServerAsync.AsyncUpstream.fetch), with the same results and errors
+    """
+    logging.debug("GET async stream {} {}".format(url, range if range else ""))
+    headers = {"Accept-Encoding": "identity"}
+    if range: headers["range"] = range
+    status, upstreamheaders, chunks = fetch(url, headers)
+    if status >= 400:
+        chunks.close()
+        if status == 404:
+            raise TransportURLNotFound(url=url)
+        elif status == 403:
+            raise ForbiddenException(what="{} for url {}".format(status, url))
+        else:
+            e = requests.exceptions.HTTPError("{} Error for url: {}".format(status, url))
+            logging.error("HTTP request failed err={}".format(e))
+            raise e
+    return status, {h: upstreamheaders[h] for h in httpgetstream_passheaders if h in upstreamheaders}, chunks
+
+def readahead(chunks, depth):
+    """
+    Consume an iterator in a background thread, up to depth items ahead of the caller, so that e.g. a download continues
+    while the previous chunks are being uploaded. Memory is bounded to depth items.
+
+    :param chunks:  iterator e.g. from httpgetstream
+    :param depth:   Maximum items held
+    :returns:       iterator of the same items, raises whatever chunks raised
+    """
+    q = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):  # Returns False if the consumer has gone away
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for chunk in chunks:
+                if not put((chunk, None)):
+                    break
+            else:
+                put((done, None))
+        except Exception as e:
+            put((done, e))
+        finally:
+            if stop.is_set() and hasattr(chunks, "close"):
+                chunks.close()  # e.g. release the connection of httpgetstream
+
+    threading.Thread(target=produce, name="readahead", daemon=True).start()
+    try:
+        while True:
+            chunk, e = q.get()
+            if e:
+                raise e
+            if chunk is done:
+                return
+            yield chunk
+    finally:
+        stop.set()  # Producer stops if consumer gives up part way
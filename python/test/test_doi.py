@@ -30,8 +30,9 @@ def test_contenthash_resolve():
     verbose=False   # True to debug
     res = _processurl(CONTENTHASHURL, verbose)  # Simulate what the server would do with the URL
     assert res["Content-type"] == "application/pdf", "Check retrieved content of expected type"
-    assert len(res["data"]) == CONTENTSIZE, "Check retrieved content of expected length"
-    multihash = Multihash(data=res["data"], code=Multihash.SHA1)
+    data = b"".join(res["data"])    # Content is streamed
+    assert len(data) == CONTENTSIZE, "Check retrieved content of expected length"
+    multihash = Multihash(data=data, code=Multihash.SHA1)
     assert multihash.multihash58 == CONTENTMULTIHASH, "Check retrieved content has same multihash58_sha1 as we expect"
     assert multihash.sha1hex == PDF_SHA1HEX, "Check retrieved content has same hex sha1 as we expect"
 
@@ -39,8 +40,9 @@ def test_sha1hexcontent_resolve():
     verbose = False  # True to debug
     res = _processurl(SHA1HEXCONTENTURL, verbose)  # Simulate what the server would do with the URL
     assert res["Content-type"] == "application/pdf", "Check retrieved content of expected type"
-    assert len(res["data"]) == CONTENTSIZE, "Check retrieved content of expected length"
-    multihash = Multihash(data=res["data"], code=Multihash.SHA1)
+    data = b"".join(res["data"])    # Content is streamed
+    assert len(data) == CONTENTSIZE, "Check retrieved content of expected length"
+    multihash = Multihash(data=data, code=Multihash.SHA1)
     assert multihash.multihash58 == CONTENTMULTIHASH, "Check retrieved content has same multihash58_sha1 as we expect"
     assert multihash.sha1hex == PDF_SHA1HEX, "Check retrieved content has same hex sha1 as we expect"
 
@@ -0,0 +1,60 @@
+import pytest
+from python.config import config
+from python.HashStore import HashStore, LocationService, MimetypeService, IPLDHashService, MagnetLinkService, ThumbnailIPFSfromItemIdService
+
+MULTIHASH = "testmultihash"
+
+
+@pytest.fixture
+def sqlitestore():
+    # Run against an in memory sqlite store, then return to whatever backend was configured
+    saved = config["hashstore"]["backend"], config["hashstore"]["sqlite"]["path"]
+    config["hashstore"]["backend"], config["hashstore"]["sqlite"]["path"] = "sqlite", ":memory:"
+    HashStore.reset()
+    yield HashStore.redis()
+    config["hashstore"]["backend"], config["hashstore"]["sqlite"]["path"] = saved
+    HashStore.reset()
+
+
+def test_sqlite_services(sqlitestore):
+    LocationService.set(MULTIHASH, "http://example.com/x")
+    assert LocationService.get(MULTIHASH) == "http://example.com/x"
+    ipldhash, = HashStore.set_many([(MULTIHASH, MimetypeService, "text/plain")], get=[(MULTIHASH, IPLDHashService)])
+    assert ipldhash is None
+    assert sqlitestore.hgetall(MULTIHASH) == {"location": "http://example.com/x", "mimetype": "text/plain"}
+    assert list(sqlitestore.scan_iter()) == [MULTIHASH]
+
+
+def test_sharded_split_key():
+    # A key part way through resharding, with some fields on its new node and some still on its previous node
+    from python.HashStoreBackends import ShardedBackend, SqliteBackend
+    old, new = {"host": "old", "port": 6379}, {"host": "new", "port": 6379}
+    r = ShardedBackend([old, new], vnodes=16, previousnodes=[old])
+    r.connections = [SqliteBackend(":memory:"), SqliteBackend(":memory:")]
+    r.previousconnections = [r.connections[0]]
+    key = next(k for k in ("key{}".format(i) for i in range(100)) if r.connection(k) is r.connections[1])
+    r.previousconnections[0].hset(key, mapping={"location": "http://example.com/x", "ipldhash": "Qmold"})
+    r.connection(key).hset(key, "ipldhash", "Qmnew")
+    assert r.hmget(key, ["location", "ipldhash", "mimetype"]) == ["http://example.com/x", "Qmnew", None]
+    assert r.hgetall(key) == {"location": "http://example.com/x", "ipldhash": "Qmnew"}
+    assert r.pipeline().hmget(key, ["location", "ipldhash"]).hget(key, "location").execute() == \
+        [["http://example.com/x", "Qmnew"], "http://example.com/x"]
+    r.pipeline().hdel(key, "location").execute()
+    assert r.hget(key, "location") is None
+    assert r.hdel(key, "ipldhash") == 2     # Removed from both nodes
+    assert r.hgetall(key) == {}
+
+
+def test_expiry(sqlitestore):
+    # Entries from before a field had a TTL, and btih: keys, never expire
+    sqlitestore.hset("btih:ABC", "magnetlink", "magnet:?xt=urn:btih:ABC")
+    sqlitestore.hset("archiveid:foo", "thumbnailipfs", "ipfs:/ipfs/Qm123")
+    assert MagnetLinkService.btihget("ABC") == "magnet:?xt=urn:btih:ABC"
+    assert HashStore.get_many([("archiveid:foo", ThumbnailIPFSfromItemIdService)]) == ["ipfs:/ipfs/Qm123"]
+    MagnetLinkService.btihset("DEF", "magnet:?xt=urn:btih:DEF")
+    assert sqlitestore.hgetall("btih:DEF") == {"magnetlink": "magnet:?xt=urn:btih:DEF"}
+    MagnetLinkService.archiveidset("bar", "magnet:?xt=urn:btih:DEF")
+    assert "magnetlink_x" in sqlitestore.hgetall("archiveid:bar")
+    sqlitestore.hset("archiveid:bar", "magnetlink_x", "1")     # Expired
+    HashStore._nearcache("magnetlink").clear()
+    assert MagnetLinkService.archiveidget("bar") is None
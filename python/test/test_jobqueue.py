@@ -0,0 +1,69 @@
+import pytest
+from python.config import config
+from python.HashStore import HashStore
+from python.JobQueue import JobQueue
+
+calls = []
+
+
+@pytest.fixture
+def jobqueue():
+    # Queue jobs in an in memory sqlite store, then return to whatever was configured
+    saved = config["hashstore"]["backend"], config["hashstore"]["sqlite"]["path"], dict(config["jobs"])
+    config["hashstore"]["backend"], config["hashstore"]["sqlite"]["path"] = "sqlite", ":memory:"
+    config["jobs"].update({"enabled": True, "attempts": 2, "backoff": 0})
+    HashStore.reset()
+    del calls[:]
+    JobQueue.register("testjob", lambda x: calls.append(x))
+    JobQueue.register("testfail", lambda x: calls.append(1 / x))
+    yield HashStore.redis()
+    config["hashstore"]["backend"], config["hashstore"]["sqlite"]["path"] = saved[:2]
+    config["jobs"].update(saved[2])
+    HashStore.reset()
+
+
+def test_enqueue_inline():
+    assert not config["jobs"]["enabled"]
+    calls[:] = []
+    JobQueue.register("testjob", lambda x: calls.append(x) or x)
+    assert JobQueue.enqueue("testjob", 1) == 1
+    assert calls == [1]
+
+
+def test_enqueue_background(jobqueue):
+    assert JobQueue.enqueue("testjob", "a") is None
+    JobQueue.enqueue("testjob", "a")    # Same job, only queued once
+    JobQueue.enqueue("testjob", "b")
+    assert calls == []
+    assert JobQueue.runpending() == 2
+    assert sorted(calls) == ["a", "b"]
+    assert jobqueue.hgetall(JobQueue.queuekey) == {}
+    assert jobqueue.zcard(JobQueue.duekey) == 0
+
+
+def test_retry_then_give_up(jobqueue):
+    JobQueue.enqueue("testfail", 0)
+    assert JobQueue.runpending() == 1
+    assert len(jobqueue.hgetall(JobQueue.queuekey)) == 1     # Queued for retry
+    assert jobqueue.zcard(JobQueue.duekey) == 1
+    assert JobQueue.runpending() == 1
+    assert jobqueue.hgetall(JobQueue.queuekey) == {}        # Given up after config attempts
+    assert jobqueue.zcard(JobQueue.duekey) == 0
+
+
+def test_only_due_jobs_read(jobqueue):
+    config["jobs"]["backoff"] = 60
+    JobQueue.enqueue("testfail", 0)
+    assert JobQueue.runpending() == 1
+    assert JobQueue.runpending() == 0   # Not due for a minute
+    JobQueue.enqueue("testjob", "c")
+    assert JobQueue.runpending() == 1 and calls == ["c"]
+
+
+def test_lease_taken_over(jobqueue):
+    # A job that outlives its lease must not release the lease of the worker that took the job over
+    leasekey = JobQueue.leaseprefix + JobQueue.jobid("testjob", ["slow"])
+    JobQueue.register("testjob", lambda x: jobqueue.set(leasekey, "otherworker"))
+    JobQueue.enqueue("testjob", "slow")
+    assert JobQueue.runpending() == 1
+    assert jobqueue.get(leasekey) == "otherworker"
@@ -0,0 +1,35 @@
+import threading
+import time
+from python.Singleflight import Singleflight
+
+
+def test_singleflight():
+    calls = []
+
+    def slow():
+        calls.append(1)
+        time.sleep(0.5)
+        return {"Content-type": "application/json", "data": {"identifier": "commute"}}
+
+    key = Singleflight.key("archiveid", "commute", output="metadata", verbose=True)
+    assert key == Singleflight.key("archiveid", "commute", output="metadata")   # verbose doesnt change the key
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(Singleflight.do(key, slow))) for i in range(10)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    assert len(calls) == 1
+    assert len(results) == 10 and all(r["data"]["identifier"] == "commute" for r in results)
+    Singleflight.do(key, slow)  # Not in flight any more, so runs again
+    assert len(calls) == 2
+
+
+def test_arc_metadata_output_kwarg(monkeypatch):
+    # ?output=... in the query string is passed in kwargs, and must not clash with the output the key is made with
+    from python import ServerGateway
+
+    class Item:
+        def metadata(self, headers=True, **kwargs):
+            return {"Content-type": "application/json", "data": {"identifier": "commute"}}
+    monkeypatch.setattr(ServerGateway.ArchiveItem, "new", classmethod(lambda cls, *args, **kwargs: Item()))
+    res = ServerGateway.DwebGatewayHTTPRequestHandler.arc_metadata(None, "commute", output="metadata")
+    assert res["data"]["identifier"] == "commute"